@@ -0,0 +1,201 @@
+"""
+Compare the row-at-a-time transforms `susocli run` used to do with the
+vectorized ones in `suso.participants`, on synthetic participants. Also
+compares the memory taken by the letters as dicts and as `LetterRecord`s.
+
+  python benchmarks/participants_benchmark.py --num-participants 50000
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import time
+import tracemalloc
+
+import click
+import numpy as np
+import pandas as pd
+
+from suso import database as db
+from suso import participants
+
+
+def synthetic_participants(num_participants, seed=1234):
+    """Participants shaped like `eto.ApiHandler.get_all_participants` output"""
+    rng = np.random.RandomState(seed)
+
+    def with_missing(values, rate):
+        values = pd.Series(values, dtype=object)
+        return values.mask(rng.rand(len(values)) < rate, None)
+
+    staff_numbers = rng.randint(0, 100, num_participants)
+    return pd.DataFrame(
+        {
+            "CLID": rng.permutation(num_participants * 2)[:num_participants] + 1000,
+            "FName": with_missing([f"First{i}" for i in range(num_participants)], 0.01),
+            "LName": with_missing([f"Last{i}" for i in range(num_participants)], 0.01),
+            "address": with_missing(
+                [f"{i} Main St NW" for i in range(num_participants)], 0.02
+            ),
+            "zipcode": with_missing(rng.randint(20001, 20040, num_participants), 0.01),
+            "guardian_firstname": with_missing(["Guardian"] * num_participants, 0.02),
+            "guardian_lastname": with_missing(["Name"] * num_participants, 0.02),
+            "site_name": rng.choice(
+                ["Far Southeast", "Example CBO", "Another CBO"], num_participants
+            ),
+            "staff_first_name": with_missing([f"User{n}" for n in staff_numbers], 0.05),
+            "staff_last_name": with_missing(["Worker"] * num_participants, 0.05),
+            "school_name": rng.choice(["Example School", "Another"], num_participants),
+            "referral_date": pd.Series(
+                pd.date_range("2018-01-01", periods=365).strftime("%Y-%m-%d")
+            )
+            .sample(num_participants, replace=True, random_state=seed)
+            .values,
+        }
+    )
+
+
+def legacy_student_rows(new_participants):
+    bad_data_filter = (
+        new_participants.guardian_firstname.isnull()
+        | new_participants.guardian_lastname.isnull()
+        | new_participants.FName.isnull()
+        | new_participants.LName.isnull()
+        | new_participants.address.isnull()
+        | new_participants.zipcode.isnull()
+    )
+    rows = []
+    for df, is_good_record in [
+        [new_participants[~bad_data_filter], 1],
+        [new_participants[bad_data_filter], 0],
+    ]:
+        for _, row in df.iterrows():
+            if pd.isnull(row.staff_first_name) or pd.isnull(row.staff_last_name):
+                caseworker_name = None
+            else:
+                caseworker_name = " ".join((row.staff_first_name, row.staff_last_name))
+            rows.append(
+                (
+                    row.CLID,
+                    row.FName,
+                    row.LName,
+                    row.address,
+                    row.zipcode,
+                    row.guardian_firstname,
+                    row.guardian_lastname,
+                    row.site_name,
+                    caseworker_name,
+                    row.school_name,
+                    row.referral_date,
+                    is_good_record,
+                )
+            )
+    return rows
+
+
+def legacy_fix_caseworkers(df):
+    df = df.copy()
+    df.loc[
+        df.caseworker.str.startswith("User", na=False)
+        & df.cbo.str.startswith("Far South", na=False),
+        "caseworker",
+    ] = "Default Contact"
+    return df.caseworker.map(
+        lambda word: "".join(letter for letter in word if not letter.isdigit()),
+        na_action="ignore",
+    )
+
+
+def legacy_letter_data(df):
+    return {
+        row.id: {
+            "cbo_name": row.cbo,
+            "school": row.school,
+            "guardian": row.guardian_firstname + " " + row.guardian_lastname,
+            "caseworker_name": row.caseworker,
+            "address": row.address,
+            "zipcode": row.zipcode,
+        }
+        for _, row in df.iterrows()
+        if row.is_treatment > 0
+    }
+
+
+def _allocated(function, *args):
+    """The bytes still allocated for what `function` returns"""
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def _time(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+@click.command()
+@click.option("--num-participants", "-n", type=int, default=50000)
+@click.option("--repeat", type=int, default=3, help="Report the best of this many")
+def main(num_participants, repeat):
+    raw = synthetic_participants(num_participants)
+    latest = participants.latest_referrals(raw)
+
+    students = participants.student_rows(latest)
+    letters = students.assign(is_treatment=np.arange(len(students)) % 2)
+    letters = letters[letters.is_good_record == 1]
+    letters["caseworker"] = letters.caseworker.fillna("Someone")
+
+    benchmarks = [
+        (
+            "student rows",
+            lambda: legacy_student_rows(latest),
+            lambda: db._to_rows(participants.student_rows(latest), db.STUDENT_COLUMNS),
+        ),
+        (
+            "caseworker fix",
+            lambda: legacy_fix_caseworkers(letters),
+            lambda: participants.fix_caseworkers(letters),
+        ),
+        (
+            "letter data",
+            lambda: legacy_letter_data(letters),
+            lambda: participants.letter_records(letters),
+        ),
+    ]
+
+    click.echo(f"{num_participants} synthetic participants, best of {repeat}\n")
+    click.echo(
+        "{:<16} {:>10} {:>10} {:>8}".format("", "iterrows", "vectorized", "speedup")
+    )
+    for name, legacy, vectorized in benchmarks:
+        legacy_seconds, _ = _time(legacy, repeat=repeat)
+        vectorized_seconds, _ = _time(vectorized, repeat=repeat)
+        click.echo(
+            "{:<16} {:>9.3f}s {:>9.3f}s {:>7.1f}x".format(
+                name,
+                legacy_seconds,
+                vectorized_seconds,
+                legacy_seconds / vectorized_seconds,
+            )
+        )
+
+    dict_bytes = _allocated(legacy_letter_data, letters)
+    record_bytes = _allocated(participants.letter_records, letters)
+    click.echo(
+        "\nletters in memory: {:.1f}MB as dicts, {:.1f}MB as LetterRecords "
+        "({:.0%})".format(
+            dict_bytes / 1e6, record_bytes / 1e6, record_bytes / dict_bytes
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""
+The database engines the SUSO tables can live in. Production uses SQL Server over
+ODBC; SQLite lets the whole pipeline run (and be profiled) on one machine with no
+server at all. Pick one with the `backend` key of the `db` section of the config::
+
+  db:
+    backend: sqlite
+    database: /work/suso.sqlite3
+
+If `backend` is missing, SQL Server is assumed.
+
+Each backend knows how to connect and supplies the bits of SQL that differ between
+the engines. Code in `suso.database` asks `backend_for(curs)` which backend it is
+talking to.
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import copy
+import math
+import re
+import sqlite3
+
+
+class Backend:
+    """
+    The interface each database backend implements.
+    """
+
+    name = None
+
+    # The expression for the current timestamp
+    now = None
+
+    # The column type of an auto-incrementing integer primary key
+    identity_primary_key = None
+
+    # The table hint which holds a lock on the keys a statement reads until the
+    # transaction ends, so that checking for a row and then inserting it is atomic.
+    # SQLite lets only one transaction write at a time, so it needs none.
+    key_lock_hint = ""
+
+    def connect(self, config):
+        """
+        Connect to the database described by `config`.
+
+        Args:
+          config (dict): The `db` section of the config, without `backend`
+
+        Returns:
+          A DB-API 2.0 connection
+        """
+        raise NotImplementedError
+
+    def begin(self, curs):
+        """
+        Make sure a transaction is open on `curs`, so that DDL run after this is
+        rolled back along with everything else. pyodbc connections are never in
+        autocommit mode, so by default there's nothing to do.
+        """
+
+    def set_statement_timeout(self, conn, seconds):
+        """
+        Make statements run on `conn` from now on fail after `seconds`. SQLite
+        runs in process with nothing to hang on, so by default this does nothing.
+        """
+
+    def references(self, table_name, column):
+        """The inline column constraint for a foreign key"""
+        raise NotImplementedError
+
+    def create_table_if_not_exists(self, table_name, rendered_columns):
+        """The statement creating `table_name` if it doesn't exist"""
+        raise NotImplementedError
+
+    def temp_table_name(self, name):
+        """The name by which to refer to the temporary table `name`"""
+        raise NotImplementedError
+
+    def create_temp_table(self, name, rendered_columns):
+        """The statement creating a connection-scoped temporary table"""
+        raise NotImplementedError
+
+    def create_covering_index(
+        self, index_name, table_name, key_columns, included_columns, where=None
+    ):
+        """
+        The statement creating an index on `key_columns` which also carries
+        `included_columns`, so that queries reading only those columns never have
+        to touch the table. If `where` is passed, the index is filtered by it.
+        """
+        raise NotImplementedError
+
+    def drop_index(self, index_name, table_name):
+        """The statement dropping the index `index_name` of `table_name`"""
+        raise NotImplementedError
+
+    def insert_returning(self, table_name, columns, select, returned_column):
+        """
+        The statement inserting the rows `select` picks into `columns` of
+        `table_name`, which returns `returned_column` of each row it inserted.
+        """
+        raise NotImplementedError
+
+    def increment(self, table_name, key_columns, column):
+        """
+        The statement adding to `column` of the row of `table_name` with the given
+        `key_columns`, inserting the row if there isn't one. It is atomic even when
+        two runs race to insert the same row. Its parameters are the values of the
+        key columns followed by the amount to add.
+        """
+        raise NotImplementedError
+
+    def year(self, expression):
+        """An integer expression for the year of the date `expression`"""
+        raise NotImplementedError
+
+    def month(self, expression):
+        """An integer expression for the month of the date `expression`"""
+        raise NotImplementedError
+
+    def indexes_used(self, curs, sql, params=()):
+        """
+        Ask the database for the plan it would use for `sql` (without running it)
+        and return the names of the indexes the plan touches.
+
+        Returns:
+          set[str]: The names of the indexes in the plan
+        """
+        raise NotImplementedError
+
+
+class SqlServerBackend(Backend):
+    name = "mssql"
+    now = "GETDATE()"
+    identity_primary_key = "INTEGER IDENTITY(1, 1) PRIMARY KEY"
+    key_lock_hint = " WITH (UPDLOCK, HOLDLOCK)"
+
+    def connect(self, config):
+        import pyodbc
+
+        config = copy.copy(config)
+        config["uid"] = config.pop("username")
+        config["pwd"] = config.pop("password")
+        return pyodbc.connect(**config)
+
+    def set_statement_timeout(self, conn, seconds):
+        # pyodbc's query timeout is in whole seconds, and 0 means none
+        conn.timeout = max(int(math.ceil(seconds)), 1)
+
+    def references(self, table_name, column):
+        return f"FOREIGN KEY REFERENCES {table_name}({column})"
+
+    def create_table_if_not_exists(self, table_name, rendered_columns):
+        return f"""
+    IF NOT EXISTS (
+      SELECT * FROM sysobjects WHERE name = '{table_name}' AND xtype = 'U'
+    )
+    CREATE TABLE {table_name} (
+      {rendered_columns}
+    )
+  """
+
+    def temp_table_name(self, name):
+        return f"#{name}"
+
+    def create_temp_table(self, name, rendered_columns):
+        return f"""
+    CREATE TABLE {self.temp_table_name(name)} (
+      {rendered_columns}
+    )
+  """
+
+    def create_covering_index(
+        self, index_name, table_name, key_columns, included_columns, where=None
+    ):
+        sql = f"""CREATE INDEX {index_name} ON {table_name} ({", ".join(key_columns)})
+            INCLUDE ({", ".join(included_columns)})"""
+        if where:
+            sql += f" WHERE {where}"
+        return sql
+
+    def drop_index(self, index_name, table_name):
+        return f"DROP INDEX {index_name} ON {table_name}"
+
+    def insert_returning(self, table_name, columns, select, returned_column):
+        return f"""
+    INSERT INTO {table_name} ({", ".join(columns)})
+    OUTPUT inserted.{returned_column}
+    {select}
+  """
+
+    def increment(self, table_name, key_columns, column):
+        columns = key_columns + (column,)
+        return f"""
+    MERGE {table_name} WITH (HOLDLOCK) AS target
+    USING (SELECT {", ".join(f"? AS {name}" for name in columns)}) AS source
+       ON {" AND ".join(f"target.{name} = source.{name}" for name in key_columns)}
+     WHEN MATCHED THEN
+          UPDATE SET {column} = target.{column} + source.{column}
+     WHEN NOT MATCHED THEN
+          INSERT ({", ".join(columns)})
+          VALUES ({", ".join(f"source.{name}" for name in columns)});
+  """
+
+    def year(self, expression):
+        return f"DATEPART(year, {expression})"
+
+    def month(self, expression):
+        return f"DATEPART(month, {expression})"
+
+    def indexes_used(self, curs, sql, params=()):
+        curs.execute("SET SHOWPLAN_XML ON")
+        try:
+            curs.execute(sql, params)
+            plan = "".join(row[0] for row in curs.fetchall())
+        finally:
+            curs.execute("SET SHOWPLAN_XML OFF")
+        return set(re.findall(r'Index="\[([^\]]+)\]"', plan))
+
+
+class SqliteBackend(Backend):
+    name = "sqlite"
+    now = "CURRENT_TIMESTAMP"
+    identity_primary_key = "INTEGER PRIMARY KEY AUTOINCREMENT"
+
+    def connect(self, config):
+        conn = sqlite3.connect(config.get("database", ":memory:"))
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def begin(self, curs):
+        # sqlite3 only opens transactions implicitly before DML, not DDL
+        if not curs.connection.in_transaction:
+            curs.execute("BEGIN")
+
+    def references(self, table_name, column):
+        return f"REFERENCES {table_name}({column})"
+
+    def create_table_if_not_exists(self, table_name, rendered_columns):
+        return f"""
+    CREATE TABLE IF NOT EXISTS {table_name} (
+      {rendered_columns}
+    )
+  """
+
+    def temp_table_name(self, name):
+        return name
+
+    def create_temp_table(self, name, rendered_columns):
+        return f"""
+    CREATE TEMP TABLE {self.temp_table_name(name)} (
+      {rendered_columns}
+    )
+  """
+
+    def create_covering_index(
+        self, index_name, table_name, key_columns, included_columns, where=None
+    ):
+        # SQLite has no INCLUDE, but an index on all the columns covers the same
+        # queries
+        columns = ", ".join(tuple(key_columns) + tuple(included_columns))
+        sql = f"CREATE INDEX {index_name} ON {table_name} ({columns})"
+        if where:
+            sql += f" WHERE {where}"
+        return sql
+
+    def drop_index(self, index_name, table_name):
+        return f"DROP INDEX {index_name}"
+
+    def insert_returning(self, table_name, columns, select, returned_column):
+        return f"""
+    INSERT INTO {table_name} ({", ".join(columns)})
+    {select}
+    RETURNING {returned_column}
+  """
+
+    def increment(self, table_name, key_columns, column):
+        columns = key_columns + (column,)
+        return f"""
+    INSERT INTO {table_name} ({", ".join(columns)})
+    VALUES ({", ".join("?" for _ in columns)})
+        ON CONFLICT ({", ".join(key_columns)})
+        DO UPDATE SET {column} = {column} + excluded.{column}
+  """
+
+    def year(self, expression):
+        return f"CAST(strftime('%Y', {expression}) AS INTEGER)"
+
+    def month(self, expression):
+        return f"CAST(strftime('%m', {expression}) AS INTEGER)"
+
+    def indexes_used(self, curs, sql, params=()):
+        curs.execute("EXPLAIN QUERY PLAN " + sql, params)
+        plan = "\n".join(row[-1] for row in curs.fetchall())
+        return set(re.findall(r"USING (?:COVERING )?INDEX (\w+)", plan))
+
+
+BACKENDS = {backend.name: backend for backend in (SqlServerBackend(), SqliteBackend())}
+
+DEFAULT_BACKEND = SqlServerBackend.name
+
+
+def get_backend(config):
+    """
+    Return the backend named in the `db` section of the config.
+
+    Args:
+      config (dict): The `db` section of the config
+
+    Returns:
+      Backend: The backend
+    """
+    name = config.get("backend", DEFAULT_BACKEND)
+    if name not in BACKENDS:
+        raise ValueError(
+            "Unknown database backend {}; expected one of {}".format(
+                name, ", ".join(sorted(BACKENDS))
+            )
+        )
+    return BACKENDS[name]
+
+
+def backend_for(obj):
+    """
+    Return the backend which a connection or cursor belongs to.
+
+    Args:
+      obj: A connection or cursor returned by `suso.database`
+
+    Returns:
+      Backend: The backend
+    """
+    backend = getattr(obj, "backend", None)
+    if isinstance(backend, Backend):
+        return backend
+    if isinstance(obj, (sqlite3.Connection, sqlite3.Cursor)):
+        return BACKENDS[SqliteBackend.name]
+    return BACKENDS[SqlServerBackend.name]
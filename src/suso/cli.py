@@ -1,63 +1,206 @@
-import time
+import os
 import uuid
 from datetime import datetime, timedelta
 
 import click
-import numpy as np
-import pandas as pd
-import yaml
 
-from suso import click2mail
+# Only light modules are imported here so that, e.g., `susocli --help` and
+# `susocli migrate` start quickly. Modules which pull in pandas, requests, bs4,
+# mailchimp3, jinja2 or yaml are imported inside the commands that use them.
+# tests/test_import_time.py keeps this honest.
 from suso import database as db
-from suso import email, eto, render
+from suso import (
+    export,
+    journal,
+    letters,
+    migrations,
+    profiling,
+    randomizer,
+    scheduler,
+    stages,
+    tenants,
+)
+from suso.deadline import Deadline, DeadlineExceeded, deadline_from_config
+
+
+class SubmissionUncertain(Exception):
+    """
+    Raised when a job may or may not have been submitted, and Click2Mail can't
+    say which
+    """
 
 
 class Submitter:
-    def __init__(self, client, data, pdf_directory):
+    def __init__(
+        self, client, records, pdf_directory, submission_journal=None, deadline=None
+    ):
+        """
+        Args:
+          client (click2mail.Click2MailClient): A logged in client
+          records (iterable[letters.LetterRecord]): The letters to submit. Their
+            Click2Mail ids are filled in as they go.
+          pdf_directory (str): Where to find the pdfs of letters without a
+            `pdf_path`
+          submission_journal (journal.SubmissionJournal|None): Where to record
+            each letter's progress
+          deadline (deadline.Deadline|None): When to stop
+        """
         self.client = client
-        self.data = data
-        self.keys = list(data)
+        self.records = list(records)
         self.i = 0
         self.pdf_directory = pdf_directory
+        self.journal = submission_journal or journal.SubmissionJournal()
+        self.deadline = deadline or Deadline()
+        # Letters left for the next run because this one ran out of time
+        self.deferred = []
+        # Whether the current letter's job was created by an earlier run
+        self.resumed_job = False
 
     def __len__(self):
-        return len(self.data)
+        return len(self.records)
+
+    @property
+    def letter(self):
+        return self.records[self.i]
 
     @property
     def key(self):
-        return self.keys[self.i]
+        return self.letter.student_id
+
+    @property
+    def job_id(self):
+        return self.letter.job_id
+
+    def prepare(self, letter):
+        """
+        Upload the document and create the address list for `letter`, skipping
+        either if the journal says it has already been done.
+        """
+        key = letter.student_id
+        if not self.journal.has(key, journal.DOCUMENT_UPLOADED):
+            document_id = self.client.post_document(
+                letter.pdf_path or f"{self.pdf_directory}/{key}.pdf"
+            )
+            self.journal.record(key, journal.DOCUMENT_UPLOADED, document_id)
+        letter.document_id = self.journal.get(key, journal.DOCUMENT_UPLOADED)
+
+        if not self.journal.has(key, journal.ADDRESS_LIST_CREATED):
+            address_list_id = self.client.post_recipients(
+                [letter.recipient()], uuid.uuid4()
+            )
+            self.journal.record(key, journal.ADDRESS_LIST_CREATED, address_list_id)
+        letter.address_list_id = self.journal.get(key, journal.ADDRESS_LIST_CREATED)
+
+    def _defer(self, records):
+        for letter in records:
+            letter.deferred = True
+        self.deferred.extend(records)
+
+    def prepare_all(self):
+        """
+        Upload documents and address lists for every letter, then wait for
+        Click2Mail to finish processing all of the address lists at once.
+
+        Letters whose address lists Click2Mail rejected, or said something
+        unexpected about, are dropped from this submitter (and forgotten by the
+        journal so that the next run starts them over). So are letters which
+        can't be prepared before the deadline, or whose address lists are still
+        processing when the wait times out, which are moved to `deferred`. One
+        list's trouble doesn't hold up the others.
+
+        Returns:
+          dict: A map from the student ids of rejected letters to Click2Mail's
+            reason
+        """
+        from suso import click2mail
+
+        waiting = {}
+        for i, letter in enumerate(self.records):
+            try:
+                self.deadline.check()
+                self.prepare(letter)
+            except DeadlineExceeded:
+                self._defer(self.records[i:])
+                self.records = self.records[:i]
+                break
+            if not self.journal.has(letter.student_id, journal.JOB_CREATED):
+                waiting[letter.address_list_id] = letter
+
+        rejected = {}
+        if waiting:
+            try:
+                statuses = self.client.wait_for_address_lists(
+                    waiting,
+                    timeout=self.deadline.timeout(
+                        click2mail.DEFAULT_ADDRESS_LIST_TIMEOUT
+                    ),
+                    return_exceptions=True,
+                )
+            except DeadlineExceeded:
+                statuses = {}
+
+            unready = []
+            for address_list_id, letter in waiting.items():
+                status, description = statuses.get(address_list_id, (None, None))
+                if isinstance(description, ValueError):
+                    rejected[letter.student_id] = str(description)
+                elif status is None:
+                    # The journal has its address list, so the next run only waits
+                    click.echo(
+                        f"Address list for {letter.student_id} isn't ready; "
+                        "leaving it for the next run"
+                    )
+                    unready.append(letter)
+                elif status:
+                    rejected[letter.student_id] = description
+            if unready:
+                self._defer(unready)
+                self.records = [
+                    letter for letter in self.records if not letter.deferred
+                ]
+
+        for key in rejected:
+            self.journal.reset(key)
+        self.records = [
+            letter for letter in self.records if letter.student_id not in rejected
+        ]
+        return rejected
 
     def post(self):
-        print(f"Posting {self.key}")
-        self.document_id = self.client.post_document(
-            f"{self.pdf_directory}/{self.key}.pdf"
-        )
-        datum = self.data[self.key]
-        address = {
-            "firstname": datum["guardian"],
-            "lastname": "",
-            "address": datum["address"],
-            "city": "Washington",
-            "state": "DC",
-            "zipcode": datum["zipcode"],
-        }
-        self.address_list_id = self.client.post_recipients([address], uuid.uuid4())
-        self.job_id = self.client.create_job(self.document_id, self.address_list_id)
-        self.client._post(
-            "jobs",
-            self.job_id,
-            "update",
-            data={
-                "rtnName": "Michelle Garcia",
-                "rtnAddress2": "1350 Pennsylvania Avenue NW Suite 533",
-                "rtnAddress1": "c/o Donald Braman",
-                "rtnZip": "20004",
-                "rtnCity": "Washington",
-                "rtnState": "DC",
-            },
-        )
+        """
+        Create the job for the current letter, uploading its document and address
+        list first if `prepare_all` hasn't. Any of these steps which the journal
+        says have already been completed (e.g., by a run that died partway through)
+        are skipped.
+        """
+        letter = self.letter
+        print(f"Posting {letter.student_id}")
+        self.prepare(letter)
+
+        letter.job_id = self.journal.get(letter.student_id, journal.JOB_CREATED)
+        self.resumed_job = letter.job_id is not None
+        if letter.job_id is None:
+            letter.job_id = self.client.create_job(
+                letter.document_id, letter.address_list_id
+            )
+            self.client._post(
+                "jobs",
+                letter.job_id,
+                "update",
+                data={
+                    "rtnName": "Michelle Garcia",
+                    "rtnAddress2": "1350 Pennsylvania Avenue NW Suite 533",
+                    "rtnAddress1": "c/o Donald Braman",
+                    "rtnZip": "20004",
+                    "rtnCity": "Washington",
+                    "rtnState": "DC",
+                },
+            )
+            self.journal.record(letter.student_id, journal.JOB_CREATED, letter.job_id)
 
     def get_proof(self, tempfile="hold.pdf"):
+        from suso import click2mail
+
         r = self.client._post("jobs", self.job_id, "proof")
         self.proof_id = click2mail._get_id_from_response(r)
         r = self.client._get("jobs", self.job_id, "proof", self.proof_id)
@@ -65,48 +208,74 @@ class Submitter:
             f.write(r.content)
 
     def submit(self):
-        self.client.submit_job(str(self.job_id))
+        """
+        Submit the current letter's job, unless it already has been. A job which
+        an earlier run created may have been submitted without the journal hearing
+        about it, and a submission which times out may have gone through anyway,
+        so in both cases ask Click2Mail first rather than paying for it twice.
+
+        Raises:
+          SubmissionUncertain: If the submission timed out and Click2Mail can't
+            say whether it went through
+        """
+        import requests
+
+        letter = self.letter
+        if self.journal.has(letter.student_id, journal.SUBMITTED):
+            letter.submitted = True
+            return
+
+        self.deadline.check()
+        if not (self.resumed_job and self.client.job_submitted(letter.job_id)):
+            try:
+                self.client.submit_job(str(letter.job_id))
+            except (requests.RequestException, DeadlineExceeded) as exc:
+                submitted = self.client.job_submitted(letter.job_id)
+                if submitted is None:
+                    raise SubmissionUncertain(
+                        f"Couldn't tell whether job {letter.job_id} was submitted"
+                    ) from exc
+                if not submitted:
+                    raise
+        self.journal.record(letter.student_id, journal.SUBMITTED, letter.job_id)
+        letter.submitted = True
 
     def advance(self):
         self.i += 1
 
+    def defer_rest(self):
+        """Leave the current letter and those after it for the next run"""
+        self._defer(self.records[self.i :])
+        self.records = self.records[: self.i]
+
+    def defer_current(self):
+        """Leave just the current letter for the next run"""
+        self._defer([self.records.pop(self.i)])
+
+
+def load_config(path):
+    """Read the YAML config at `path`"""
+    import yaml
+
+    with open(path) as f:
+        return yaml.safe_load(f)
+
 
 def today():
     return datetime.now().strftime("%Y-%m-%d %H:00")
 
 
 def get_stats_tables(curs):
-    min_date = (datetime.now() - timedelta(days=365 * 2)).strftime("%Y-%m-01")
-    curs.execute(
-        """
-    WITH by_month AS (
-      SELECT DATEPART(year, enrolled_date) as the_year,
-             DATEPART(month, enrolled_date) the_month
-        FROM students_new
-       WHERE enrolled_date >= ?
-    )
-    SELECT the_year, the_month, COUNT(*)
-      FROM by_month
-     GROUP BY the_year, the_month
-     ORDER BY the_year, the_month ASC;
-    """,
-        (min_date,),
-    )
+    import pandas as pd
+
+    min_date = datetime.now() - timedelta(days=365 * 2)
+    curs.execute(db.MONTH_STATS_QUERY, (min_date.year, min_date.year, min_date.month))
     month_counts = pd.DataFrame.from_records(
         curs.fetchall(), columns=["year", "month", "count"]
     )
 
     min_date = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
-    curs.execute(
-        """
-    SELECT enrolled_date, COUNT(*)
-      FROM students_new
-     WHERE enrolled_date >= ?
-     GROUP BY enrolled_date
-     ORDER BY enrolled_date ASC;
-  """,
-        (min_date,),
-    )
+    curs.execute(db.DAY_STATS_QUERY, (min_date,))
     day_counts = pd.DataFrame.from_records(curs.fetchall(), columns=["day", "count"])
 
     return "Count of students by month\n\n{}\n\nCount of students by day\n\n{}".format(
@@ -114,19 +283,38 @@ def get_stats_tables(curs):
     )
 
 
-def stop_email(username, key, curs):
-    client = email.get_client(username, key)
+def stop_email(username, key, curs, mailer=None):
+    from suso import email
+
+    client = mailer or email.get_client(username, key)
     text = "There were no new letters at this time\n\n" + get_stats_tables(curs)
     email.send_email(client, "SUSO " + today(), text)
 
 
-def success_email(username, key, curs, num_sent, num_errors):
-    client = email.get_client(username, key)
-    text = (
-        "There were {} letters sent at this time and there were {} errors\n\n{}".format(
-            num_sent, num_errors, get_stats_tables(curs)
-        )
+def success_email(
+    username,
+    key,
+    curs,
+    num_sent,
+    num_errors,
+    query_metrics=None,
+    mailer=None,
+    num_deferred=0,
+):
+    from suso import email
+
+    client = mailer or email.get_client(username, key)
+    text = "There were {} letters sent at this time and there were {} errors".format(
+        num_sent, num_errors
     )
+    if num_deferred:
+        text += (
+            "\n\nThe run ran out of time, so {} letters were left for the next "
+            "run".format(num_deferred)
+        )
+    text += "\n\n" + get_stats_tables(curs)
+    if query_metrics is not None:
+        text += "\n\nDatabase time by statement\n\n" + query_metrics.summary()
     email.send_email(client, "SUSO " + today(), text)
 
 
@@ -139,61 +327,28 @@ def cli():
 @click.argument("config")
 def create_command(config):
     """Setup the tables for the SUSO database"""
-    with open(config) as f:
-        config = yaml.load(config)
+    config = load_config(config)
 
     conn = db.get_connection(config["db"])
+    create_database(conn)
+    conn.close()
+
+
+def create_database(conn):
+    """
+    Create the tables of a new SUSO database, apply the migrations, and insert the
+    placeholder student that sets the starting point for pulling from ETO.
+    """
     curs = conn.cursor()
-    db._create_table_if_not_exists(
-        curs,
-        db.STUDENTS_TABLE,
-        "id INTEGER PRIMARY KEY",
-        "firstname NVARCHAR(1024)",
-        "lastname NVARCHAR(1024)",
-        "address NVARCHAR(1024)",
-        "zipcode NVARCHAR(20)",
-        "guardian_firstname NVARCHAR(1024)",
-        "guardian_lastname NVARCHAR(1024)",
-        "cbo NVARCHAR(1024)",
-        "caseworker NVARCHAR(1024)",
-        "school NVARCHAR(1024)",
-        "enrolled_date NVARCHAR(1024)",
-        "is_good_record BIT",
-        "created_at DATETIME NOT NULL DEFAULT GETDATE()",
-    )
-    db._create_table_if_not_exists(
-        curs,
-        db.RANDOMIZER_TABLE,
-        "student_id INTEGER PRIMARY KEY",
-        "is_treatment BIT",
-        "created_at DATETIME NOT NULL DEFAULT GETDATE()",
-    )
-    db._create_table_if_not_exists(
-        curs,
-        db.STATUS_TABLE,
-        "id INTEGER IDENTITY(1, 1) PRIMARY KEY",
-        f"student_id INTEGER FOREIGN KEY REFERENCES {db.STUDENTS_TABLE}(id)",
-        "status NVARCHAR(20)",
-        "created_at DATETIME NOT NULL DEFAULT GETDATE()",
-    )
-    db._create_table_if_not_exists(
-        curs,
-        db.JOBS_TABLE,
-        "id INTEGER PRIMARY KEY NOT NULL",
-        f"student_id INTEGER FOREIGN KEY REFERENCES {db.STUDENTS_TABLE}(id)",
-        "created_at DATETIME NOT NULL DEFAULT GETDATE()",
-    )
-    db._create_table_if_not_exists(
-        curs,
-        db.MAILINGS_TABLE,
-        "id INTEGER IDENTITY(1, 1) PRIMARY KEY, NOT NULL",
-        f"job_id INTEGER FOREIGN KEY REFERENCES {db.JOBS_TABLE}(id)",
-        "status NVARCHAR(64)",
-        "status_datetime DATETIME",
-        "created_at DATETIME NOT NULL DEFAULT GETDATE()",
-    )
+    db.create_tables(curs)
+    curs.close()
+    conn.commit()
+
+    for migration in migrations.migrate(conn):
+        click.echo(f"Applied migration {migration.version}: {migration.description}")
 
     # This sets a starting point in the database
+    curs = conn.cursor()
     db.insert_student(
         curs,
         1,
@@ -212,306 +367,1023 @@ def create_command(config):
     db.insert_randomizer(curs, 1, 0)
     curs.close()
     conn.commit()
+
+
+@cli.command("migrate")
+@click.argument("config")
+@click.option("--target", type=int, default=None, help="The last version to apply")
+@click.option(
+    "--list", "list_only", is_flag=True, help="List pending migrations and exit"
+)
+def migrate_command(config, target, list_only):
+    """Apply pending schema migrations to the SUSO database"""
+    config = load_config(config)
+
+    conn = db.get_connection(config["db"])
+    if list_only:
+        curs = conn.cursor()
+        pending = migrations.pending_migrations(curs)
+        curs.close()
+        conn.commit()
+        for migration in pending:
+            click.echo(f"{migration.version}: {migration.description}")
+        if not pending:
+            click.echo("No pending migrations")
+    else:
+        applied = migrations.migrate(conn, target=target)
+        for migration in applied:
+            click.echo(
+                f"Applied migration {migration.version}: {migration.description}"
+            )
+        if not applied:
+            click.echo("No pending migrations")
     conn.close()
 
 
-@cli.command("run")
+@cli.command("plans")
 @click.argument("config")
-@click.option("--tex", "-t", default="./tex", help="Where to store generated tex files")
-@click.option("--pdf", "-p", default="./pdf", help="Where to store generated pdf files")
-def run_command(config, tex, pdf):
-    with open(config) as f:
-        config = yaml.load(f)
+def plans_command(config):
+    """Check that the hot queries' plans use the indexes they should"""
+    config = load_config(config)
 
-    # From what date should we pull new data from ETO?
     conn = db.get_connection(config["db"])
     curs = conn.cursor()
-    curs.execute(f"""SELECT MAX(enrolled_date) FROM {db.STUDENTS_TABLE}""")
-    start_date = max(curs.fetchall()[0][0], "2018-01-04")  # Deal with start date
+    all_ok = True
+    for query, indexes in migrations.check_query_plans(curs):
+        missing = query.expected_indexes - indexes
+        all_ok = all_ok and not missing
+        click.echo(
+            "{status} {name}: uses {used}{missing}".format(
+                status="ok  " if not missing else "MISS",
+                name=query.name,
+                used=", ".join(sorted(indexes)) or "no indexes",
+                missing=f" (expected {', '.join(sorted(missing))})" if missing else "",
+            )
+        )
+    curs.close()
+    conn.close()
 
-    # Back the date up a couple days in case something happened to time zones or automation
-    start_date = (
-        datetime.strptime(start_date, "%Y-%m-%d") - timedelta(days=2)
-    ).strftime("%Y-%m-%d")
+    if not all_ok:
+        raise SystemExit(1)
 
-    curs.execute(f"""SELECT id FROM {db.STUDENTS_TABLE}""")
-    all_ids = {row[0] for row in curs.fetchall()}
-    curs.close()
 
-    # Setup ETO handler
-    api = eto.ApiHandler()
-    api.login(config["eto"]["username"], config["eto"]["password"])
-
-    # Pull data from ETO
-    click.echo("Pulling data from ETO")
-    end_date = datetime.now().strftime("%Y-%m-%d")
-    potential_participants = api.get_all_participants(start_date, end_date)
-    potential_participants[
-        "referral_date"
-    ] = potential_participants.ProgramStartDate.apply(eto.convert_date)
-
-    # Filter to new participants
-    new_participants = potential_participants[
-        ~potential_participants.CLID.isin(all_ids)
-    ]
-    new_participants = new_participants.sort_values(by="referral_date", ascending=False)
-    new_participants = new_participants.drop_duplicates("CLID")
-
-    # Filter for missing data
-    bad_data_filter = (
-        new_participants.guardian_firstname.isnull()
-        | new_participants.guardian_lastname.isnull()
-        | new_participants.FName.isnull()
-        | new_participants.LName.isnull()
-        | new_participants.address.isnull()
-        | new_participants.zipcode.isnull()
-    )
-    good_participants = new_participants[~bad_data_filter]
-    bad_participants = new_participants[bad_data_filter]
+@cli.command("rebuild-stats")
+@click.argument("config")
+def rebuild_stats_command(config):
+    """Recompute the enrollment counts used in the summary emails"""
+    config = load_config(config)
 
-    # Commit participants to db
-    click.echo("Committing participants to db")
+    conn = db.get_connection(config["db"])
     curs = conn.cursor()
-    for df, is_good_record in [[good_participants, 1], [bad_participants, 0]]:
-        for _, row in df.iterrows():
-            if pd.isnull(row.staff_first_name) or pd.isnull(row.staff_last_name):
-                caseworker_name = None
-            else:
-                caseworker_name = " ".join((row.staff_first_name, row.staff_last_name))
-            db.insert_student(
-                curs,
-                row.CLID,
-                row.FName,
-                row.LName,
-                row.address,
-                row.zipcode,
-                row.guardian_firstname,
-                row.guardian_lastname,
-                row.site_name,
-                caseworker_name,
-                row.school_name,
-                row.referral_date,
-                is_good_record,
-            )
-
+    db.rebuild_enrollment_stats(curs)
     curs.close()
     conn.commit()
+    conn.close()
+    click.echo("Rebuilt enrollment counts")
+
 
-    # Pull standardized participant data from db
-    click.echo("Getting standardized participant list")
+@cli.command("export")
+@click.argument("config")
+@click.option(
+    "--output", "-o", default="./export", help="Where to write the Parquet files"
+)
+@click.option(
+    "--table",
+    "table_names",
+    multiple=True,
+    help="Only export this table. May be passed more than once",
+)
+@click.option(
+    "--full", is_flag=True, help="Re-export everything instead of just new rows"
+)
+@click.option(
+    "--chunk-size",
+    type=int,
+    default=export.DEFAULT_CHUNK_SIZE,
+    help="The number of rows to fetch and write at a time",
+)
+def export_command(config, output, table_names, full, chunk_size):
+    """Export the SUSO tables to Parquet"""
+    config = load_config(config)
+
+    tables = export.EXPORT_TABLES
+    if table_names:
+        unknown = set(table_names) - {table.name for table in tables}
+        if unknown:
+            raise click.BadParameter(
+                "Unknown tables: {}".format(", ".join(sorted(unknown))),
+                param_hint="--table",
+            )
+        tables = [table for table in tables if table.name in table_names]
+
+    conn = db.get_connection(config["db"])
     curs = conn.cursor()
-    curs.execute(
-        f"""
-    SELECT s.id, s.firstname, s.lastname, s.address, s.zipcode,
-           s.guardian_firstname, s.guardian_lastname,
-           s.cbo, s.caseworker, s.enrolled_date,
-           s.school, r.is_treatment
-      FROM {db.STUDENTS_TABLE} s
-    LEFT JOIN {db.RANDOMIZER_TABLE} r
-        ON s.id = r.student_id
-     WHERE r.is_treatment IS NULL
-       AND s.is_good_record = 1
-  """
-    )
-    df = pd.DataFrame.from_records(
-        curs.fetchall(),
-        columns=[
-            "id",
-            "firstname",
-            "lastname",
-            "address",
-            "zipcode",
-            "guardian_firstname",
-            "guardian_lastname",
-            "cbo",
-            "caseworker",
-            "enrolled_date",
-            "school",
-            "is_treatment",
-        ],
+    written = export.export_tables(
+        curs, output, tables=tables, full=full, chunk_size=chunk_size
     )
     curs.close()
+    conn.close()
 
-    # Pull total number of students randomized so far
-    curs = conn.cursor()
-    total_seen = curs.execute(
-        f"""SELECT COUNT(*) FROM {db.RANDOMIZER_TABLE}"""
-    ).fetchall()[0][0]
-    curs.close()
+    for table_name, num_rows in written.items():
+        click.echo(f"Exported {num_rows} rows from {table_name}")
 
-    # Randomize students
-    if len(df) != 0:
-        click.echo("Randomizing")
-        df = df.sample(frac=1)
-        df["is_treatment"] = ((np.arange(len(df)) + total_seen) % 2).astype(bool)
 
-        # Record randomizations
-        curs = conn.cursor()
-        for _, row in df.iterrows():
-            db.insert_randomizer(curs, row.id, 1 if row.is_treatment else 0)
-        curs.close()
-        conn.commit()
-    else:
-        click.echo("Nothing to randomize. Perhaps there are things to send?")
+@cli.command("balance")
+@click.argument("config")
+@click.option(
+    "--by",
+    "strata",
+    type=click.Choice(["cbo", "school", "month"]),
+    multiple=True,
+    help="Also check balance within each value of this. May be passed more than once",
+)
+@click.option("--alpha", type=float, default=0.05, help="The significance level")
+def balance_command(config, strata, alpha):
+    """Check that the treatment and control arms are balanced"""
+    import pandas as pd
+
+    config = load_config(config)
 
-    # Get unsubmitted treatment students from database
+    conn = db.get_connection(config["db"])
     curs = conn.cursor()
-    curs.execute(
-        f"""
-    WITH successes (student_id, status) AS (
-      SELECT student_id, status FROM {db.STATUS_TABLE} WHERE status = 'Success'
-    ),
-    successful_students (student_id, status) AS (
-      SELECT DISTINCT student_id, status FROM successes
-    )
-    SELECT s.id, s.firstname, s.lastname, s.address, s.zipcode,
-           s.guardian_firstname, s.guardian_lastname,
-           s.cbo, s.caseworker, s.enrolled_date,
-           s.school, r.is_treatment
-      FROM {db.STUDENTS_TABLE} s
-      JOIN {db.RANDOMIZER_TABLE} r
-        ON s.id = r.student_id
-      LEFT JOIN successful_students st
-        ON s.id = st.student_id
-     WHERE r.is_treatment = 1
-       AND s.is_good_record = 1
-       AND st.status IS NULL
-  """
-    )
+    curs.execute(db.RANDOMIZED_STUDENTS_QUERY)
     df = pd.DataFrame.from_records(
         curs.fetchall(),
-        columns=[
-            "id",
-            "firstname",
-            "lastname",
-            "address",
-            "zipcode",
-            "guardian_firstname",
-            "guardian_lastname",
-            "cbo",
-            "caseworker",
-            "enrolled_date",
-            "school",
-            "is_treatment",
-        ],
+        columns=["id", "cbo", "school", "enrolled_date", "is_treatment"],
     )
     curs.close()
+    conn.close()
+    df["month"] = df.enrolled_date.str[:7]
 
-    if len(df) == 0:
-        click.echo("Nothing to send. Quitting")
-        curs = conn.cursor()
-        stop_email(config["mailchimp"]["username"], config["mailchimp"]["key"], curs)
-        curs.close()
-        conn.close()
+    all_results = randomizer.balance(df.is_treatment)
+    click.echo(randomizer.balance_report(all_results, alpha=alpha))
+    for stratum in strata:
+        results = randomizer.balance(df.is_treatment, df[stratum])
+        all_results.extend(results[1:])
+        click.echo("\nBy " + stratum)
+        click.echo(randomizer.balance_report(results[1:], alpha=alpha))
+
+    if any(result.p_value < alpha for result in all_results):
+        raise SystemExit(1)
+
+
+@cli.command("run")
+@click.argument("configs", nargs=-1, required=True)
+@click.option("--tex", "-t", default="./tex", help="Where to store generated tex files")
+@click.option("--pdf", "-p", default="./pdf", help="Where to store generated pdf files")
+@click.option(
+    "--journal",
+    "-j",
+    "journal_path",
+    default=None,
+    help="Where to keep the submission journal. Defaults to PDF/submissions.journal",
+)
+@click.option(
+    "--durability",
+    type=click.Choice(db.DURABILITY_MODES),
+    default=None,
+    help="Commit once per stage or after every letter. Defaults to `durability` "
+    "in the db config, else letter",
+)
+@click.option(
+    "--query-metrics",
+    "query_metrics_path",
+    default=None,
+    help="Where to write the timings of the run's SQL statements as JSON. "
+    "Defaults to PDF/query_metrics.json",
+)
+@click.option(
+    "--profile",
+    "profile_path",
+    default=None,
+    help="Time each stage of the run and write the report here as JSON",
+)
+@click.option(
+    "--cprofile",
+    is_flag=True,
+    help="With --profile, also run each stage under cProfile and save the stats "
+    "in a directory next to the report, named after it",
+)
+@click.option(
+    "--simulate",
+    type=click.IntRange(min=0),
+    default=None,
+    metavar="N",
+    help="Rehearse with N made up participants against local fakes of ETO, the "
+    "database, Click2Mail and MailChimp, and report throughput. Nothing is mailed",
+)
+@click.option(
+    "--from",
+    "start",
+    type=click.Choice(stages.STAGES),
+    default=None,
+    help="Start from this stage, using the saved outputs of the ones before it, "
+    "e.g., to pick up a run that failed",
+)
+@click.option(
+    "--to",
+    "end",
+    type=click.Choice(stages.STAGES),
+    default=None,
+    help="Stop after this stage",
+)
+@click.option(
+    "--stages",
+    "stage_directory",
+    default=None,
+    help="Where to save the output of each stage. Defaults to PDF/stages",
+)
+@click.option(
+    "--metrics",
+    "metrics_path",
+    default=None,
+    help="Where to write Prometheus metrics about the run, e.g., for node_exporter's "
+    "textfile collector. Defaults to PDF/metrics.prom",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="With several configs, the most to run at once. Defaults to all of them",
+)
+@click.option(
+    "--logs",
+    "log_directory",
+    default=None,
+    help="With several configs, where to write each one's log. Defaults to PDF/logs",
+)
+def run_command(configs, journal_path, workers, log_directory, **kwargs):
+    """
+    Pull new participants from ETO, randomize them, and mail letters to the
+    treatment group, in the stages ingest, randomize, render, submit and notify.
+
+    Pass several configs (or directories of them) to run each program in its own
+    process at the same time. Each gets its own subdirectory of the tex, pdf and
+    stages directories and its own log.
+    """
+    try:
+        stages.stages_between(kwargs["start"], kwargs["end"])
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--from/--to")
+
+    try:
+        configs = tenants.find_tenants(configs)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="CONFIGS")
+    if not configs:
+        raise click.BadParameter("No config files found", param_hint="CONFIGS")
+
+    if len(configs) == 1:
+        (config_path,) = configs.values()
+        run_config(config_path, journal_path=journal_path, **kwargs)
         return
-    else:
-        click.echo(f"We have {len(df)} letters to send!")
-
-    # Fix known errors
-    click.echo("Fixing errors")
-    df.loc[
-        df.caseworker.str.startswith("User") & df.cbo.str.startswith("Far South"),
-        "caseworker",
-    ] = render.CBOs["Far Southeast"].default_contact
-    df["caseworker"] = df.caseworker.map(
-        lambda word: "".join(letter for letter in word if not letter.isdigit()),
-        na_action="ignore",
+
+    if journal_path:
+        raise click.BadParameter(
+            "Each config keeps its journal in its own pdf directory",
+            param_hint="--journal",
+        )
+    jobs = [
+        (name, tenant_arguments(name, path, **kwargs)) for name, path in configs.items()
+    ]
+    results = tenants.run_in_processes(
+        jobs,
+        run_config,
+        log_directory or os.path.join(kwargs["pdf"], "logs"),
+        workers=workers,
+        log=click.echo,
     )
+    failed = sorted(result.name for result in results if result.exit_code)
+    if failed:
+        click.echo("Failed: {}".format(", ".join(failed)))
+        raise SystemExit(1)
 
-    # Render pdfs
-    click.echo("Rendering pdfs")
-    data = {
-        row.id: {
-            "cbo_name": row.cbo,
-            "school": row.school,
-            "guardian": row.guardian_firstname + " " + row.guardian_lastname,
-            "caseworker_name": row.caseworker,
-            "address": row.address,
-            "zipcode": row.zipcode,
-        }
-        for _, row in df.iterrows()
-        if row.is_treatment > 0
-    }
 
-    render.render_templates(data, output_directory=tex, pdf_output_directory=pdf)
+def tenant_arguments(
+    name,
+    config_path,
+    tex,
+    pdf,
+    query_metrics_path,
+    profile_path,
+    stage_directory,
+    metrics_path,
+    **kwargs,
+):
+    """
+    The arguments to `run_config` for the tenant `name` when running several at
+    once: each gets its own subdirectory of the tex, pdf and stages directories,
+    and its own query metrics and profile.
+    """
 
-    # Ship things to click2mail
-    click.echo("Shipping things to click2mail")
-    client = click2mail.Click2MailClient(is_production=True)
-    client.login(config["click2mail"]["username"], config["click2mail"]["password"])
-    client._post("account", "authorize")
-
-    client.set_return_address(
-        "Don Braman",
-        "Office of the City Administrator",
-        "1350 Pennsylvania Avenue NW Suite 533",
-        "Washington",
-        "DC",
-        "20004",
+    def tenant_file(path):
+        stem, extension = os.path.splitext(path)
+        return f"{stem}-{name}{extension}"
+
+    return dict(
+        kwargs,
+        config_path=config_path,
+        tex=os.path.join(tex, name),
+        pdf=os.path.join(pdf, name),
+        query_metrics_path=query_metrics_path and tenant_file(query_metrics_path),
+        profile_path=profile_path and tenant_file(profile_path),
+        stage_directory=stage_directory and os.path.join(stage_directory, name),
+        metrics_path=metrics_path and tenant_file(metrics_path),
     )
 
-    submitter = Submitter(client, data, pdf_directory=pdf)
 
-    curs = conn.cursor()
-    num_success = num_error = 0
-    for i in range(len(submitter)):
-        click.echo(f"On {i+1} of {len(submitter)}")
-        submitter.post()
-        db.insert_job(curs, submitter.job_id, submitter.key)
-        time.sleep(1)
-        try:
-            submitter.submit()
-            success = True
-        except Exception:
-            success = False
-        db.insert_status(curs, submitter.key, "Success" if success else "Error")
-        num_success += 1 if success else 0
-        num_error += 1 if not success else 0
-        submitter.advance()
-        conn.commit()
-        time.sleep(1)
+def cprofile_directory(profile_path):
+    """
+    Where to save the cProfile stats of a run profiled to `profile_path`: next to
+    the report, in a directory named after it (so that tenants, whose reports are
+    named apart, don't overwrite each other's stats).
+    """
+    if not profile_path:
+        return None
+    return os.path.splitext(profile_path)[0] + "-cprofile"
 
-    curs.close()
 
-    click.echo(
-        "Done submitting to click2mail; {} submitted and {} errors".format(
-            num_success, num_error
+def run_config(
+    config_path,
+    tex,
+    pdf,
+    journal_path=None,
+    durability=None,
+    query_metrics_path=None,
+    profile_path=None,
+    cprofile=False,
+    simulate=None,
+    start=None,
+    end=None,
+    stage_directory=None,
+    metrics_path=None,
+):
+    """
+    Run the program configured in `config_path`. The arguments are the options of
+    `susocli run`.
+    """
+    from suso import metrics
+
+    config = load_config(config_path)
+    tenant = tenants.tenant_name(config_path)
+    if simulate is not None:
+        simulate_run(
+            config, simulate, durability, profile_path, cprofile, metrics_path, tenant
         )
+        return
+
+    deadline = deadline_from_config(config)
+    run_metrics = metrics.RunMetrics(tenant)
+    query_metrics = db.QueryMetrics()
+    profiler = profiling.Profiler(
+        enabled=bool(profile_path),
+        cprofile=cprofile,
+        cprofile_directory=cprofile_directory(profile_path),
     )
+    try:
+        with db.ConnectionPool(config["db"], size=1) as pool:
+            with pool.session(durability, query_metrics) as session:
+                run(
+                    config,
+                    session,
+                    tex,
+                    pdf,
+                    journal_path,
+                    profiler=profiler,
+                    start=start,
+                    end=end,
+                    stage_directory=stage_directory,
+                    run_metrics=run_metrics,
+                    deadline=deadline,
+                )
+        run_metrics.success = True
+    except stages.MissingStageOutput as e:
+        raise click.ClickException(str(e))
+    finally:
+        run_metrics.write(
+            metrics_path or os.path.join(pdf, "metrics.prom"), profiler, query_metrics
+        )
+        query_metrics_path = query_metrics_path or os.path.join(
+            pdf, "query_metrics.json"
+        )
+        if os.path.isdir(os.path.dirname(query_metrics_path) or "."):
+            query_metrics.dump(query_metrics_path)
+        if profiler.enabled:
+            profiler.write(profile_path)
+            click.echo(profiler.summary())
 
-    curs = conn.cursor()
-    success_email(
-        config["mailchimp"]["username"],
-        config["mailchimp"]["key"],
-        curs,
-        num_success,
-        num_error,
+
+def simulate_run(
+    config,
+    num_participants,
+    durability,
+    profile_path,
+    cprofile,
+    metrics_path=None,
+    tenant=None,
+):
+    """
+    Run against the fakes in `suso.simulation` and print the throughput report.
+    """
+    from suso import metrics, simulation
+
+    run_metrics = metrics.RunMetrics(tenant)
+    query_metrics = db.QueryMetrics()
+    profiler = profiling.Profiler(
+        enabled=bool(profile_path),
+        cprofile=cprofile,
+        cprofile_directory=cprofile_directory(profile_path),
     )
-    curs.close()
-    conn.close()
+    with simulation.Simulation(config, num_participants) as sim:
+        click.echo(f"Simulating {num_participants} participants in {sim.directory}")
+        conn = db.get_connection(sim.config["db"])
+        create_database(conn)
+        conn.close()
+
+        with db.ConnectionPool(sim.config["db"], size=1) as pool:
+            with pool.session(durability, query_metrics) as session:
+                run(
+                    sim.config,
+                    session,
+                    sim.tex,
+                    sim.pdf,
+                    None,
+                    profiler=profiler,
+                    api=sim.eto,
+                    client=sim.click2mail,
+                    mailer=sim.mailchimp,
+                    renderer=sim.renderer,
+                    run_metrics=run_metrics,
+                    deadline=deadline_from_config(config),
+                )
+        run_metrics.success = True
+
+        profiler.write(profile_path)
+        if metrics_path:
+            run_metrics.write(metrics_path, profiler, query_metrics)
+        click.echo(sim.report(profiler, query_metrics))
+
+
+@cli.command("serve")
+@click.argument("config")
+@click.option("--tex", "-t", default="./tex", help="Where to store generated tex files")
+@click.option("--pdf", "-p", default="./pdf", help="Where to store generated pdf files")
+@click.option(
+    "--journal",
+    "-j",
+    "journal_path",
+    default=None,
+    help="Where to keep the submission journal. Defaults to PDF/submissions.journal",
+)
+@click.option(
+    "--durability",
+    type=click.Choice(db.DURABILITY_MODES),
+    default=None,
+    help="Commit once per stage or after every letter. Defaults to `durability` "
+    "in the db config, else letter",
+)
+@click.option(
+    "--metrics",
+    "metrics_path",
+    default=None,
+    help="Where to write Prometheus metrics about each run, e.g., for node_exporter's "
+    "textfile collector. Defaults to PDF/metrics.prom",
+)
+@click.option("--run-now", is_flag=True, help="Also run once immediately on startup")
+def serve_command(config, tex, pdf, journal_path, durability, metrics_path, run_now):
+    """
+    Stay running and `run` on the schedule in the `serve` section of the config.
+    The database pool, ETO session and Click2Mail connections are kept between
+    runs, runs never overlap, and SIGTERM stops the server after the current run.
+    """
+    from suso import click2mail, eto, metrics
+
+    tenant = tenants.tenant_name(config)
+    config = load_config(config)
+
+    schedules = (config.get("serve") or {}).get("schedule")
+    if not schedules:
+        raise click.ClickException("No schedule in the `serve` section of the config")
+    if isinstance(schedules, str):
+        schedules = [schedules]
+
+    api = eto.ApiHandler()
+    client = click2mail.Click2MailClient(
+        is_production=True,
+        document_index=click2mail.DocumentIndex(os.path.join(pdf, "documents.json")),
+    )
+
+    with db.ConnectionPool(config["db"], size=1) as pool:
+
+        def tick():
+            run_metrics = metrics.RunMetrics(tenant)
+            query_metrics = db.QueryMetrics()
+            profiler = profiling.Profiler(enabled=False)
+            try:
+                with pool.session(durability, query_metrics) as session:
+                    run(
+                        config,
+                        session,
+                        tex,
+                        pdf,
+                        journal_path,
+                        profiler=profiler,
+                        api=api,
+                        client=client,
+                        run_metrics=run_metrics,
+                        deadline=deadline_from_config(config),
+                    )
+                run_metrics.success = True
+            finally:
+                run_metrics.write(
+                    metrics_path or os.path.join(pdf, "metrics.prom"),
+                    profiler,
+                    query_metrics,
+                )
+                if os.path.isdir(pdf):
+                    query_metrics.dump(os.path.join(pdf, "query_metrics.json"))
+
+        server = scheduler.Scheduler(schedules, tick, log=click.echo)
+        server.install_signal_handlers()
+        if run_now:
+            server.run_once()
+        server.run_forever()
+
+    client.close()
+
+
+def run(
+    config,
+    session,
+    tex,
+    pdf,
+    journal_path,
+    profiler=None,
+    api=None,
+    client=None,
+    mailer=None,
+    renderer=None,
+    start=None,
+    end=None,
+    stage_directory=None,
+    run_metrics=None,
+    deadline=None,
+):
+    """
+    Pull new participants from ETO, randomize them, and mail letters to the
+    treatment group. See `suso.stages` for the stages of a run.
+
+    Args:
+      config (dict): The parsed config
+      session (db.Session): The database session to work in
+      tex (str): Where to store generated tex files
+      pdf (str): Where to store generated pdf files
+      journal_path (str|None): Where to keep the submission journal
+      profiler (profiling.Profiler|None): Where to record the timing of each stage
+      api (eto.ApiHandler|None): If passed, reuse this ETO handler (and its HTTP
+        session and cached sites) rather than making a new one
+      client (click2mail.Click2MailClient|None): If passed, reuse this client
+        (and its connections) rather than making a new one. It is not closed.
+      mailer (mailchimp3.MailChimp|None): If passed, send the summary email with
+        this client rather than one made from the config
+      renderer (callable|None): If passed, use this in place of
+        `render.render_templates`
+      start (str|None): The first stage to run. Defaults to the first stage.
+      end (str|None): The last stage to run. Defaults to the last stage.
+      stage_directory (str|None): Where to keep the outputs of each stage.
+        Defaults to PDF/stages
+      run_metrics (metrics.RunMetrics|None): Where to record the letters sent,
+        HTTP requests, etc., for the metrics file
+      deadline (deadline.Deadline|None): When the run must be done by. Letters
+        not submitted by then are left for the next run.
+
+    Raises:
+      click.ClickException: If the database has migrations still to apply
+    """
+    # The statements of a run assume the latest schema; e.g., inserting students
+    # needs the enrollment count tables
+    with session.transaction() as curs:
+        pending = migrations.pending_migrations(curs)
+    if pending:
+        raise click.ClickException(
+            "The database is missing migrations {}; run `susocli migrate` first".format(
+                ", ".join(str(migration.version) for migration in pending)
+            )
+        )
+
+    pipeline = Pipeline(
+        config,
+        session,
+        tex,
+        pdf,
+        journal_path,
+        profiler=profiler,
+        api=api,
+        client=client,
+        mailer=mailer,
+        renderer=renderer,
+        stage_directory=stage_directory,
+        run_metrics=run_metrics,
+        deadline=deadline,
+    )
+    pipeline.run(start, end)
+
+
+class Pipeline:
+    """
+    The stages of a run. Each stage is a method named after it which returns its
+    output, which `run` saves before moving on to the next stage. The arguments
+    are as for `run`.
+    """
+
+    def __init__(
+        self,
+        config,
+        session,
+        tex,
+        pdf,
+        journal_path,
+        profiler=None,
+        api=None,
+        client=None,
+        mailer=None,
+        renderer=None,
+        stage_directory=None,
+        run_metrics=None,
+        deadline=None,
+    ):
+        from suso import metrics
+
+        self.config = config
+        self.session = session
+        self.tex = tex
+        self.pdf = pdf
+        self.journal_path = journal_path or os.path.join(pdf, "submissions.journal")
+        self.profiler = profiler or profiling.Profiler(enabled=False)
+        self.api = api
+        self.client = client
+        self.mailer = mailer
+        self.renderer = renderer
+        self.run_metrics = run_metrics or metrics.RunMetrics()
+        self.deadline = deadline or Deadline()
+        self.session.deadline = self.deadline
+        self.outputs = stages.StageOutputs(
+            stage_directory or os.path.join(pdf, "stages")
+        )
+
+    def run(self, start=None, end=None):
+        """
+        Run the stages from `start` through `end`, saving the output of each.
+
+        Raises:
+          stages.MissingStageOutput: If a stage needs the output of one before
+            `start` which hasn't been run
+        """
+        to_run = stages.stages_between(start, end)
+        # Outputs left by an earlier run of these stages are stale now
+        self.outputs.clear(to_run)
+        for stage in to_run:
+            click.echo(f"Starting the {stage} stage")
+            self.outputs.save(stage, getattr(self, stage)())
+
+    def ingest(self):
+        """Pull new participants from ETO and store them"""
+        from suso import eto, participants
+
+        with self.profiler.stage("eto") as stage:
+            # From what date should we pull new data from ETO?
+            latest_enrollment = self.session.query(db.LATEST_ENROLLMENT_QUERY)[0][0]
+            start_date = max(latest_enrollment, "2018-01-04")  # Deal with start date
+
+            # Back the date up a couple days in case something happened to time zones or automation
+            start_date = (
+                datetime.strptime(start_date, "%Y-%m-%d") - timedelta(days=2)
+            ).strftime("%Y-%m-%d")
+
+            # Setup ETO handler
+            self.api = self.api or eto.ApiHandler()
+            self.api.http_metrics = self.run_metrics.http
+            self.api.deadline = self.deadline
+            self.api.login(
+                self.config["eto"]["username"], self.config["eto"]["password"]
+            )
+
+            # Pull data from ETO
+            click.echo("Pulling data from ETO")
+            end_date = datetime.now().strftime("%Y-%m-%d")
+            potential_participants = self.api.get_all_participants(start_date, end_date)
+            potential_participants[
+                "referral_date"
+            ] = potential_participants.ProgramStartDate.apply(eto.convert_date)
+            stage.count("participants", len(potential_participants))
+
+        with self.profiler.stage("db_insert") as stage:
+            # Keep the latest referral for each participant. Which of them are new
+            # is decided by the database when we insert them. Participants missing
+            # data are stored but marked as bad records.
+            click.echo("Committing participants to db")
+            rows = participants.student_rows(
+                participants.latest_referrals(potential_participants)
+            )
+            with self.session.transaction() as curs:
+                num_new = db.insert_new_students(curs, rows)
+            click.echo(f"Found {num_new} new participants")
+            stage.count("rows", len(rows))
+            stage.count("new_students", num_new)
+
+        return {"participants": len(potential_participants), "new_students": num_new}
+
+    def randomize(self):
+        """Assign the students who haven't been randomized yet"""
+        import pandas as pd
+
+        with self.profiler.stage("randomize") as stage:
+            # Pull standardized participant data from db
+            click.echo("Getting standardized participant list")
+            df = pd.DataFrame.from_records(
+                self.session.query(db.UNRANDOMIZED_STUDENTS_QUERY),
+                columns=db.LETTER_COLUMNS,
+            )
+
+            # Randomize students. Assignments depend only on the student's id, so
+            # overlapping runs agree and whichever records a student first wins.
+            if len(df) != 0:
+                click.echo("Randomizing")
+                df["is_treatment"] = randomizer.from_config(self.config).assign(df.id)
+
+                # Record randomizations
+                with self.session.transaction() as curs:
+                    db.insert_new_randomizers(
+                        curs, zip(df.id, df.is_treatment.astype(int))
+                    )
+            else:
+                click.echo("Nothing to randomize. Perhaps there are things to send?")
+            stage.count("students", len(df))
+
+        return {
+            "randomized": len(df),
+            "treated": int(df.is_treatment.sum()) if len(df) else 0,
+        }
+
+    def render(self):
+        """Render the letters of the treatment students who haven't been sent one"""
+        import pandas as pd
+
+        from suso import participants, render
+
+        with self.profiler.stage("render") as stage:
+            # Get unsubmitted treatment students from database
+            df = pd.DataFrame.from_records(
+                self.session.query(db.UNSENT_TREATMENT_STUDENTS_QUERY),
+                columns=db.LETTER_COLUMNS,
+            )
+            stage.count("letters", len(df))
+
+            if len(df) == 0:
+                click.echo("Nothing to send")
+                return {"letters": letters.to_table([])}
+
+            click.echo(f"We have {len(df)} letters to send!")
+
+            # Fix known errors
+            click.echo("Fixing errors")
+            df["caseworker"] = participants.fix_caseworkers(df)
+
+            # Render pdfs
+            click.echo("Rendering pdfs")
+            records = participants.letter_records(df)
+
+            # Letters whose documents were uploaded by a previous run don't need
+            # rendering
+            submission_journal = journal.SubmissionJournal(self.journal_path)
+            to_render = [
+                letter
+                for letter in records
+                if not submission_journal.has(
+                    letter.student_id, journal.DOCUMENT_UPLOADED
+                )
+            ]
+            submission_journal.close()
+
+            # A letter pdflatex chokes on, or doesn't get to before the deadline,
+            # is left for the next run rather than holding up the rest
+            (self.renderer or render.render_templates)(
+                to_render,
+                output_directory=self.tex,
+                pdf_output_directory=self.pdf,
+                skip_failures=True,
+                deadline=self.deadline,
+            )
+            num_failures = num_deferred = 0
+            for letter in to_render:
+                if letter.render_error:
+                    click.echo(letter.render_error)
+                    num_failures += 1
+                num_deferred += letter.deferred
+            if num_deferred:
+                click.echo(f"Out of time; leaving {num_deferred} letters unrendered")
+            self.run_metrics.render_failures = num_failures
+            stage.count("rendered", len(to_render) - num_failures - num_deferred)
+            stage.count("failures", num_failures)
+            stage.count("deferred", num_deferred)
+
+        return {"letters": letters.to_table(records)}
+
+    def submit(self):
+        """Upload and submit the rendered letters to Click2Mail"""
+        from suso import click2mail
+
+        records = letters.from_table(self.outputs.load(stages.RENDER)["letters"])
+        num_deferred = sum(letter.deferred for letter in records)
+        records = [
+            letter for letter in records if not (letter.render_error or letter.deferred)
+        ]
+        if records and self.deadline.expired:
+            click.echo(f"Out of time; leaving {len(records)} letters for the next run")
+            num_deferred += len(records)
+            records = []
+        if records:
+            # If this stage is being rerun, some of the letters may have been sent
+            # (and committed) already
+            unsent = {
+                row[0] for row in self.session.query(db.UNSENT_TREATMENT_STUDENTS_QUERY)
+            }
+            records = [letter for letter in records if letter.student_id in unsent]
+        self.run_metrics.letters_deferred = num_deferred
+        if not records:
+            click.echo("Nothing to submit")
+            return {"letters": 0, "submitted": 0, "errors": 0, "deferred": num_deferred}
+
+        num_success = num_error = 0
+        submission_journal = journal.SubmissionJournal(self.journal_path)
+
+        # The whole submission stage is one transaction unless every letter must
+        # be committed as it goes. If we die partway through, the journal remembers
+        # what Click2Mail has already done, so the next run records it without
+        # resending.
+        with self.session.transaction() as curs:
+            with self.profiler.stage("upload") as stage:
+                # Ship things to click2mail
+                click.echo("Shipping things to click2mail")
+                owns_client = self.client is None
+                client = self.client or click2mail.Click2MailClient(
+                    is_production=True,
+                    document_index=click2mail.DocumentIndex(
+                        os.path.join(self.pdf, "documents.json")
+                    ),
+                )
+                client.http_metrics = self.run_metrics.http
+                client.deadline = self.deadline
+                client.login(
+                    self.config["click2mail"]["username"],
+                    self.config["click2mail"]["password"],
+                )
+                client._post("account", "authorize")
+
+                client.set_return_address(
+                    "Don Braman",
+                    "Office of the City Administrator",
+                    "1350 Pennsylvania Avenue NW Suite 533",
+                    "Washington",
+                    "DC",
+                    "20004",
+                )
+
+                submitter = Submitter(
+                    client,
+                    records,
+                    pdf_directory=self.pdf,
+                    submission_journal=submission_journal,
+                    deadline=self.deadline,
+                )
+
+                # Rather than hoping Click2Mail has processed each address list by
+                # the time we create its job, upload everything first and wait on
+                # all the lists together
+                click.echo("Uploading documents and address lists")
+                rejected = submitter.prepare_all()
+                for key, reason in rejected.items():
+                    click.echo(f"Click2Mail rejected the address for {key}: {reason}")
+                    db.insert_status(curs, key, "Error")
+                    num_error += 1
+                self.session.checkpoint()
+                stage.count("letters", len(submitter))
+                stage.count("rejected", len(rejected))
+
+            with self.profiler.stage("submit") as stage:
+                while submitter.i < len(submitter):
+                    # Whatever the journal says the letter got through is kept
+                    if self.deadline.expired:
+                        submitter.defer_rest()
+                        break
+                    click.echo(f"On {submitter.i+1} of {len(submitter)}")
+                    try:
+                        submitter.post()
+                    except DeadlineExceeded:
+                        submitter.defer_rest()
+                        break
+                    if not db.job_exists(curs, submitter.job_id):
+                        db.insert_job(curs, submitter.job_id, submitter.key)
+                    try:
+                        submitter.submit()
+                        success = True
+                    except DeadlineExceeded:
+                        submitter.defer_rest()
+                        break
+                    except SubmissionUncertain as exc:
+                        # The next run asks Click2Mail again before submitting
+                        click.echo(f"{exc}; leaving it for the next run")
+                        submitter.defer_current()
+                        self.session.checkpoint()
+                        continue
+                    except Exception:
+                        success = False
+                    db.insert_status(
+                        curs, submitter.key, "Success" if success else "Error"
+                    )
+                    num_success += 1 if success else 0
+                    num_error += 1 if not success else 0
+                    submitter.advance()
+                    self.session.checkpoint()
+                stage.count("submitted", num_success)
+                stage.count("errors", num_error)
+                stage.count("deferred", len(submitter.deferred))
+
+        # Everything submitted has been committed to the database, so the journal
+        # only needs to remember the letters that didn't make it
+        submission_journal.compact()
+        submission_journal.close()
+
+        num_deferred += len(submitter.deferred)
+        click.echo(
+            "Done submitting to click2mail; {} submitted and {} errors".format(
+                num_success, num_error
+            )
+        )
+        if submitter.deferred:
+            click.echo(
+                f"Out of time; left {len(submitter.deferred)} letters for the next run"
+            )
+        click.echo(
+            "Click2Mail connections: {connections_opened} opened, "
+            "{connections_reused} reused".format(**client.pool_stats())
+        )
+        if owns_client:
+            client.close()
+
+        self.run_metrics.letters_submitted = num_success
+        self.run_metrics.letter_errors = num_error
+        self.run_metrics.letters_deferred = num_deferred
+        return {
+            "letters": len(records),
+            "submitted": num_success,
+            "errors": num_error,
+            "deferred": num_deferred,
+        }
+
+    def notify(self):
+        """Send the summary email"""
+        output = self.outputs.load(stages.SUBMIT)
+        with self.profiler.stage("notify"):
+            with self.session.transaction() as curs:
+                num_deferred = output.get("deferred", 0)
+                if output["letters"] == 0 and not num_deferred:
+                    stop_email(
+                        self.config["mailchimp"]["username"],
+                        self.config["mailchimp"]["key"],
+                        curs,
+                        mailer=self.mailer,
+                    )
+                else:
+                    success_email(
+                        self.config["mailchimp"]["username"],
+                        self.config["mailchimp"]["key"],
+                        curs,
+                        output["submitted"],
+                        output["errors"],
+                        query_metrics=self.session.metrics,
+                        mailer=self.mailer,
+                        num_deferred=num_deferred,
+                    )
+                self.run_metrics.table_rows = db.table_row_counts(curs)
+        return {"sent": True}
 
 
 @cli.command("mailing")
 @click.argument("config")
 def mailing_status_command(config):
-    with open(config) as f:
-        yaml.load(config)
+    """Record the latest tracking status of each undelivered letter"""
+    from suso import click2mail
+
+    config = load_config(config)
     conn = db.get_connection(config["db"])
     curs = conn.cursor()
 
+    client = click2mail.Click2MailClient(is_production=True)
+    client.login(config["click2mail"]["username"], config["click2mail"]["password"])
+
     click.echo("Getting old mailings")
-    curs.execute(
-        f"""
-    SELECT j.id, s.id
-      FROM {db.STUDENTS_TABLE} s
-      JOIN {db.JOBS_TABLE} j
-        ON s.id = j.student_id
-      LEFT JOIN {db.MAILINGS_TABLE} m
-        ON j.id = m.job_id
-     WHERE NOT (m.status = 'Arrived at Recipient PO' OR 'USPS Indicated Delievered')
-  """
-    )
-    returned = curs.fetchall()
+    returned = db.undelivered_jobs(curs)
     for job_id, student_id in returned:
         status, status_time = client.get_tracking_data(job_id)
         if not status:
@@ -519,6 +1391,7 @@ def mailing_status_command(config):
         status_time = datetime.strptime(status_time[:-2], "%Y-%m-%d %H:%M:%S")
         db.insert_mailing(curs, job_id, status, status_time)
     curs.close()
+    client.close()
     conn.commit()
     conn.close()
 
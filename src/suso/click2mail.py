@@ -6,15 +6,24 @@ of the Quick Start Guide with Mail Merge::
 
 @author Kevin H. Wilson <kevin.wilson@dc.gov>
 """
+import asyncio
 import datetime
+import hashlib
+import json
 import os
+import threading
+import time
 from posixpath import join as urljoin
 from urllib.parse import urlencode
 
 import requests
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
+from suso.deadline import Deadline
+from suso.metrics import endpoint_label
+
 ADDRESS_CSV_HEADERS = (
     "First_name",
     "Last_name",
@@ -33,6 +42,35 @@ STAGING_BASE_URL = "https://stage-rest.click2mail.com/molpro"
 
 XML_PARSER = "xml"
 
+# Click2Mail's status for an address list it hasn't finished processing
+ADDRESS_LIST_PROCESSING = 3
+
+# The status of a job which hasn't been submitted yet
+JOB_EDITING = "EDITING"
+
+# HTTP statuses which mean "try again later" rather than "this is broken"
+TRANSIENT_HTTP_STATUSES = (429, 500, 502, 503, 504)
+
+# Of those, the statuses which mean the request wasn't processed at all, so that
+# even a request which can't safely be repeated can be retried
+UNPROCESSED_HTTP_STATUSES = (429, 503)
+
+# How many times to send a request answered with a transient status, and how long
+# to wait before the first retry (doubling after each) if Click2Mail doesn't say
+MAX_ATTEMPTS = 4
+RETRY_DELAY = 0.5
+
+# The number of keep-alive connections to Click2Mail the client will hold open.
+# Worker threads beyond this many wait for a connection rather than opening
+# throwaway ones.
+DEFAULT_POOL_SIZE = 10
+
+# How long to wait for Click2Mail to process an address list before giving up
+DEFAULT_ADDRESS_LIST_TIMEOUT = 300.0
+
+# How long we trust that a document we uploaded is still available on Click2Mail
+DEFAULT_DOCUMENT_MAX_AGE = datetime.timedelta(days=30)
+
 
 def _today():
     """
@@ -44,6 +82,28 @@ def _today():
     return datetime.datetime.now().strftime("%Y-%m-%d")
 
 
+def _file_digest(filename, chunk_size=1 << 16):
+    """
+    Compute the SHA-256 digest and size of a file without reading it into memory
+    all at once.
+
+    Args:
+      filename (str): The file to digest
+      chunk_size (int): How many bytes to read at a time
+
+    Returns:
+      str: The hex digest of the file
+      int: The size of the file in bytes
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
 def _convert_recipient_to_row(recipient):
     """
     Click2Mail expects addresses in a CSV formatted in a particular order.
@@ -227,34 +287,161 @@ class ReturnAddress:
         }
 
 
+class DocumentIndex:
+    """
+    A local index from the content hash of a PDF to the documentId Click2Mail
+    assigned it when it was uploaded. This lets `Click2MailClient.post_document`
+    skip uploading a file it has already uploaded, e.g., on a retry or when
+    resending a letter whose submission errored.
+
+    If `path` is None, the index is only kept in memory.
+    """
+
+    def __init__(self, path=None, max_age=DEFAULT_DOCUMENT_MAX_AGE):
+        """
+        Args:
+          path (str|None): The JSON file in which to persist the index
+          max_age (datetime.timedelta): How long after uploading a document we'll
+            still reuse it
+        """
+        self.path = path
+        self.max_age = max_age
+        self._entries = {}
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, digest, size):
+        """
+        Find the id of a previously uploaded document with the given digest.
+        Entries whose size doesn't match or which are older than `max_age` are
+        treated as missing.
+
+        Args:
+          digest (str): The SHA-256 hex digest of the document
+          size (int): The size of the document in bytes
+
+        Returns:
+          int|None: The documentId, if there is a valid one
+        """
+        entry = self._entries.get(digest)
+        if not entry or entry["size"] != size:
+            return None
+
+        uploaded_at = datetime.datetime.strptime(
+            entry["uploaded_at"], "%Y-%m-%d %H:%M:%S"
+        )
+        if datetime.datetime.now() - uploaded_at > self.max_age:
+            return None
+
+        return entry["document_id"]
+
+    def add(self, digest, size, document_id):
+        """
+        Record that the document with the given digest was uploaded as `document_id`.
+        """
+        self._entries[digest] = {
+            "size": size,
+            "document_id": document_id,
+            "uploaded_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self.save()
+
+    def discard(self, digest):
+        """Forget the document with the given digest, e.g., if Click2Mail has lost it"""
+        if self._entries.pop(digest, None):
+            self.save()
+
+    def save(self):
+        """Atomically write the index to `path`, if it has one"""
+        if not self.path:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+
+
+def _retry_delay(response, default):
+    """
+    How long `response` asks us to wait before trying again: its Retry-After
+    header, if that's a number of seconds, else `default`
+    """
+    try:
+        return max(float(response.headers.get("Retry-After")), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
 class Click2MailClient:
     """
     Interact with Click2Mail via their API. The general flow, after creating this class,
     is to:
       * login
-      * create_job
+      * post_document
       * post_recipients
-      * (TODO) poll_recipients
-      * update_job
+      * wait_for_address_lists
+      * create_job
       * submit_job
     """
 
-    def __init__(self, is_production=False):
+    def __init__(
+        self,
+        is_production=False,
+        document_index=None,
+        base_url=None,
+        pool_size=DEFAULT_POOL_SIZE,
+    ):
         """
         Create the client indicating whether or not this is production.
 
         Args:
           is_production (bool): Is this production?
+          base_url (str|None): If passed, talk to this URL instead of Click2Mail's
+            production or staging API, e.g., to point at a `suso.fakes.click2mail`
+            server
+          pool_size (int): The maximum number of connections to keep open to
+            Click2Mail across all threads using this client
+          document_index (DocumentIndex|None): If passed, documents which have
+            already been uploaded will be reused rather than uploaded again
         """
         self._client = None
         self._username = None
         self._password = None
-        self._session = None
+
+        # requests.Session isn't thread-safe, so each thread gets its own, but they
+        # all share one (thread-safe) adapter and hence one connection pool
+        self._adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True
+        )
+        self._local = threading.local()
+
+        self.document_index = document_index
+
+        # A running estimate of how long Click2Mail takes to process an address
+        # list, used to decide when to first check on a new one
+        self._address_list_seconds = None
 
         self.return_address = ReturnAddress()
 
+        # If set to a metrics.HttpMetrics, every request is recorded in it
+        self.http_metrics = None
+        # Every request times out by this deadline (and after DEFAULT_TIMEOUT)
+        self.deadline = Deadline()
+
         self.is_production = is_production
-        self._base_url = PROD_BASE_URL if is_production else STAGING_BASE_URL
+        self._base_url = base_url or (
+            PROD_BASE_URL if is_production else STAGING_BASE_URL
+        )
 
     def login(self, username, secret_key):
         """
@@ -282,9 +469,94 @@ class Click2MailClient:
 
     @property
     def session(self):
-        if not self._session:
-            self._session = requests.session()
-        return self._session
+        """
+        The calling thread's HTTP session. Sessions are per-thread but share this
+        client's keep-alive connection pool.
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.session()
+            session.mount("http://", self._adapter)
+            session.mount("https://", self._adapter)
+            self._local.session = session
+        return session
+
+    def pool_stats(self):
+        """
+        Statistics about the connection pool shared by this client's sessions.
+
+        Returns:
+          dict[str, int]: The number of requests made, the number of connections
+            opened to make them, and the number of requests which reused an
+            already open connection
+        """
+        num_requests = num_connections = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        return {
+            "requests": num_requests,
+            "connections_opened": num_connections,
+            "connections_reused": num_requests - num_connections,
+        }
+
+    def close(self):
+        """Close all the connections held open by this client"""
+        self._adapter.close()
+
+    def _request(
+        self,
+        method,
+        *args,
+        query=None,
+        retry_statuses=TRANSIENT_HTTP_STATUSES,
+        **kwargs,
+    ):
+        """
+        Make an HTTP request to join(self.base_url, *args), with auth, timing out
+        by `self.deadline` unless a `timeout` is passed. A response with one of
+        `retry_statuses` is retried up to MAX_ATTEMPTS times in all, waiting as
+        long as its Retry-After header asks, so long as that fits in the deadline.
+
+        Raises:
+          DeadlineExceeded: If the run's deadline passed before or during the
+            request
+        """
+        url = urljoin(self.base_url, *map(str, args))
+        if query:
+            url += "?" + urlencode(query)
+        timeout = kwargs.pop("timeout", None)
+
+        for attempt in range(MAX_ATTEMPTS):
+            kwargs["timeout"] = self.deadline.timeout() if timeout is None else timeout
+
+            def send():
+                try:
+                    return self.session.request(method, url, auth=self.auth, **kwargs)
+                except requests.Timeout:
+                    self.deadline.check()
+                    raise
+
+            if self.http_metrics is None:
+                response = send()
+            else:
+                response = self.http_metrics.timed(
+                    "click2mail", method, endpoint_label(*args), send
+                )
+
+            if response.status_code not in retry_statuses:
+                return response
+            delay = _retry_delay(response, RETRY_DELAY * 2**attempt)
+            remaining = self.deadline.remaining()
+            if attempt + 1 == MAX_ATTEMPTS or (
+                remaining is not None and delay >= remaining
+            ):
+                return response
+            time.sleep(delay)
 
     def _post(self, *args, query=None, **kwargs):
         """
@@ -299,10 +571,7 @@ class Click2MailClient:
         Returns:
           requests.Response: The response from the POST.
         """
-        url = urljoin(self.base_url, *map(str, args))
-        if query:
-            url += "?" + urlencode(query)
-        return self.session.post(url, auth=self.auth, **kwargs)
+        return self._request("post", *args, query=query, **kwargs)
 
     def _get(self, *args, query=None, **kwargs):
         """
@@ -317,10 +586,7 @@ class Click2MailClient:
         Returns:
           requests.Response: The response from the GET.
         """
-        url = urljoin(self.base_url, *map(str, args))
-        if query:
-            url += "?" + urlencode(query)
-        return self.session.get(url, auth=self.auth, **kwargs)
+        return self._request("get", *args, query=query, **kwargs)
 
     def post_document(
         self,
@@ -329,6 +595,29 @@ class Click2MailClient:
         document_class="Letter 8.5 x 11",
         document_format="PDF",
     ):
+        """
+        Upload a document to Click2Mail. If this client has a `document_index` and
+        an identical file has already been uploaded (and Click2Mail still has it),
+        the existing document is reused instead.
+
+        Args:
+          document_pdf (str): The path to the document
+          document_name (str|None): The name of the document on Click2Mail. By
+            default, SUSO {today} {filename}
+          document_class (str): The Click2Mail document class
+          document_format (str): The format of the document
+
+        Returns:
+          int: The id of the document
+        """
+        if self.document_index is not None:
+            digest, size = _file_digest(document_pdf)
+            document_id = self.document_index.lookup(digest, size)
+            if document_id is not None:
+                if self.document_exists(document_id):
+                    return document_id
+                self.document_index.discard(digest)
+
         if not document_name:
             name = os.path.basename(document_pdf.rsplit(".", 1)[0])
             document_name = "SUSO {date} {name}".format(date=_today(), name=name)
@@ -338,15 +627,40 @@ class Click2MailClient:
             "documentClass": document_class,
             "documentFormat": document_format,
         }
-        pdf_name = os.path.basename(document_pdf)
+        # Read the file up front so that a retry sends all of it again
         with open(document_pdf, "rb") as f:
-            response = self._post("documents", data=data, files={"file": f})
+            content = f.read()
+        response = self._post(
+            "documents",
+            data=data,
+            files={"file": (os.path.basename(document_pdf), content)},
+        )
         _raise_errors(response, "uploading the document")
 
         soup = BeautifulSoup(response.content, XML_PARSER)
         document_id = int(soup.find("id").text)
+
+        if self.document_index is not None:
+            self.document_index.add(digest, size, document_id)
         return document_id
 
+    def document_exists(self, document_id):
+        """
+        Check whether Click2Mail still has the document `document_id`.
+
+        Args:
+          document_id (int): The id of the document
+
+        Returns:
+          bool: Whether the document can be used to create jobs
+        """
+        response = self._get("documents", document_id)
+        if not response.ok:
+            return False
+        soup = BeautifulSoup(response.content, XML_PARSER)
+        status = soup.find("status")
+        return status is None or not int(status.text)
+
     def create_job_from_template(self, template_name):
         """
         Create a new job from a template name.
@@ -431,13 +745,172 @@ class Click2MailClient:
         headers = requests.utils.default_headers()
         headers["Content-Type"] = "application/xml"
 
-        # TODO (kevin): Apparently need to poll to understand if there are address errors
+        # Click2Mail processes address lists asynchronously, so the list may not be
+        # usable yet (status 3). Use `wait_for_address_lists` before creating a job.
         # See https://developers.click2mail.com/rest-api/molpro/docs/reference#addressLists
         # for more info
         response = self._post("addressLists", headers=headers, data=address_list)
-        _raise_errors(response, extra_text="posting addresses", allowed_status=(3,))
+        _raise_errors(
+            response,
+            extra_text="posting addresses",
+            allowed_status=(ADDRESS_LIST_PROCESSING,),
+        )
         return _get_id_from_response(response)
 
+    def get_address_list_status(self, address_list_id):
+        """
+        Ask Click2Mail how processing the address list is going.
+
+        Args:
+          address_list_id (int): The id of the address list
+
+        Returns:
+          int|None: The Click2Mail status of the list (0 when it's ready,
+            ADDRESS_LIST_PROCESSING while it's processing), or None if Click2Mail
+            asked us to come back later
+          str|None: The description of the status
+        """
+        response = self._get("addressLists", address_list_id)
+        if response.status_code in TRANSIENT_HTTP_STATUSES:
+            return None, None
+        if not response.ok:
+            raise ValueError(
+                "Something went wrong checking address list {}: {}".format(
+                    address_list_id, response.content
+                )
+            )
+        return _get_return_status(response)
+
+    async def _poll_address_list(
+        self, address_list_id, initial_interval, max_interval, backoff, timeout
+    ):
+        """
+        Poll a single address list until Click2Mail is done processing it, backing
+        off exponentially between checks.
+
+        Returns:
+          int: The id of the address list
+          int: The final Click2Mail status of the list
+          str: The description of the status
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        # Don't bother checking before a typical list would be done
+        interval = initial_interval
+        if self._address_list_seconds:
+            interval = min(max(interval, self._address_list_seconds), max_interval)
+
+        while True:
+            await asyncio.sleep(interval)
+            status, description = await loop.run_in_executor(
+                None, self.get_address_list_status, address_list_id
+            )
+            if status is not None and status != ADDRESS_LIST_PROCESSING:
+                break
+            if loop.time() - started > timeout:
+                raise asyncio.TimeoutError(
+                    f"Address list {address_list_id} still processing after {timeout}s"
+                )
+            interval = min(interval * backoff, max_interval)
+
+        elapsed = loop.time() - started
+        self._address_list_seconds = (
+            elapsed
+            if self._address_list_seconds is None
+            else 0.8 * self._address_list_seconds + 0.2 * elapsed
+        )
+        return address_list_id, status, description
+
+    async def iter_ready_address_lists(
+        self,
+        address_list_ids,
+        initial_interval=0.25,
+        max_interval=5.0,
+        backoff=1.5,
+        timeout=DEFAULT_ADDRESS_LIST_TIMEOUT,
+        return_exceptions=False,
+    ):
+        """
+        Wait on many address lists at once, yielding each one as soon as Click2Mail
+        has finished processing it. Each list is polled independently, starting
+        at `initial_interval` (or the typical processing time seen so far) and
+        backing off by a factor of `backoff` up to `max_interval` seconds.
+
+        Usage::
+
+          async for address_list_id, status, description in (
+              client.iter_ready_address_lists(ids)
+          ):
+              ...
+
+        Args:
+          address_list_ids (iterable[int]): The address lists to wait on
+          initial_interval (float): Seconds before first checking a list
+          max_interval (float): The longest we'll wait between checks of a list
+          backoff (float): The factor by which to increase the wait between checks
+          timeout (float): Give up on a list after this many seconds
+          return_exceptions (bool): If True, a list which can't be waited on is
+            yielded with a status of None and the exception as its description,
+            rather than the exception stopping the wait on every list
+
+        Yields:
+          int: The id of the address list
+          int|None: Its final status; 0 means the list is ready to be used in a job
+          str|Exception: The description of the status
+
+        Raises:
+          asyncio.TimeoutError: If a list is still processing after `timeout`
+          ValueError: If Click2Mail says something unexpected about a list
+        """
+
+        async def poll(address_list_id):
+            try:
+                return await self._poll_address_list(
+                    address_list_id, initial_interval, max_interval, backoff, timeout
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                if not return_exceptions:
+                    raise
+                return address_list_id, None, exc
+
+        tasks = [
+            asyncio.ensure_future(poll(address_list_id))
+            for address_list_id in address_list_ids
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def wait_for_address_lists(self, address_list_ids, **kwargs):
+        """
+        Block until Click2Mail has finished processing all the passed address lists.
+        This is a synchronous wrapper around `iter_ready_address_lists`, which see
+        for the keyword arguments.
+
+        Args:
+          address_list_ids (iterable[int]): The address lists to wait on
+
+        Returns:
+          dict[int, tuple[int, str]]: A map from address list id to its final status
+            and description
+        """
+
+        async def wait():
+            return {
+                address_list_id: (status, description)
+                async for address_list_id, status, description in (
+                    self.iter_ready_address_lists(address_list_ids, **kwargs)
+                )
+            }
+
+        return asyncio.run(wait())
+
     def update_job(self, job_id, address_list_id):
         """
         Set the address list of the job you created.
@@ -446,26 +919,79 @@ class Click2MailClient:
           job_id (int): The id of the job to update
           address_list_id (int): The address list for the job
         """
-        url = urljoin(self.base_url, "jobs", job_id, "update")
-        data = urlencode({"addressId": address_list_id})
-        response = requests.post(url, data=data, auth=self.auth)
+        response = self._post(
+            "jobs", job_id, "update", data={"addressId": address_list_id}
+        )
         _raise_errors(response, "updating job")
 
     def submit_job(self, job_id, billing_type="Invoice"):
         """
         Submit the job. Note that when you submit this, you will be charged.
 
+        Submitting can't safely be repeated, so it always gets the full operation
+        timeout of `self.deadline`, however little of the run is left. If it times
+        out anyway, use `job_submitted` to find out whether it went through. A
+        server error is only retried once Click2Mail confirms the job is still
+        unsubmitted.
+
         Args:
           job_id (int): The job to submit
           billing_type (str): How to bill the job. Possible values are 'User Credit' or 'Invoice'
+
+        Returns:
+          requests.Response: The response from Click2Mail
+
+        Raises:
+          ValueError: If Click2Mail did not accept the submission
         """
-        return self._post(
-            "jobs", str(job_id), "submit", data={"billingType": billing_type}
-        )
+        for _ in range(MAX_ATTEMPTS):
+            response = self._post(
+                "jobs",
+                str(job_id),
+                "submit",
+                data={"billingType": billing_type},
+                timeout=self.deadline.operation_timeout,
+                retry_statuses=UNPROCESSED_HTTP_STATUSES,
+            )
+            if response.status_code not in TRANSIENT_HTTP_STATUSES:
+                break
+            submitted = self.job_submitted(job_id)
+            if submitted:
+                return response
+            if submitted is None:
+                break
+        _raise_errors(response, "submitting job")
+        return response
+
+    def job_submitted(self, job_id):
+        """
+        Ask Click2Mail whether the job has been submitted, e.g., because the
+        response to submitting it never arrived.
+
+        Args:
+          job_id (int): The job
+
+        Returns:
+          bool|None: Whether the job has been submitted, or None if Click2Mail
+            couldn't be asked or didn't say
+        """
+        try:
+            response = self._get(
+                "jobs", str(job_id), timeout=self.deadline.operation_timeout
+            )
+        except requests.RequestException:
+            return None
+        if not response.ok:
+            return None
+        soup = BeautifulSoup(response.content, XML_PARSER)
+        job_status = soup.find("jobStatus")
+        if job_status is None:
+            return None
+        return job_status.text.strip().upper() != JOB_EDITING
 
     def get_tracking_data(self, job_id):
         response = self._get(
-            "jobs", str(job_id), "tracking", query={"trackingType", "IMB"}
+            "jobs", str(job_id), "tracking", query={"trackingType": "IMB"}
         )
         soup = BeautifulSoup(response.content, XML_PARSER)
         try:
@@ -1,6 +1,17 @@
-import copy
+"""
+Tables, queries and inserts for the SUSO database. Everything here works against
+any of the backends in `suso.backends`; the SQL which differs between them is
+asked of `backends.backend_for(curs)`.
+"""
+import json
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
 
-import pyodbc
+from suso import backends
 
 STUDENTS_TABLE = "students_new"
 RANDOMIZER_TABLE = "randomizer_new"
@@ -8,87 +19,1057 @@ STATUS_TABLE = "status_new"
 JOBS_TABLE = "jobs_new"
 MAILINGS_TABLE = "mailings_new"
 
+# Views of the most recent job for each student and the most recent mailing
+# status for each job
+LATEST_JOBS_VIEW = "latest_jobs"
+LATEST_MAILINGS_VIEW = "latest_mailings"
+
+# Counts of students by enrollment month and day, kept up to date on insert
+ENROLLMENT_BY_MONTH_TABLE = "enrollment_by_month"
+ENROLLMENT_BY_DAY_TABLE = "enrollment_by_day"
+
+# Connection-scoped temporary table used to find new students server side
+STUDENTS_STAGING_TABLE = "students_staging"
+
+
+# Keys of the `db` section of the config which configure pooling and sessions
+# rather than the connection itself
+SESSION_OPTIONS = ("pool_size", "max_idle", "durability")
+
+DEFAULT_POOL_SIZE = 4
+
+# Connections idle in the pool for longer than this many seconds are closed
+# rather than reused, since the server may well have dropped them
+DEFAULT_MAX_IDLE = 600
+
+# When a session commits: once at the end of each stage of a run, or after every
+# letter as well
+DURABILITY_STAGE = "stage"
+DURABILITY_LETTER = "letter"
+DURABILITY_MODES = (DURABILITY_STAGE, DURABILITY_LETTER)
+
+# A stage's transaction would hold its locks for as long as, e.g., the whole
+# Click2Mail loop, so by default commit after every letter
+DEFAULT_DURABILITY = DURABILITY_LETTER
+
 
 def get_connection(config):
-    config = copy.copy(config)
-    config["uid"] = config["username"]
-    config["pwd"] = config["password"]
-    del config["username"]
-    del config["password"]
-    return pyodbc.connect(**config)
+    """
+    Connect to the SUSO database.
+
+    Args:
+      config (dict): The `db` section of the config. `backend` picks the engine
+        (see `suso.backends`); the remaining keys, except SESSION_OPTIONS, are
+        passed to it.
+
+    Returns:
+      A DB-API 2.0 connection
+    """
+    backend = backends.get_backend(config)
+    config = {
+        key: value
+        for key, value in config.items()
+        if key != "backend" and key not in SESSION_OPTIONS
+    }
+    return backend.connect(config)
+
+
+class ConnectionPool:
+    """
+    A bounded pool of connections to the SUSO database. Connections are handed
+    out most recently used first and are rolled back before being returned, so
+    no transaction ever leaks from one user of the pool to the next.
+    """
+
+    def __init__(self, config, size=None, max_idle=None):
+        """
+        Args:
+          config (dict): The `db` section of the config
+          size (int|None): The most connections to have open at once. Defaults to
+            `pool_size` in the config or DEFAULT_POOL_SIZE
+          max_idle (float|None): Close connections idle for longer than this many
+            seconds. Defaults to `max_idle` in the config or DEFAULT_MAX_IDLE
+        """
+        self.config = config
+        self.size = size or config.get("pool_size", DEFAULT_POOL_SIZE)
+        self.max_idle = max_idle or config.get("max_idle", DEFAULT_MAX_IDLE)
+
+        # (connection, when it was released), most recently used last
+        self._idle = []
+        # Notified whenever a connection is released or closed
+        self._available = threading.Condition()
+        self._num_open = 0
+        self._closed = False
+
+    def acquire(self, timeout=None):
+        """
+        Check a connection out of the pool, opening one if the pool isn't full.
+
+        Args:
+          timeout (float|None): How long to wait for a connection if the pool is
+            full. Waits forever if None.
+
+        Returns:
+          A DB-API 2.0 connection
+
+        Raises:
+          TimeoutError: If no connection came free within `timeout`
+        """
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        stale = []
+        try:
+            with self._available:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("The connection pool is closed")
+                    while self._idle:
+                        conn, idle_since = self._idle.pop()
+                        if time.monotonic() - idle_since <= self.max_idle:
+                            return conn
+                        self._num_open -= 1
+                        stale.append(conn)
+                    if self._num_open < self.size:
+                        self._num_open += 1
+                        break
+
+                    # Wait for a connection to be released, or closed so that
+                    # there's room to open another
+                    remaining = None
+                    if expires_at is not None:
+                        remaining = expires_at - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError(
+                                "Timed out waiting for a database connection"
+                            )
+                    self._available.wait(remaining)
+        finally:
+            for conn in stale:
+                _close_quietly(conn)
+
+        try:
+            return get_connection(self.config)
+        except Exception:
+            with self._available:
+                self._num_open -= 1
+                self._available.notify()
+            raise
+
+    def release(self, conn):
+        """Return a connection to the pool, rolling back anything uncommitted"""
+        if self._closed:
+            self._discard(conn)
+            return
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._available:
+            self._idle.append((conn, time.monotonic()))
+            self._available.notify()
+
+    def _discard(self, conn):
+        with self._available:
+            self._num_open -= 1
+            self._available.notify()
+        _close_quietly(conn)
+
+    @contextmanager
+    def connection(self):
+        """A context manager checking a connection out of the pool"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def session(self, durability=None, metrics=None):
+        """
+        A context manager yielding a `Session` on a pooled connection.
+
+        Args:
+          durability (str|None): One of DURABILITY_MODES. Defaults to `durability`
+            in the config or DEFAULT_DURABILITY
+          metrics (QueryMetrics|None): If passed, record every statement run in
+            the session here
+        """
+        durability = durability or self.config.get("durability", DEFAULT_DURABILITY)
+        with self.connection() as conn:
+            yield Session(conn, durability, metrics)
+
+    def close(self):
+        """Close every idle connection. Connections in use are closed on release."""
+        with self._available:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._num_open -= len(idle)
+            self._available.notify_all()
+        for conn, _ in idle:
+            _close_quietly(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class Session:
+    """
+    A connection and the policy for when to commit on it. Work is done inside
+    `transaction()` blocks, each of which commits when it exits cleanly and rolls
+    back otherwise. Long loops (e.g., submitting letters) call `checkpoint()` after
+    each item, which commits in the default DURABILITY_LETTER mode. In the
+    DURABILITY_STAGE mode, the loop's work is committed once at the end of its
+    stage instead. That flushes the log far less often, but holds the loop's locks
+    (and blocks other runs) until the stage is done.
+    """
+
+    def __init__(self, conn, durability=DEFAULT_DURABILITY, metrics=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(
+                "Unknown durability {}; expected one of {}".format(
+                    durability, ", ".join(DURABILITY_MODES)
+                )
+            )
+        self.conn = conn
+        self.durability = durability
+        self.metrics = metrics
+        # If set to a deadline.Deadline, statements time out by it
+        self.deadline = None
+
+    def cursor(self):
+        curs = self.conn.cursor()
+        if self.metrics is not None:
+            curs = InstrumentedCursor(curs, self.metrics)
+        return curs
+
+    @contextmanager
+    def transaction(self):
+        """
+        A context manager yielding a cursor. The transaction is committed if the
+        block succeeds and rolled back if it raises.
+        """
+        self._limit_statements()
+        curs = self.cursor()
+        try:
+            yield curs
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            curs.close()
+
+    def checkpoint(self):
+        """Commit the work so far if every letter must be durable on its own"""
+        if self.durability == DURABILITY_LETTER:
+            self.conn.commit()
+        self._limit_statements()
+
+    def _limit_statements(self):
+        """
+        Time statements out by the deadline. Once it has passed, they get the full
+        operation timeout again, so that the run can still record what it did and
+        send the summary email.
+        """
+        if self.deadline is None:
+            return
+        if self.deadline.expired:
+            seconds = self.deadline.operation_timeout
+        else:
+            seconds = self.deadline.timeout()
+        backends.backend_for(self.conn).set_statement_timeout(self.conn, seconds)
+
+    def query(self, sql, params=()):
+        """Run `sql` in its own transaction and return all its rows"""
+        with self.transaction() as curs:
+            curs.execute(sql, params)
+            return curs.fetchall()
+
+
+def fingerprint(sql):
+    """
+    Reduce a SQL statement to its shape: literals become ?, lists of placeholders
+    collapse to (?+), and whitespace is normalized. Statements which differ only
+    in their parameters have the same fingerprint.
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"(?<![\w.])\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?+)", sql)
+    return " ".join(sql.split())
+
+
+class QueryMetrics:
+    """
+    Per-statement timings and row counts for a run, keyed by the statement's
+    fingerprint. Time spent fetching a statement's results counts towards it.
+    """
+
+    def __init__(self):
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, key):
+        entry = self.statements.get(key)
+        if entry is None:
+            entry = self.statements[key] = {
+                "executions": 0,
+                "seconds": 0.0,
+                "max_seconds": 0.0,
+                "rows_fetched": 0,
+                "rows_affected": 0,
+            }
+        return entry
+
+    def record_execute(self, key, seconds, rows_affected=0):
+        """Record one execution of the statement with fingerprint `key`"""
+        with self._lock:
+            entry = self._entry(key)
+            entry["executions"] += 1
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["rows_affected"] += max(rows_affected, 0)
+
+    def record_fetch(self, key, seconds, rows_fetched):
+        """Record fetching `rows_fetched` rows of the statement `key`"""
+        with self._lock:
+            entry = self._entry(key)
+            entry["seconds"] += seconds
+            entry["rows_fetched"] += rows_fetched
+
+    @property
+    def total_seconds(self):
+        return sum(entry["seconds"] for entry in self.statements.values())
+
+    def to_dict(self):
+        """The metrics, slowest statement first, ready to be dumped as JSON"""
+        with self._lock:
+            statements = [
+                dict(entry, statement=key) for key, entry in self.statements.items()
+            ]
+        statements.sort(key=lambda entry: entry["seconds"], reverse=True)
+        return {
+            "executions": sum(entry["executions"] for entry in statements),
+            "seconds": sum(entry["seconds"] for entry in statements),
+            "statements": statements,
+        }
+
+    def dump(self, path):
+        """Write the metrics to `path` as JSON"""
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self, limit=10, width=80):
+        """
+        A plain text table of the `limit` slowest statements, suitable for an
+        email.
+        """
+        metrics = self.to_dict()
+        lines = [
+            "{executions} statements in {seconds:.2f}s".format(**metrics),
+            "",
+            "{:>8} {:>6} {:>8} {:>8}  {}".format(
+                "seconds", "execs", "fetched", "affected", "statement"
+            ),
+        ]
+        for entry in metrics["statements"][:limit]:
+            statement = entry["statement"]
+            if len(statement) > width:
+                statement = statement[: width - 3] + "..."
+            lines.append(
+                "{:>8.3f} {:>6} {:>8} {:>8}  {}".format(
+                    entry["seconds"],
+                    entry["executions"],
+                    entry["rows_fetched"],
+                    entry["rows_affected"],
+                    statement,
+                )
+            )
+        return "\n".join(lines)
+
+
+class InstrumentedCursor:
+    """
+    Wrap a DB-API cursor, recording the time and row counts of everything run
+    through it in a `QueryMetrics`. Anything else is passed through to the
+    wrapped cursor.
+    """
+
+    _own_attributes = ("_cursor", "_metrics", "_last")
+
+    def __init__(self, cursor, metrics):
+        object.__setattr__(self, "_cursor", cursor)
+        object.__setattr__(self, "_metrics", metrics)
+        object.__setattr__(self, "_last", None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        if name in self._own_attributes:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cursor, name, value)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    @property
+    def backend(self):
+        return backends.backend_for(self._cursor)
+
+    def execute(self, sql, params=()):
+        key = fingerprint(sql)
+        start = time.perf_counter()
+        self._cursor.execute(sql, params)
+        self._metrics.record_execute(
+            key, time.perf_counter() - start, self._cursor.rowcount
+        )
+        self._last = key
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        key = fingerprint(sql)
+        start = time.perf_counter()
+        self._cursor.executemany(sql, seq_of_params)
+        rowcount = self._cursor.rowcount
+        self._metrics.record_execute(
+            key,
+            time.perf_counter() - start,
+            rowcount if rowcount >= 0 else len(seq_of_params),
+        )
+        self._last = key
+        return self
+
+    def _fetch(self, method, *args):
+        start = time.perf_counter()
+        rows = getattr(self._cursor, method)(*args)
+        if self._last is not None:
+            num_rows = len(rows) if method != "fetchone" else (0 if rows is None else 1)
+            self._metrics.record_fetch(
+                self._last, time.perf_counter() - start, num_rows
+            )
+        return rows
+
+    def fetchone(self):
+        return self._fetch("fetchone")
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._fetch("fetchmany")
+        return self._fetch("fetchmany", size)
+
+    def fetchall(self):
+        return self._fetch("fetchall")
 
 
 def _create_table_if_not_exists(curs, table_name, *columns):
-    rendered_columns = "\n".join(columns)
+    rendered_columns = ",\n      ".join(columns)
     curs.execute(
-        f"""
-    IF NOT EXISTS (
-      SELECT * FROM sysobjects WHERE name = '{table_name}' AND xtype = 'U'
+        backends.backend_for(curs).create_table_if_not_exists(
+            table_name, rendered_columns
+        )
     )
-    CREATE TABLE {table_name} (
-      {rendered_columns}
+
+
+def create_tables(curs):
+    """
+    Create the SUSO tables if they don't already exist. Nothing is committed.
+
+    Args:
+      curs: A cursor into the SUSO database
+    """
+    backend = backends.backend_for(curs)
+    created_at = f"created_at DATETIME NOT NULL DEFAULT {backend.now}"
+    _create_table_if_not_exists(
+        curs,
+        STUDENTS_TABLE,
+        "id INTEGER PRIMARY KEY",
+        "firstname NVARCHAR(1024)",
+        "lastname NVARCHAR(1024)",
+        "address NVARCHAR(1024)",
+        "zipcode NVARCHAR(20)",
+        "guardian_firstname NVARCHAR(1024)",
+        "guardian_lastname NVARCHAR(1024)",
+        "cbo NVARCHAR(1024)",
+        "caseworker NVARCHAR(1024)",
+        "school NVARCHAR(1024)",
+        "enrolled_date NVARCHAR(1024)",
+        "is_good_record BIT",
+        created_at,
     )
-  """
+    _create_table_if_not_exists(
+        curs,
+        RANDOMIZER_TABLE,
+        "student_id INTEGER PRIMARY KEY",
+        "is_treatment BIT",
+        created_at,
+    )
+    _create_table_if_not_exists(
+        curs,
+        STATUS_TABLE,
+        f"id {backend.identity_primary_key}",
+        f"student_id INTEGER {backend.references(STUDENTS_TABLE, 'id')}",
+        "status NVARCHAR(20)",
+        created_at,
+    )
+    _create_table_if_not_exists(
+        curs,
+        JOBS_TABLE,
+        "id INTEGER PRIMARY KEY NOT NULL",
+        f"student_id INTEGER {backend.references(STUDENTS_TABLE, 'id')}",
+        created_at,
+    )
+    _create_table_if_not_exists(
+        curs,
+        MAILINGS_TABLE,
+        f"id {backend.identity_primary_key} NOT NULL",
+        f"job_id INTEGER {backend.references(JOBS_TABLE, 'id')}",
+        "status NVARCHAR(64)",
+        "status_datetime DATETIME",
+        created_at,
     )
 
 
-def insert_student(curs, *args):
+STUDENT_COLUMNS = (
+    "id",
+    "firstname",
+    "lastname",
+    "address",
+    "zipcode",
+    "guardian_firstname",
+    "guardian_lastname",
+    "cbo",
+    "caseworker",
+    "school",
+    "enrolled_date",
+    "is_good_record",
+)
+RANDOMIZER_COLUMNS = ("student_id", "is_treatment")
+STATUS_COLUMNS = ("student_id", "status")
+JOB_COLUMNS = ("id", "student_id")
+MAILING_COLUMNS = ("job_id", "status", "status_datetime")
+
+# The number of rows to send to the server in each round trip of a bulk insert
+DEFAULT_BATCH_SIZE = 1000
+
+# The columns returned by the queries for students to randomize and to send to
+LETTER_COLUMNS = [
+    "id",
+    "firstname",
+    "lastname",
+    "address",
+    "zipcode",
+    "guardian_firstname",
+    "guardian_lastname",
+    "cbo",
+    "caseworker",
+    "enrolled_date",
+    "school",
+    "is_treatment",
+]
+
+LATEST_ENROLLMENT_QUERY = f"""SELECT MAX(enrolled_date) FROM {STUDENTS_TABLE}"""
+
+# Students with good records who have not been randomized yet
+UNRANDOMIZED_STUDENTS_QUERY = f"""
+    SELECT s.id, s.firstname, s.lastname, s.address, s.zipcode,
+           s.guardian_firstname, s.guardian_lastname,
+           s.cbo, s.caseworker, s.enrolled_date,
+           s.school, r.is_treatment
+      FROM {STUDENTS_TABLE} s
+    LEFT JOIN {RANDOMIZER_TABLE} r
+        ON s.id = r.student_id
+     WHERE r.is_treatment IS NULL
+       AND s.is_good_record = 1
+  """
+
+# Treatment students with good records who have not successfully been sent a letter
+UNSENT_TREATMENT_STUDENTS_QUERY = f"""
+    SELECT s.id, s.firstname, s.lastname, s.address, s.zipcode,
+           s.guardian_firstname, s.guardian_lastname,
+           s.cbo, s.caseworker, s.enrolled_date,
+           s.school, r.is_treatment
+      FROM {STUDENTS_TABLE} s
+      JOIN {RANDOMIZER_TABLE} r
+        ON s.id = r.student_id
+     WHERE r.is_treatment = 1
+       AND s.is_good_record = 1
+       AND NOT EXISTS (
+         SELECT 1
+           FROM {STATUS_TABLE} st
+          WHERE st.status = 'Success'
+            AND st.student_id = s.id
+       )
+  """
+
+# Every randomized student with a good record and their arm
+RANDOMIZED_STUDENTS_QUERY = f"""
+    SELECT s.id, s.cbo, s.school, s.enrolled_date, r.is_treatment
+      FROM {STUDENTS_TABLE} s
+      JOIN {RANDOMIZER_TABLE} r
+        ON s.id = r.student_id
+     WHERE s.is_good_record = 1
+  """
+
+# The statuses after which Click2Mail has nothing more to tell us about a mailing
+DELIVERED_STATUSES = ("Arrived at Recipient PO", "USPS Indicated Delivered")
+
+LATEST_JOBS_QUERY = f"""
+    SELECT id, student_id, created_at
+      FROM {LATEST_JOBS_VIEW}
+  """
+
+LATEST_MAILINGS_QUERY = f"""
+    SELECT job_id, status, status_datetime
+      FROM {LATEST_MAILINGS_VIEW}
+  """
+
+# The latest job of each student whose mailing has not yet been delivered
+UNDELIVERED_JOBS_QUERY = f"""
+    SELECT j.id, j.student_id
+      FROM {LATEST_JOBS_VIEW} j
+      LEFT JOIN {LATEST_MAILINGS_VIEW} m
+        ON j.id = m.job_id
+     WHERE m.status IS NULL
+        OR m.status NOT IN ({", ".join("?" for _ in DELIVERED_STATUSES)})
+  """
+
+# Number of students enrolled by month and by day since a date, read from the
+# materialized counts
+MONTH_STATS_QUERY = f"""
+    SELECT the_year, the_month, num_students
+      FROM {ENROLLMENT_BY_MONTH_TABLE}
+     WHERE the_year > ? OR (the_year = ? AND the_month >= ?)
+     ORDER BY the_year, the_month ASC
+  """
+
+DAY_STATS_QUERY = f"""
+    SELECT enrolled_date, num_students
+      FROM {ENROLLMENT_BY_DAY_TABLE}
+     WHERE enrolled_date >= ?
+     ORDER BY enrolled_date ASC
+  """
+
+
+def rebuild_enrollment_stats(curs):
+    """
+    Recompute ENROLLMENT_BY_MONTH_TABLE and ENROLLMENT_BY_DAY_TABLE from scratch
+    out of STUDENTS_TABLE. The inserts keep them current, so this is only needed
+    to repair them. Nothing is committed.
+
+    Args:
+      curs: A cursor into the SUSO database
+    """
+    backend = backends.backend_for(curs)
+    the_year = backend.year("enrolled_date")
+    the_month = backend.month("enrolled_date")
+
+    curs.execute(f"DELETE FROM {ENROLLMENT_BY_MONTH_TABLE}")
     curs.execute(
         f"""
-        INSERT INTO {STUDENTS_TABLE}
-            (id, firstname, lastname, address, zipcode,
-             guardian_firstname, guardian_lastname, cbo,
-             caseworker, school, enrolled_date, is_good_record)
-        VALUES
-            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """,
-        tuple(args),
+    INSERT INTO {ENROLLMENT_BY_MONTH_TABLE} (the_year, the_month, num_students)
+    SELECT {the_year}, {the_month}, COUNT(*)
+      FROM {STUDENTS_TABLE}
+     WHERE enrolled_date IS NOT NULL
+     GROUP BY {the_year}, {the_month}
+  """
     )
 
-
-def insert_randomizer(curs, id, is_treatment):
+    curs.execute(f"DELETE FROM {ENROLLMENT_BY_DAY_TABLE}")
     curs.execute(
         f"""
-        INSERT INTO {RANDOMIZER_TABLE}
-            (student_id, is_treatment)
-        VALUES
-            (?, ?)
-    """,
-        (id, is_treatment),
+    INSERT INTO {ENROLLMENT_BY_DAY_TABLE} (enrolled_date, num_students)
+    SELECT enrolled_date, COUNT(*)
+      FROM {STUDENTS_TABLE}
+     WHERE enrolled_date IS NOT NULL
+     GROUP BY enrolled_date
+  """
     )
 
 
-def insert_status(curs, id, status):
+def _increment_count(curs, table_name, key_columns, key, count):
     curs.execute(
-        f"""
-        INSERT INTO {STATUS_TABLE}
-            (student_id, status)
+        backends.backend_for(curs).increment(table_name, key_columns, "num_students"),
+        key + (count,),
+    )
+
+
+def _add_enrollment_counts(curs, enrolled_dates):
+    """
+    Add newly inserted students to the materialized enrollment counts.
+
+    Args:
+      curs: A cursor into the SUSO database
+      enrolled_dates (iterable[str]): The enrollment date of each new student
+    """
+    by_day = Counter(date for date in enrolled_dates if date is not None)
+    by_month = Counter()
+    for day, count in by_day.items():
+        try:
+            the_date = datetime.strptime(str(day)[:10], "%Y-%m-%d")
+        except ValueError:
+            continue
+        by_month[(the_date.year, the_date.month)] += count
+
+    for key, count in sorted(by_month.items()):
+        _increment_count(
+            curs, ENROLLMENT_BY_MONTH_TABLE, ("the_year", "the_month"), key, count
+        )
+    for day, count in sorted(by_day.items()):
+        _increment_count(
+            curs, ENROLLMENT_BY_DAY_TABLE, ("enrolled_date",), (day,), count
+        )
+
+
+def _insert_sql(table_name, columns):
+    return """
+        INSERT INTO {table_name}
+            ({columns})
         VALUES
-            (?, ?)
-    """,
-        (id, status),
+            ({placeholders})
+    """.format(
+        table_name=table_name,
+        columns=", ".join(columns),
+        placeholders=", ".join("?" for _ in columns),
     )
 
 
-def insert_job(curs, job_id, student_id):
+def _to_python(value):
+    """
+    Convert numpy scalars (which the ODBC driver can't bind) to plain Python
+    values and missing values to None.
+    """
+    if value is None:
+        return None
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def _to_rows(data, columns):
+    """
+    Convert `data` into a list of tuples suitable for `executemany`.
+
+    Args:
+      data (pandas.DataFrame|iterable[tuple]): Either a DataFrame containing (at
+        least) `columns` or an iterable of tuples already in the order of `columns`
+      columns (tuple[str]): The columns being inserted
+
+    Returns:
+      list[tuple]: The rows
+    """
+    if hasattr(data, "itertuples"):
+        data = data[list(columns)].itertuples(index=False, name=None)
+    return [tuple(_to_python(value) for value in row) for row in data]
+
+
+def _executemany(curs, sql, rows, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Run `sql` once for each of `rows`, sending `batch_size` rows to the server per
+    round trip. Uses pyodbc's `fast_executemany` where the driver supports it.
+    Nothing is committed; the caller owns the transaction.
+
+    Returns:
+      int: The number of rows sent
+    """
+    if not rows:
+        return 0
+    if hasattr(curs, "fast_executemany"):
+        curs.fast_executemany = True
+    for start in range(0, len(rows), batch_size):
+        curs.executemany(sql, rows[start : start + batch_size])
+    return len(rows)
+
+
+def insert_student(curs, *args):
+    curs.execute(_insert_sql(STUDENTS_TABLE, STUDENT_COLUMNS), tuple(args))
+    _add_enrollment_counts(curs, [args[STUDENT_COLUMNS.index("enrolled_date")]])
+
+
+def insert_students(curs, data, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert many students at once, adding them to the materialized enrollment
+    counts as well.
+
+    Args:
+      curs: The cursor to insert with
+      data (pandas.DataFrame|iterable[tuple]): The students, either as a DataFrame
+        with the columns in STUDENT_COLUMNS or as tuples in that order
+      batch_size (int): The number of rows to send per round trip
+
+    Returns:
+      int: The number of rows inserted
+    """
+    rows = _to_rows(data, STUDENT_COLUMNS)
+    num_inserted = _executemany(
+        curs, _insert_sql(STUDENTS_TABLE, STUDENT_COLUMNS), rows, batch_size
+    )
+    enrolled_date = STUDENT_COLUMNS.index("enrolled_date")
+    _add_enrollment_counts(curs, [row[enrolled_date] for row in rows])
+    return num_inserted
+
+
+def insert_new_students(curs, data, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert those of the passed students who aren't already in the database.
+    The students are bulk loaded into a temporary staging table and an anti-join
+    against STUDENTS_TABLE inserts just the new ones, so we never have to pull
+    the ids of every student we've ever seen out of the database. The new
+    students are also added to the materialized enrollment counts.
+
+    Args:
+      curs: The cursor to insert with
+      data (pandas.DataFrame|iterable[tuple]): The students, either as a DataFrame
+        with the columns in STUDENT_COLUMNS or as tuples in that order. Ids should
+        be unique.
+      batch_size (int): The number of rows to send per round trip
+
+    Returns:
+      int: The number of students inserted
+    """
+    rows = _to_rows(data, STUDENT_COLUMNS)
+    if not rows:
+        return 0
+
+    backend = backends.backend_for(curs)
+    staging_table = backend.temp_table_name(STUDENTS_STAGING_TABLE)
+    columns = ", ".join(STUDENT_COLUMNS)
     curs.execute(
+        backend.create_temp_table(
+            STUDENTS_STAGING_TABLE,
+            """id INTEGER PRIMARY KEY,
+      firstname NVARCHAR(1024),
+      lastname NVARCHAR(1024),
+      address NVARCHAR(1024),
+      zipcode NVARCHAR(20),
+      guardian_firstname NVARCHAR(1024),
+      guardian_lastname NVARCHAR(1024),
+      cbo NVARCHAR(1024),
+      caseworker NVARCHAR(1024),
+      school NVARCHAR(1024),
+      enrolled_date NVARCHAR(1024),
+      is_good_record BIT""",
+        )
+    )
+    try:
+        _executemany(
+            curs,
+            _insert_sql(staging_table, STUDENT_COLUMNS),
+            rows,
+            batch_size,
+        )
+        # The lock hint keeps a concurrent run from inserting the same students
+        # between the check and the insert, and the counts are taken from the
+        # rows actually inserted
+        curs.execute(
+            backend.insert_returning(
+                STUDENTS_TABLE,
+                STUDENT_COLUMNS,
+                f"""SELECT {columns}
+        FROM {staging_table} st
+       WHERE NOT EXISTS (
+         SELECT 1 FROM {STUDENTS_TABLE} s{backend.key_lock_hint} WHERE s.id = st.id
+       )""",
+                "enrolled_date",
+            )
+        )
+        new_enrolled_dates = [row[0] for row in curs.fetchall()]
+        _add_enrollment_counts(curs, new_enrolled_dates)
+        return len(new_enrolled_dates)
+    finally:
+        curs.execute(f"DROP TABLE {staging_table}")
+
+
+def insert_randomizer(curs, id, is_treatment):
+    curs.execute(_insert_sql(RANDOMIZER_TABLE, RANDOMIZER_COLUMNS), (id, is_treatment))
+
+
+def insert_randomizers(curs, data, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert many randomizations at once. `data` is a DataFrame with the columns in
+    RANDOMIZER_COLUMNS or an iterable of (student_id, is_treatment) tuples.
+
+    Returns:
+      int: The number of rows inserted
+    """
+    return _executemany(
+        curs,
+        _insert_sql(RANDOMIZER_TABLE, RANDOMIZER_COLUMNS),
+        _to_rows(data, RANDOMIZER_COLUMNS),
+        batch_size,
+    )
+
+
+def insert_new_randomizers(curs, data, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert the randomizations of those students who don't already have one, so
+    that runs randomizing the same students at the same time don't conflict.
+    `data` is a DataFrame with the columns in RANDOMIZER_COLUMNS or an iterable
+    of (student_id, is_treatment) tuples.
+
+    Returns:
+      int: The number of rows sent
+    """
+    columns = ", ".join(RANDOMIZER_COLUMNS)
+    backend = backends.backend_for(curs)
+    # Without the lock hint, two runs can both see that a student has no row and
+    # both insert one
+    return _executemany(
+        curs,
         f"""
-    INSERT INTO {JOBS_TABLE}
-      (id, student_id)
-    VALUES
-      (?, ?)
+        INSERT INTO {RANDOMIZER_TABLE} ({columns})
+        SELECT ?, ?
+         WHERE NOT EXISTS (
+           SELECT 1 FROM {RANDOMIZER_TABLE}{backend.key_lock_hint}
+            WHERE student_id = ?
+         )
     """,
-        (job_id, student_id),
+        [
+            (student_id, is_treatment, student_id)
+            for student_id, is_treatment in _to_rows(data, RANDOMIZER_COLUMNS)
+        ],
+        batch_size,
+    )
+
+
+def insert_status(curs, id, status):
+    curs.execute(_insert_sql(STATUS_TABLE, STATUS_COLUMNS), (id, status))
+
+
+def insert_statuses(curs, data, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert many statuses at once. `data` is a DataFrame with the columns in
+    STATUS_COLUMNS or an iterable of (student_id, status) tuples.
+
+    Returns:
+      int: The number of rows inserted
+    """
+    return _executemany(
+        curs,
+        _insert_sql(STATUS_TABLE, STATUS_COLUMNS),
+        _to_rows(data, STATUS_COLUMNS),
+        batch_size,
+    )
+
+
+def insert_job(curs, job_id, student_id):
+    curs.execute(_insert_sql(JOBS_TABLE, JOB_COLUMNS), (job_id, student_id))
+
+
+def insert_jobs(curs, data, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert many jobs at once. `data` is a DataFrame with the columns in
+    JOB_COLUMNS or an iterable of (job_id, student_id) tuples.
+
+    Returns:
+      int: The number of rows inserted
+    """
+    return _executemany(
+        curs,
+        _insert_sql(JOBS_TABLE, JOB_COLUMNS),
+        _to_rows(data, JOB_COLUMNS),
+        batch_size,
     )
 
 
+def table_row_counts(curs):
+    """
+    Count the rows in each of the SUSO tables.
+
+    Returns:
+      dict[str, int]: A map from table name to its number of rows
+    """
+    counts = {}
+    for table in (
+        STUDENTS_TABLE,
+        RANDOMIZER_TABLE,
+        STATUS_TABLE,
+        JOBS_TABLE,
+        MAILINGS_TABLE,
+    ):
+        curs.execute(f"SELECT COUNT(*) FROM {table}")
+        counts[table] = curs.fetchone()[0]
+    return counts
+
+
+def job_exists(curs, job_id):
+    curs.execute(f"""SELECT 1 FROM {JOBS_TABLE} WHERE id = ?""", (job_id,))
+    return curs.fetchone() is not None
+
+
+def latest_jobs(curs):
+    """
+    Return the most recent job sent to each student.
+
+    Args:
+      curs: A cursor into the SUSO database
+
+    Returns:
+      list[tuple]: (job_id, student_id, created_at) for each student with a job
+    """
+    curs.execute(LATEST_JOBS_QUERY)
+    return curs.fetchall()
+
+
+def latest_mailings(curs):
+    """
+    Return the most recent mailing status of each job.
+
+    Args:
+      curs: A cursor into the SUSO database
+
+    Returns:
+      list[tuple]: (job_id, status, status_datetime) for each job with a status
+    """
+    curs.execute(LATEST_MAILINGS_QUERY)
+    return curs.fetchall()
+
+
+def undelivered_jobs(curs):
+    """
+    Return the latest job of each student whose letter hasn't been delivered,
+    i.e., the jobs whose tracking is still worth checking.
+
+    Args:
+      curs: A cursor into the SUSO database
+
+    Returns:
+      list[tuple]: (job_id, student_id) pairs
+    """
+    curs.execute(UNDELIVERED_JOBS_QUERY, DELIVERED_STATUSES)
+    return curs.fetchall()
+
+
 def insert_mailing(curs, job_id, status, status_datetime):
     curs.execute(
-        f"""
-    INSERT INTO {MAILINGS_TABLE}
-      (job_id, status, status_datetime)
-    VALUES
-      (?, ?, ?)
-    """,
-        (job_id, status, status_datetime),
+        _insert_sql(MAILINGS_TABLE, MAILING_COLUMNS), (job_id, status, status_datetime)
+    )
+
+
+def insert_mailings(curs, data, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert many mailing statuses at once. `data` is a DataFrame with the columns in
+    MAILING_COLUMNS or an iterable of (job_id, status, status_datetime) tuples.
+
+    Returns:
+      int: The number of rows inserted
+    """
+    return _executemany(
+        curs,
+        _insert_sql(MAILINGS_TABLE, MAILING_COLUMNS),
+        _to_rows(data, MAILING_COLUMNS),
+        batch_size,
     )
@@ -0,0 +1,108 @@
+"""
+A time budget for a whole run, so that a hung ETO request or a stuck pdflatex
+can't stall a cron run until the next one starts on top of it. Set it in the
+`deadline` section of the config::
+
+  deadline:
+    minutes: 25
+    timeout: 60
+
+Every HTTP request, pdflatex call and SQL statement is given a timeout of at most
+`timeout` seconds (60 by default, even with no deadline) and never more than is
+left of the run. Once the run is out of time, the letters which haven't been
+rendered or submitted are left for the next run, and the summary email says how
+many.
+
+  deadline = Deadline(25 * 60)
+  response = session.get(url, timeout=deadline.timeout())
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import time
+
+# The longest any one HTTP request, pdflatex call or SQL statement may take
+DEFAULT_TIMEOUT = 60.0
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the run is out of time"""
+
+
+class Deadline:
+    """
+    The time left in a run.
+    """
+
+    def __init__(self, seconds=None, timeout=DEFAULT_TIMEOUT, clock=time.monotonic):
+        """
+        Args:
+          seconds (float|None): How long the run may take, from now. None for no
+            limit on the run as a whole.
+          timeout (float): The longest any one operation may take
+          clock (callable): Returns the current time in seconds
+        """
+        self.seconds = seconds
+        self.operation_timeout = timeout
+        self._clock = clock
+        self._expires_at = None if seconds is None else clock() + seconds
+
+    def remaining(self):
+        """The seconds left in the run (never negative), or None if unlimited"""
+        if self._expires_at is None:
+            return None
+        return max(self._expires_at - self._clock(), 0.0)
+
+    @property
+    def expired(self):
+        return self._expires_at is not None and self._clock() >= self._expires_at
+
+    def check(self):
+        """
+        Raises:
+          DeadlineExceeded: If the run is out of time
+        """
+        if self.expired:
+            raise DeadlineExceeded(f"The run's {self.seconds:.0f}s deadline passed")
+
+    def timeout(self, limit=None):
+        """
+        The timeout to give the next operation: the time left in the run, but no
+        more than `limit`.
+
+        Args:
+          limit (float|None): The longest the operation may take. Defaults to the
+            `timeout` passed to the constructor.
+
+        Returns:
+          float: The timeout in seconds
+
+        Raises:
+          DeadlineExceeded: If the run is already out of time
+        """
+        self.check()
+        limit = self.operation_timeout if limit is None else limit
+        remaining = self.remaining()
+        return limit if remaining is None else min(limit, remaining)
+
+
+def deadline_from_config(config):
+    """
+    The deadline for a run starting now, as set in the `deadline` section of the
+    config.
+
+    Raises:
+      ValueError: If the section has keys other than `minutes` and `timeout`
+    """
+    section = config.get("deadline") or {}
+    unknown = set(section) - {"minutes", "timeout"}
+    if unknown:
+        raise ValueError(
+            "Unknown keys in the deadline section of the config: {}".format(
+                ", ".join(sorted(unknown))
+            )
+        )
+    minutes = section.get("minutes")
+    return Deadline(
+        None if minutes is None else minutes * 60,
+        timeout=section.get("timeout", DEFAULT_TIMEOUT),
+    )
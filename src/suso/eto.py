@@ -5,7 +5,10 @@ from urllib.parse import urlencode
 
 import pandas as pd
 import requests
-from pandas.io.json import json_normalize
+from pandas import json_normalize
+
+from suso.deadline import Deadline
+from suso.metrics import endpoint_label
 
 BASE_URL = "https://services.etosoftware.com/API"
 
@@ -52,6 +55,11 @@ class ApiHandler:
         self._site_id = None
         self._program_id = None
 
+        # If set to a metrics.HttpMetrics, every request is recorded in it
+        self.http_metrics = None
+        # Every request times out by this deadline (and after DEFAULT_TIMEOUT)
+        self.deadline = Deadline()
+
     @property
     def session(self):
         """The HTTP session the class maintains"""
@@ -111,11 +119,26 @@ class ApiHandler:
 
         Returns:
           requests.Response: The requests Response object
+
+        Raises:
+          DeadlineExceeded: If the run's deadline passed before or during the
+            request
         """
         url = urljoin(self.base_url, *map(str, args))
         if query:
             url += "?" + urlencode(query)
-        return self.session.request(method, url, **kwargs)
+        kwargs.setdefault("timeout", self.deadline.timeout())
+
+        def send():
+            try:
+                return self.session.request(method, url, **kwargs)
+            except requests.Timeout:
+                self.deadline.check()
+                raise
+
+        if self.http_metrics is None:
+            return send()
+        return self.http_metrics.timed("eto", method, endpoint_label(*args), send)
 
     def _request_site(self, method, *args, query=None, **kwargs):
         """
@@ -0,0 +1,292 @@
+"""
+Export the SUSO tables to Parquet for analysis. Each table is streamed out of the
+database `chunk_size` rows at a time and each chunk is written as its own row
+group, so memory stays bounded no matter how large the tables get.
+
+Exports are incremental. Each table gets a directory of part files, and the
+largest `created_at` exported so far is recorded in STATE_FILE; the next export
+of that table only pulls rows created since then and adds a new part. A row's
+`created_at` is set when it is inserted, not when it is committed, so each export
+looks back EXPORT_OVERLAP before the watermark, and STATE_FILE also remembers the
+keys of the rows in that window so that none is written twice. Read a table back
+with `pd.read_parquet(os.path.join(directory, table_name))`.
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import json
+import os
+from collections import deque, namedtuple
+from datetime import date, datetime, timedelta
+
+from suso import database as db
+
+STATE_FILE = "_export_state.json"
+
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_COMPRESSION = "snappy"
+
+# How long before the watermark to look for rows which were committed late
+EXPORT_OVERLAP = timedelta(minutes=10)
+
+# `key` is the name of the table's primary key column, and `columns` is a tuple of
+# (name, type) pairs, where type is one of "int", "string", "bool" or "timestamp"
+ExportTable = namedtuple("ExportTable", ("name", "key", "columns"))
+
+EXPORT_TABLES = (
+    ExportTable(
+        db.STUDENTS_TABLE,
+        "id",
+        (
+            ("id", "int"),
+            ("firstname", "string"),
+            ("lastname", "string"),
+            ("address", "string"),
+            ("zipcode", "string"),
+            ("guardian_firstname", "string"),
+            ("guardian_lastname", "string"),
+            ("cbo", "string"),
+            ("caseworker", "string"),
+            ("school", "string"),
+            ("enrolled_date", "string"),
+            ("is_good_record", "bool"),
+            ("created_at", "timestamp"),
+        ),
+    ),
+    ExportTable(
+        db.RANDOMIZER_TABLE,
+        "student_id",
+        (
+            ("student_id", "int"),
+            ("is_treatment", "bool"),
+            ("created_at", "timestamp"),
+        ),
+    ),
+    ExportTable(
+        db.STATUS_TABLE,
+        "id",
+        (
+            ("id", "int"),
+            ("student_id", "int"),
+            ("status", "string"),
+            ("created_at", "timestamp"),
+        ),
+    ),
+    ExportTable(
+        db.JOBS_TABLE,
+        "id",
+        (
+            ("id", "int"),
+            ("student_id", "int"),
+            ("created_at", "timestamp"),
+        ),
+    ),
+    ExportTable(
+        db.MAILINGS_TABLE,
+        "id",
+        (
+            ("id", "int"),
+            ("job_id", "int"),
+            ("status", "string"),
+            ("status_datetime", "timestamp"),
+            ("created_at", "timestamp"),
+        ),
+    ),
+)
+
+
+def _arrow_type(name):
+    import pyarrow as pa
+
+    return {
+        "int": pa.int64(),
+        "string": pa.string(),
+        "bool": pa.bool_(),
+        "timestamp": pa.timestamp("us"),
+    }[name]
+
+
+def _to_timestamp(value):
+    """SQLite hands back timestamps as strings; SQL Server as datetimes"""
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return datetime.fromisoformat(str(value))
+
+
+def _convert(value, type_name):
+    if value is None:
+        return None
+    if type_name == "timestamp":
+        return _to_timestamp(value)
+    if type_name == "bool":
+        return bool(value)
+    return value
+
+
+def _load_state(directory):
+    path = os.path.join(directory, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_state(directory, state):
+    path = os.path.join(directory, STATE_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def export_table(
+    curs,
+    table,
+    directory,
+    since=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    compression=DEFAULT_COMPRESSION,
+    seen=(),
+):
+    """
+    Write the rows of `table` created since `since` (less EXPORT_OVERLAP) to a new
+    Parquet part file in `directory`/`table.name`, skipping those in `seen`.
+
+    Args:
+      curs: A cursor into the SUSO database
+      table (ExportTable): The table to export
+      directory (str): The root of the export
+      since (datetime|None): Only export rows created since this. If None, export
+        everything.
+      chunk_size (int): The number of rows to fetch and write at a time
+      compression (str): The Parquet compression codec
+      seen (iterable): The keys of rows already exported
+
+    Returns:
+      tuple[int, datetime|None, list]: The number of rows written, the largest
+        `created_at` among them (or `since` if there were none), and the keys of
+        the rows created in the EXPORT_OVERLAP before it
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    names = [name for name, _ in table.columns]
+    types = [type_name for _, type_name in table.columns]
+    schema = pa.schema(
+        [(name, _arrow_type(type_name)) for name, type_name in table.columns]
+    )
+    created_at = names.index("created_at")
+    key = names.index(table.key)
+    seen = set(seen)
+
+    sql = f"""SELECT {", ".join(names)} FROM {table.name}"""
+    params = ()
+    if since is not None:
+        sql += " WHERE created_at >= ?"
+        params = (since - EXPORT_OVERLAP,)
+    sql += f" ORDER BY created_at, {table.key}"
+    curs.execute(sql, params)
+
+    table_directory = os.path.join(directory, table.name)
+    path = os.path.join(
+        table_directory,
+        "part-{}.parquet".format(datetime.now().strftime("%Y%m%d%H%M%S%f")),
+    )
+    writer = None
+    num_rows = 0
+    latest = since
+    # (created_at, key) of the rows fetched, oldest first, pruned to the overlap
+    recent = deque()
+    try:
+        while True:
+            rows = curs.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            for row in rows:
+                recent.append((_to_timestamp(row[created_at]), row[key]))
+            rows = [row for row in rows if row[key] not in seen]
+            if not rows:
+                continue
+
+            columns = [
+                [_convert(row[i], type_name) for row in rows]
+                for i, type_name in enumerate(types)
+            ]
+            chunk = pa.Table.from_arrays(
+                [
+                    pa.array(column, type=field.type)
+                    for column, field in zip(columns, schema)
+                ],
+                schema=schema,
+            )
+            if writer is None:
+                os.makedirs(table_directory, exist_ok=True)
+                writer = pq.ParquetWriter(path, schema, compression=compression)
+            writer.write_table(chunk)
+
+            num_rows += len(rows)
+            latest = max(columns[created_at][-1], latest or columns[created_at][-1])
+            while recent and recent[0][0] < latest - EXPORT_OVERLAP:
+                recent.popleft()
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if latest is not None:
+        recent = [
+            key for timestamp, key in recent if timestamp >= latest - EXPORT_OVERLAP
+        ]
+    return num_rows, latest, list(recent)
+
+
+def export_tables(
+    curs,
+    directory,
+    tables=EXPORT_TABLES,
+    full=False,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    compression=DEFAULT_COMPRESSION,
+):
+    """
+    Export each of `tables` into `directory`, picking up where the last export
+    left off unless `full` is passed, in which case the table's existing part
+    files are replaced.
+
+    Returns:
+      dict[str, int]: The number of rows written for each table
+    """
+    os.makedirs(directory, exist_ok=True)
+    state = _load_state(directory)
+
+    written = {}
+    for table in tables:
+        table_directory = os.path.join(directory, table.name)
+        if full:
+            state.pop(table.name, None)
+            if os.path.isdir(table_directory):
+                for filename in os.listdir(table_directory):
+                    if filename.startswith("part-") and filename.endswith(".parquet"):
+                        os.remove(os.path.join(table_directory, filename))
+
+        table_state = state.get(table.name) or {}
+        since = table_state.get("since")
+        if since is not None:
+            since = datetime.fromisoformat(since)
+
+        num_rows, latest, recent = export_table(
+            curs,
+            table,
+            directory,
+            since,
+            chunk_size,
+            compression,
+            seen=table_state.get("keys", ()),
+        )
+        if latest is not None:
+            state[table.name] = {"since": latest.isoformat(sep=" "), "keys": recent}
+        _save_state(directory, state)
+        written[table.name] = num_rows
+
+    return written
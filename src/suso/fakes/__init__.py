@@ -0,0 +1,4 @@
+"""
+Local stand-ins for the services the SUSO pipeline talks to, so that it can be
+exercised (and load tested) without touching the real thing.
+"""
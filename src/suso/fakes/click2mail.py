@@ -0,0 +1,513 @@
+"""
+A local stand-in for Click2Mail's molpro REST API. It implements the subset of
+endpoints that `suso.click2mail.Click2MailClient` uses and answers with the same
+sort of XML envelopes the real API does. On top of that it can add latency,
+inject 429s and 5xxs, and delay the processing of address lists so that the
+submission path can be exercised offline.
+
+Use it from Python::
+
+  with FakeClick2MailServer(latency=0.05, error_rate=0.1) as server:
+      client = Click2MailClient(base_url=server.base_url)
+      ...
+
+or run it on its own::
+
+  python -m suso.fakes.click2mail --port 8080 --address-list-delay 2
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import click
+
+BASE_PATH = "/molpro"
+
+# Click2Mail's status codes as they show up in the <status/> of a response
+STATUS_SUCCESS = 0
+STATUS_PROCESSING = 3
+STATUS_ERROR = 9
+
+# A one page, blank PDF to hand back as a proof
+PROOF_PDF = (
+    b"%PDF-1.1\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+    b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+    b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>endobj\n"
+    b"trailer<</Root 1 0 R>>\n%%EOF\n"
+)
+
+
+def _envelope(tag, status=STATUS_SUCCESS, description="Success", **fields):
+    """
+    Render a response the way Click2Mail does, e.g.::
+
+      <?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+      <job>
+        <id>245985</id>
+        <status>0</status>
+        <description>Created</description>
+      </job>
+
+    Args:
+      tag (str): The root tag of the response
+      status (int): The Click2Mail status code
+      description (str): The description of the status
+      fields: Any other (scalar) fields to include, in order, before the status
+
+    Returns:
+      bytes: The XML document
+    """
+    body = "".join(
+        "\n  <{key}>{value}</{key}>".format(key=key, value=value)
+        for key, value in fields.items()
+    )
+    return (
+        (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            "<{tag}>{body}\n  <status>{status}</status>\n"
+            "  <description>{description}</description>\n</{tag}>\n"
+        )
+        .format(tag=tag, body=body, status=status, description=description)
+        .encode()
+    )
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "FakeClick2Mail/0.1"
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this, Nagle's algorithm
+    # and delayed ACKs add ~40ms to every response on a kept-alive connection
+    disable_nagle_algorithm = True
+
+    # (method, regex, handler name)
+    routes = (
+        ("POST", r"account/authorize", "authorize"),
+        ("POST", r"documents", "post_document"),
+        ("GET", r"documents/(\d+)", "get_document"),
+        ("POST", r"addressLists", "post_address_list"),
+        ("GET", r"addressLists/(\d+)", "get_address_list"),
+        ("POST", r"jobs", "post_job"),
+        ("POST", r"jobs/jobTemplate", "post_job"),
+        ("GET", r"jobs/(\d+)", "get_job"),
+        ("POST", r"jobs/(\d+)/update", "update_job"),
+        ("POST", r"jobs/(\d+)/submit", "submit_job"),
+        ("POST", r"jobs/(\d+)/proof", "post_proof"),
+        ("GET", r"jobs/(\d+)/proof/(\d+)", "get_proof"),
+        ("GET", r"jobs/(\d+)/tracking", "get_tracking"),
+    )
+
+    def log_message(self, format, *args):
+        if self.server.fake.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def _send(self, code, body, content_type="application/xml", headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        try:
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting, e.g., because its request timed out
+            self.close_connection = True
+
+    def _dispatch(self, method):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        path = url.path
+        if path.startswith(BASE_PATH):
+            path = path[len(BASE_PATH) :]
+        path = path.strip("/")
+
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            fake.count(path, 404)
+            self._send(404, _envelope("error", STATUS_ERROR, "Not found"))
+            return
+
+        fake.sleep()
+
+        if not self.headers.get("Authorization", "").startswith("Basic "):
+            fake.count(name, 401)
+            self._send(401, _envelope("error", STATUS_ERROR, "Unauthorized"))
+            return
+
+        injected = fake.pick_failure()
+        if injected:
+            fake.count(name, injected)
+            headers = {"Retry-After": "1"} if injected == 429 else None
+            self._send(
+                injected,
+                _envelope("error", STATUS_ERROR, "Injected failure"),
+                headers=headers,
+            )
+            return
+
+        form = {}
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            form.update(parse_qs(body.decode("latin-1")))
+        form.update(parse_qs(url.query))
+        form = {key: values[-1] for key, values in form.items()}
+
+        code, content, content_type = getattr(fake, name)(
+            *map(int, match.groups()), form=form, body=body
+        )
+        fake.count(name, code)
+        self._send(code, content, content_type)
+
+
+class FakeClick2MailServer:
+    """
+    An in-process, threaded HTTP server which pretends to be Click2Mail.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        error_statuses=(429, 500, 502, 503),
+        address_list_delay=0.0,
+        seed=None,
+        verbose=False,
+    ):
+        """
+        Args:
+          host (str): The interface to listen on
+          port (int): The port to listen on. 0 picks a free one.
+          latency (float): Seconds to wait before answering each request
+          jitter (float): Up to this many extra seconds are added to each latency,
+            uniformly at random
+          error_rate (float): The probability that any request is answered with one
+            of `error_statuses` instead of being processed
+          error_statuses (tuple[int]): The HTTP statuses to inject
+          address_list_delay (float): Seconds after being posted before an address
+            list is ready to be used in a job
+          seed (int|None): Seed for the random number generator
+          verbose (bool): Log each request to stderr
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.address_list_delay = address_list_delay
+        self.verbose = verbose
+
+        self.documents = {}
+        self.address_lists = {}
+        self.jobs = {}
+        self.requests = Counter()
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_id = 1000
+        self._thread = None
+
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}{}".format(host, port, BASE_PATH)
+
+    def start(self):
+        """Serve requests on a background thread"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve requests on this thread"""
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _new_id(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def sleep(self):
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def pick_failure(self):
+        """Return an HTTP status to inject, or None if this request should succeed"""
+        if not self.error_rate:
+            return None
+        with self._lock:
+            if self._random.random() < self.error_rate:
+                return self._random.choice(self.error_statuses)
+        return None
+
+    def count(self, endpoint, code):
+        with self._lock:
+            self.requests[(endpoint, code)] += 1
+
+    def address_list_ready(self, address_list_id):
+        address_list = self.address_lists.get(address_list_id)
+        return bool(address_list) and time.monotonic() >= address_list["ready_at"]
+
+    # Endpoints. Each returns (HTTP status, body, content type)
+
+    def authorize(self, form, body):
+        return 200, _envelope("account"), "application/xml"
+
+    def post_document(self, form, body):
+        document_id = self._new_id()
+        self.documents[document_id] = {"size": len(body), "at": datetime.now()}
+        return (
+            200,
+            _envelope("document", id=document_id),
+            "application/xml",
+        )
+
+    def get_document(self, document_id, form, body):
+        if document_id not in self.documents:
+            return (
+                404,
+                _envelope("document", STATUS_ERROR, "Document not found"),
+                "application/xml",
+            )
+        return (
+            200,
+            _envelope("document", id=document_id, documentFormat="PDF"),
+            "application/xml",
+        )
+
+    def post_address_list(self, form, body):
+        address_list_id = self._new_id()
+        self.address_lists[address_list_id] = {
+            "addresses": body.count(b"<address>"),
+            "ready_at": time.monotonic() + self.address_list_delay,
+        }
+        return (
+            200,
+            _envelope(
+                "addressList", STATUS_PROCESSING, "Processing", id=address_list_id
+            ),
+            "application/xml",
+        )
+
+    def get_address_list(self, address_list_id, form, body):
+        if address_list_id not in self.address_lists:
+            return (
+                404,
+                _envelope("addressList", STATUS_ERROR, "Address list not found"),
+                "application/xml",
+            )
+        if not self.address_list_ready(address_list_id):
+            return (
+                200,
+                _envelope(
+                    "addressList", STATUS_PROCESSING, "Processing", id=address_list_id
+                ),
+                "application/xml",
+            )
+        return (
+            200,
+            _envelope(
+                "addressList",
+                id=address_list_id,
+                count=self.address_lists[address_list_id]["addresses"],
+            ),
+            "application/xml",
+        )
+
+    def post_job(self, form, body):
+        document_id = int(form.get("documentId") or 0)
+        address_list_id = int(form.get("addressId") or 0)
+        if form.get("templateName") is None:
+            if document_id not in self.documents:
+                return (
+                    400,
+                    _envelope("job", STATUS_ERROR, "Invalid documentId"),
+                    "application/xml",
+                )
+            if not self.address_list_ready(address_list_id):
+                return (
+                    400,
+                    _envelope("job", STATUS_ERROR, "Address list is not ready"),
+                    "application/xml",
+                )
+
+        job_id = self._new_id()
+        self.jobs[job_id] = {
+            "document_id": document_id,
+            "address_list_id": address_list_id,
+            "status": "EDITING",
+            "submitted_at": None,
+        }
+        return (
+            200,
+            _envelope("job", description="Created", id=job_id),
+            "application/xml",
+        )
+
+    def get_job(self, job_id, form, body):
+        job = self.jobs.get(job_id)
+        if not job:
+            return (
+                404,
+                _envelope("job", STATUS_ERROR, "Job not found"),
+                "application/xml",
+            )
+        return (
+            200,
+            _envelope("job", id=job_id, jobStatus=job["status"]),
+            "application/xml",
+        )
+
+    def update_job(self, job_id, form, body):
+        if job_id not in self.jobs:
+            return (
+                404,
+                _envelope("job", STATUS_ERROR, "Job not found"),
+                "application/xml",
+            )
+        if form.get("addressId"):
+            self.jobs[job_id]["address_list_id"] = int(form["addressId"])
+        return (
+            200,
+            _envelope("job", description="Updated", id=job_id),
+            "application/xml",
+        )
+
+    def submit_job(self, job_id, form, body):
+        job = self.jobs.get(job_id)
+        if not job:
+            return (
+                404,
+                _envelope("job", STATUS_ERROR, "Job not found"),
+                "application/xml",
+            )
+        if job["status"] != "EDITING":
+            return (
+                400,
+                _envelope("job", STATUS_ERROR, "Job has already been submitted"),
+                "application/xml",
+            )
+        job["status"] = "SUBMITTED"
+        job["submitted_at"] = datetime.now()
+        return (
+            200,
+            _envelope("job", description="Submitted", id=job_id),
+            "application/xml",
+        )
+
+    def post_proof(self, job_id, form, body):
+        if job_id not in self.jobs:
+            return (
+                404,
+                _envelope("job", STATUS_ERROR, "Job not found"),
+                "application/xml",
+            )
+        return 200, _envelope("proof", id=self._new_id()), "application/xml"
+
+    def get_proof(self, job_id, proof_id, form, body):
+        return 200, PROOF_PDF, "application/pdf"
+
+    def get_tracking(self, job_id, form, body):
+        job = self.jobs.get(job_id)
+        if not job:
+            return (
+                404,
+                _envelope("job", STATUS_ERROR, "Job not found"),
+                "application/xml",
+            )
+        if not job["submitted_at"]:
+            return (
+                200,
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                b"<tracking></tracking>\n",
+                "application/xml",
+            )
+        return (
+            200,
+            (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                "<tracking>\n  <jobId>{job_id}</jobId>\n  <mailPiece>\n"
+                "    <barCode>00000000000000000000</barCode>\n"
+                "    <status>Arrived at Recipient PO</status>\n"
+                "    <dateTime>{at}.0</dateTime>\n  </mailPiece>\n</tracking>\n"
+            )
+            .format(
+                job_id=job_id,
+                at=job["submitted_at"].strftime("%Y-%m-%d %H:%M:%S"),
+            )
+            .encode(),
+            "application/xml",
+        )
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", help="The interface to listen on")
+@click.option("--port", default=8080, help="The port to listen on")
+@click.option("--latency", default=0.0, help="Seconds to wait before each response")
+@click.option("--jitter", default=0.0, help="Maximum extra random latency")
+@click.option("--error-rate", default=0.0, help="Probability of a 429/5xx")
+@click.option(
+    "--address-list-delay", default=0.0, help="Seconds until address lists are ready"
+)
+@click.option("--seed", default=None, type=int, help="Random seed")
+def main(host, port, latency, jitter, error_rate, address_list_delay, seed):
+    """Run a fake Click2Mail server in the foreground"""
+    server = FakeClick2MailServer(
+        host=host,
+        port=port,
+        latency=latency,
+        jitter=jitter,
+        error_rate=error_rate,
+        address_list_delay=address_list_delay,
+        seed=seed,
+        verbose=True,
+    )
+    click.echo(f"Serving a fake Click2Mail at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
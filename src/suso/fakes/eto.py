@@ -0,0 +1,136 @@
+"""
+A local stand-in for `suso.eto.ApiHandler` which makes up participants instead of
+asking ETO for them. It doesn't speak HTTP; it answers in process, waiting as
+long as the real API would take to make the same number of requests, so that a
+simulated run spends about as long in ETO as a real one does.
+
+  api = FakeApiHandler(1000, latency=0.05, seed=0)
+  api.login("username", "password")
+  participants = api.get_all_participants("2021-06-01", "2021-06-04")
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+# Pieces to build participants from
+FIRST_NAMES = ("Ana", "Ben", "Chloe", "Dev", "Eli", "Fatima", "Gus", "Hana")
+LAST_NAMES = ("Adams", "Brown", "Carter", "Diaz", "Evans", "Ford", "Green", "Hill")
+STREETS = ("A Street NW", "Benning Rd NE", "Good Hope Rd SE", "Georgia Ave NW")
+ZIPCODES = ("20001", "20002", "20019", "20020", "20032")
+SCHOOLS = ("Example School ES", "Anacostia HS", "Kelly Miller MS", "KIPP DC PCS")
+
+
+class FakeApiHandler:
+    """
+    Pretend to be ETO, with `num_participants` participants referred between the
+    start and end dates of each `get_all_participants` call.
+    """
+
+    def __init__(
+        self,
+        num_participants,
+        sites=("Example CBO",),
+        latency=0.0,
+        num_staff=20,
+        bad_record_rate=0.02,
+        first_id=100,
+        seed=None,
+    ):
+        """
+        Args:
+          num_participants (int): The number of participants to make up
+          sites (iterable[str]): The names of the sites (CBOs) to spread them over
+          latency (float): Seconds each (modeled) request to ETO takes
+          num_staff (int): The number of caseworkers to spread them over
+          bad_record_rate (float): The fraction of participants missing an address
+          first_id (int): The CLID of the first participant
+          seed (int|None): Seed for the random number generator
+        """
+        self.num_participants = num_participants
+        self.sites = {site_id: name for site_id, name in enumerate(sites, 1)}
+        self.latency = latency
+        self.num_staff = num_staff
+        self.bad_record_rate = bad_record_rate
+        self.first_id = first_id
+        self.requests = Counter()
+        # If set to a metrics.HttpMetrics, every (modeled) request is recorded in it
+        self.http_metrics = None
+        # If set to a deadline.Deadline, requests fail once it has passed
+        self.deadline = None
+
+        self._random = random.Random(seed)
+
+    def _request(self, endpoint, n=1):
+        """Account for `n` requests to `endpoint`"""
+        if self.deadline is not None:
+            self.deadline.check()
+        self.requests[endpoint] += n
+        if self.latency:
+            time.sleep(self.latency * n)
+        if self.http_metrics is not None:
+            for _ in range(n):
+                self.http_metrics.record("eto", "get", endpoint, 200, self.latency)
+
+    @property
+    def request_seconds(self):
+        """The total time spent waiting on (modeled) requests"""
+        return self.latency * sum(self.requests.values())
+
+    def login(self, username, password):
+        self._request("SSOAuthenticate")
+        self._request("GetSSOEnterprises")
+
+    def get_sites(self, filter_historical=True):
+        return self.sites
+
+    def _participant(self, clid, site_name, start, days):
+        has_address = self._random.random() >= self.bad_record_rate
+        staff = self._random.randrange(self.num_staff)
+        referred_at = start + timedelta(days=self._random.randint(0, days))
+        # ETO's .NET style dates, e.g., /Date(1539000000000-0500)/
+        program_start = "/Date({}-0500)/".format(int(referred_at.timestamp() * 1000))
+        return {
+            "CLID": clid,
+            "FName": self._random.choice(FIRST_NAMES),
+            "LName": self._random.choice(LAST_NAMES),
+            "guardian_firstname": self._random.choice(FIRST_NAMES),
+            "guardian_lastname": self._random.choice(LAST_NAMES),
+            "address": "{} {}".format(
+                self._random.randint(100, 4999), self._random.choice(STREETS)
+            )
+            if has_address
+            else None,
+            "zipcode": self._random.choice(ZIPCODES),
+            "site_name": site_name,
+            "school_name": self._random.choice(SCHOOLS),
+            "staff_first_name": f"Staff{staff}",
+            "staff_last_name": "Member",
+            "ProgramStartDate": program_start,
+        }
+
+    def get_all_participants(self, start_date, end_date):
+        start = datetime.strptime(start_date, "%Y-%m-%d")
+        days = max((datetime.strptime(end_date, "%Y-%m-%d") - start).days, 0)
+
+        site_names = list(self.sites.values())
+        records = [
+            self._participant(
+                self.first_id + i, site_names[i % len(site_names)], start, days
+            )
+            for i in range(self.num_participants)
+        ]
+
+        # The real handler makes a search request per site, then a demographics
+        # and a touchpoint request per participant and a request per caseworker
+        self._request("SSOSiteLogin", len(self.sites))
+        self._request("Search", len(self.sites))
+        self._request("participant", self.num_participants)
+        self._request("ListTouchPointResponses", self.num_participants)
+        self._request("Staff", min(self.num_staff, self.num_participants))
+
+        return pd.DataFrame.from_records(records)
@@ -0,0 +1,82 @@
+"""
+A local stand-in for the `mailchimp3.MailChimp` client, implementing just the
+calls that `suso.email.send_email` makes. Emails are kept in `sent` rather than
+sent.
+
+  client = FakeMailChimp(latency=0.2)
+  email.send_email(client, "SUSO", "Hello")
+  client.sent  # [("SUSO", "Hello")]
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import itertools
+import time
+from collections import Counter
+
+
+class _Endpoint:
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def create(self, data):
+        return self._client._call(f"{self._name}.create", data)
+
+
+class _Campaigns(_Endpoint):
+    def __init__(self, client):
+        super().__init__(client, "campaigns")
+        self.actions = _CampaignActions(client)
+
+
+class _CampaignActions:
+    def __init__(self, client):
+        self._client = client
+
+    def send(self, campaign_id):
+        return self._client._call("campaigns.actions.send", campaign_id)
+
+
+class FakeMailChimp:
+    """
+    Pretend to be MailChimp.
+    """
+
+    def __init__(self, latency=0.0):
+        """
+        Args:
+          latency (float): Seconds each call takes
+        """
+        self.latency = latency
+        self.requests = Counter()
+        self.sent = []
+
+        self.templates = _Endpoint(self, "templates")
+        self.campaigns = _Campaigns(self)
+
+        self._ids = itertools.count(1)
+        self._templates = {}
+        self._campaigns = {}
+
+    def _call(self, endpoint, data):
+        self.requests[endpoint] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if endpoint == "templates.create":
+            template_id = next(self._ids)
+            self._templates[template_id] = data["html"]
+            return {"id": template_id}
+
+        if endpoint == "campaigns.create":
+            campaign_id = next(self._ids)
+            settings = data["settings"]
+            self._campaigns[campaign_id] = (
+                settings["subject_line"],
+                self._templates[settings["template_id"]],
+            )
+            return {"id": campaign_id}
+
+        # campaigns.actions.send
+        self.sent.append(self._campaigns[data])
+        return {}
@@ -0,0 +1,68 @@
+"""
+A local stand-in for `suso.render.render_templates` for machines without
+pdflatex. It writes a tiny (but distinct) PDF for each letter, waiting as long
+as pdflatex would take.
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import os
+import time
+
+from suso.fakes.click2mail import PROOF_PDF
+
+
+class FakeRenderer:
+    """
+    Called just like `suso.render.render_templates`.
+    """
+
+    def __init__(self, latency=0.0, fail=()):
+        """
+        Args:
+          latency (float): Seconds to take per letter
+          fail (iterable): Student ids of letters to fail to render, as pdflatex
+            might
+        """
+        self.latency = latency
+        self.fail = set(fail)
+        self.num_rendered = 0
+
+    def __call__(
+        self,
+        letters,
+        output_directory,
+        template_name=None,
+        pdf_output_directory=None,
+        cleanup=True,
+        skip_failures=False,
+        deadline=None,
+    ):
+        pdf_output_directory = pdf_output_directory or output_directory
+        os.makedirs(output_directory, exist_ok=True)
+        os.makedirs(pdf_output_directory, exist_ok=True)
+
+        letters = list(letters)
+        for letter in letters:
+            if not letter.cbo_name:
+                letter.render_error = f"No CBO for {letter.student_id}"
+        letters = [letter for letter in letters if letter.cbo_name]
+        for i, letter in enumerate(letters):
+            if deadline is not None and deadline.expired:
+                for later in letters[i:]:
+                    later.deferred = True
+                break
+            if self.latency:
+                time.sleep(self.latency)
+            key = letter.student_id
+            if key in self.fail:
+                message = f"Something went wrong rendering template {key}"
+                if not skip_failures:
+                    raise EnvironmentError(message)
+                letter.render_error = message
+                continue
+            # Make each letter's PDF different so Click2MailClient's document index
+            # doesn't treat them as the same document
+            letter.pdf_path = os.path.join(pdf_output_directory, f"{key}.pdf")
+            with open(letter.pdf_path, "wb") as f:
+                f.write(PROOF_PDF + f"% letter {key}\n".encode())
+            self.num_rendered += 1
@@ -0,0 +1,194 @@
+"""
+A write-ahead journal of the stages each letter passes through on its way to
+Click2Mail. Every time a call to Click2Mail succeeds we append a line to the
+journal (and fsync it) *before* moving on, so if the process dies halfway through
+a run the next run can pick up each letter from the last stage it completed
+instead of re-uploading documents and re-creating jobs.
+
+The journal is a plain JSON-lines file. Each line looks like::
+
+  {"key": "1234", "stage": "job_created", "value": 567890, "at": "2018-01-08 19:00:03"}
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import json
+import os
+from datetime import datetime
+
+DOCUMENT_UPLOADED = "document_uploaded"
+ADDRESS_LIST_CREATED = "address_list_created"
+JOB_CREATED = "job_created"
+SUBMITTED = "submitted"
+
+STAGES = (DOCUMENT_UPLOADED, ADDRESS_LIST_CREATED, JOB_CREATED, SUBMITTED)
+
+# Not a stage: marks that everything recorded for a letter should be forgotten
+RESET = "reset"
+
+
+class SubmissionJournal:
+    """
+    Keep track of how far along each letter (keyed by student id) is in the
+    Click2Mail submission process.
+
+    If `path` is None, the journal is kept only in memory. This is useful for
+    tests and for one-off submissions where resuming is not a concern.
+    """
+
+    def __init__(self, path=None):
+        """
+        Open (or create) the journal at `path`, replaying any entries already in it.
+
+        Args:
+          path (str|None): Where the journal lives on disk
+        """
+        self.path = path
+        self._entries = {}
+        self._file = None
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._replay()
+            self._file = open(path, "a")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return str(key) in self._entries
+
+    def _replay(self):
+        """
+        Read the entries currently on disk into memory. A partially written final
+        line (i.e., we died in the middle of a write) is ignored and cut off, so
+        that the next entry written starts on a line of its own.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            contents = f.read()
+        end = contents.rfind(b"\n") + 1
+        if end < len(contents):
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+
+        for line in contents[:end].decode().splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry["stage"] == RESET:
+                self._entries.pop(entry["key"], None)
+            else:
+                self._entries.setdefault(entry["key"], {})[entry["stage"]] = entry[
+                    "value"
+                ]
+
+    def _write(self, key, stage, value):
+        if not self._file:
+            return
+        entry = {
+            "key": key,
+            "stage": stage,
+            "value": value,
+            "at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, key, stage, value=None):
+        """
+        Durably record that the letter `key` has completed `stage`.
+
+        Args:
+          key (str|int): The key (student id) of the letter
+          stage (str): One of STAGES
+          value: Whatever the stage produced, e.g., the id of the uploaded document.
+            Must be JSON serializable.
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Unknown journal stage {stage}")
+
+        key = str(key)
+        self._write(key, stage, value)
+        self._entries.setdefault(key, {})[stage] = value
+
+    def reset(self, key):
+        """
+        Forget everything recorded about the letter `key`, so that the next attempt
+        to send it starts from scratch.
+
+        Args:
+          key (str|int): The key (student id) of the letter
+        """
+        key = str(key)
+        self._write(key, RESET, None)
+        self._entries.pop(key, None)
+
+    def get(self, key, stage, default=None):
+        """
+        Return the value recorded for `stage` of the letter `key`, or `default` if
+        that stage has not been completed.
+        """
+        return self._entries.get(str(key), {}).get(stage, default)
+
+    def has(self, key, stage):
+        """Has the letter `key` completed `stage`?"""
+        return stage in self._entries.get(str(key), {})
+
+    def last_stage(self, key):
+        """
+        Return the furthest stage the letter `key` has completed, or None if it
+        hasn't started.
+        """
+        completed = self._entries.get(str(key), {})
+        for stage in reversed(STAGES):
+            if stage in completed:
+                return stage
+        return None
+
+    def compact(self):
+        """
+        Rewrite the journal keeping only letters which have not yet been submitted.
+        Call this only once the submissions have been recorded in the database.
+        """
+        self._entries = {
+            key: stages
+            for key, stages in self._entries.items()
+            if SUBMITTED not in stages
+        }
+        if not self._file:
+            return
+
+        self._file.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for key, stages in self._entries.items():
+                for stage in STAGES:
+                    if stage in stages:
+                        f.write(
+                            json.dumps(
+                                {
+                                    "key": key,
+                                    "stage": stage,
+                                    "value": stages[stage],
+                                    "at": None,
+                                }
+                            )
+                            + "\n"
+                        )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a")
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
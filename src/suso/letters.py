@@ -0,0 +1,134 @@
+"""
+The letters of a run. Each treated student's letter is a `LetterRecord`, which
+the render and submit stages fill in as the letter goes through them (its pdf,
+its Click2Mail ids, whether it was sent), so that nothing has to be rebuilt or
+looked up by key between stages.
+
+Records use `__slots__`, so a season's worth takes a fraction of the memory the
+equivalent dicts would. In the saved stage outputs they are rows of a table::
+
+  {"fields": ["student_id", "cbo_name", ...], "rows": [[1234, "Example CBO", ...]]}
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+
+
+class LetterRecord:
+    """
+    One student's letter and how far it has got.
+    """
+
+    # What goes in the letter
+    letter_fields = (
+        "student_id",
+        "cbo_name",
+        "school",
+        "guardian",
+        "caseworker_name",
+        "address",
+        "zipcode",
+    )
+
+    # What the stages of the run have done with it
+    result_fields = (
+        "pdf_path",
+        "render_error",
+        "deferred",
+        "document_id",
+        "address_list_id",
+        "job_id",
+        "submitted",
+    )
+
+    __slots__ = letter_fields + result_fields
+
+    def __init__(
+        self,
+        student_id,
+        cbo_name=None,
+        school=None,
+        guardian=None,
+        caseworker_name=None,
+        address=None,
+        zipcode=None,
+    ):
+        self.student_id = student_id
+        self.cbo_name = cbo_name
+        self.school = school
+        self.guardian = guardian
+        self.caseworker_name = caseworker_name
+        self.address = address
+        self.zipcode = zipcode
+
+        self.pdf_path = None
+        self.render_error = None
+        self.deferred = False
+        self.document_id = None
+        self.address_list_id = None
+        self.job_id = None
+        self.submitted = False
+
+    @property
+    def rendered(self):
+        """Whether the letter has a pdf"""
+        return self.pdf_path is not None
+
+    def recipient(self):
+        """The letter's address in the form `Click2MailClient.post_recipients` wants"""
+        return {
+            "firstname": self.guardian,
+            "lastname": "",
+            "address": self.address,
+            "city": "Washington",
+            "state": "DC",
+            "zipcode": self.zipcode,
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, LetterRecord):
+            return NotImplemented
+        return all(
+            getattr(self, field) == getattr(other, field) for field in self.__slots__
+        )
+
+    def __repr__(self):
+        return "LetterRecord({})".format(
+            ", ".join(
+                f"{field}={getattr(self, field)!r}" for field in self.letter_fields
+            )
+        )
+
+
+def to_table(letters):
+    """
+    Turn letters into a JSON serializable table, e.g., for a stage's output.
+
+    Args:
+      letters (iterable[LetterRecord]): The letters
+
+    Returns:
+      dict: The names of the fields and a row of their values for each letter
+    """
+    return {
+        "fields": list(LetterRecord.__slots__),
+        "rows": [
+            [getattr(letter, field) for field in LetterRecord.__slots__]
+            for letter in letters
+        ],
+    }
+
+
+def from_table(table):
+    """
+    The inverse of `to_table`.
+
+    Returns:
+      list[LetterRecord]: The letters
+    """
+    letters = []
+    for row in table["rows"]:
+        letter = LetterRecord.__new__(LetterRecord)
+        for field, value in zip(table["fields"], row):
+            setattr(letter, field, value)
+        letters.append(letter)
+    return letters
@@ -0,0 +1,308 @@
+"""
+Metrics about a run for alerting, written in the Prometheus text format so that
+node_exporter's textfile collector can pick them up::
+
+  susocli run config.yml --metrics /var/lib/node_exporter/textfile/suso.prom
+
+The file is rewritten at the end of every run, whether or not the run succeeded,
+and describes just that run: whether it succeeded, letters sent and errors, how
+long each stage took, the number and latency of HTTP requests to each vendor
+endpoint, render failures, and rows read and written by the database. Every
+sample is labelled with the `tenant` it describes (the name of its config file),
+so that the files of tenants sharing a collector don't clash.
+
+HTTP requests are recorded by `eto.ApiHandler` and `click2mail.Click2MailClient`
+when they have `http_metrics` set to an `HttpMetrics`.
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+# The upper bounds of the buckets of the HTTP latency histograms, in seconds
+HTTP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Path segments which are names rather than ids, e.g., `Security.svc`
+_NAME_SEGMENT = re.compile(r"^[A-Za-z][A-Za-z._-]*$")
+
+
+def endpoint_label(*parts):
+    """
+    Turn the parts of a request's path into a label with the ids taken out, so
+    that, e.g., every job's submit shares the label `jobs/{id}/submit`.
+    """
+    segments = []
+    for part in parts:
+        for segment in str(part).split("/"):
+            if segment:
+                segments.append(segment if _NAME_SEGMENT.match(segment) else "{id}")
+    return "/".join(segments)
+
+
+class HttpMetrics:
+    """
+    Counts and latencies of HTTP requests by vendor, endpoint, method and status.
+    Safe to share between threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        # (vendor, endpoint) -> [count, total seconds, count in each bucket]
+        self.latencies = {}
+
+    def record(self, vendor, method, endpoint, status, seconds):
+        """
+        Record a request.
+
+        Args:
+          vendor (str): E.g., eto or click2mail
+          method (str): The HTTP method
+          endpoint (str): The endpoint, as returned by `endpoint_label`
+          status (int|str): The HTTP status, or, e.g., "error" if there wasn't one
+          seconds (float): How long the request took
+        """
+        with self._lock:
+            self.requests[(vendor, endpoint, method.upper(), str(status))] += 1
+            latency = self.latencies.setdefault(
+                (vendor, endpoint), [0, 0.0, [0] * len(HTTP_BUCKETS)]
+            )
+            latency[0] += 1
+            latency[1] += seconds
+            for i, bound in enumerate(HTTP_BUCKETS):
+                if seconds <= bound:
+                    latency[2][i] += 1
+
+    def timed(self, vendor, method, endpoint, request):
+        """
+        Call `request()`, recording how long it took and the status of the response
+        it returns. Exceptions are recorded with status "error" and re-raised.
+        """
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = request()
+            status = response.status_code
+            return response
+        finally:
+            self.record(vendor, method, endpoint, status, time.perf_counter() - start)
+
+
+def _labels(**labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for key, value in labels.items()
+        )
+    )
+
+
+class RunMetrics:
+    """
+    Everything the metrics file reports about a run.
+    """
+
+    def __init__(self, tenant=None):
+        """
+        Args:
+          tenant (str|None): The tenant to label every sample with
+        """
+        self.tenant = tenant
+        self.http = HttpMetrics()
+        self.started_at = time.time()
+        self.success = False
+        self.letters_submitted = 0
+        self.letter_errors = 0
+        self.letters_deferred = 0
+        self.render_failures = 0
+        self.table_rows = {}
+
+    def to_text(self, profiler=None, query_metrics=None):
+        """
+        Render the metrics in the Prometheus text format.
+
+        Args:
+          profiler (profiling.Profiler|None): For the stage durations
+          query_metrics (database.QueryMetrics|None): For the database statistics
+
+        Returns:
+          str: The metrics
+        """
+        lines = []
+
+        def labels(**names):
+            if self.tenant is None:
+                return _labels(**names)
+            return _labels(tenant=self.tenant, **names)
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        metric(
+            "suso_run_start_timestamp_seconds",
+            "gauge",
+            "When the last run started",
+            [(labels(), f"{self.started_at:.3f}")],
+        )
+        metric(
+            "suso_run_end_timestamp_seconds",
+            "gauge",
+            "When the last run ended",
+            [(labels(), f"{time.time():.3f}")],
+        )
+        metric(
+            "suso_run_success",
+            "gauge",
+            "Whether the last run finished without an error",
+            [(labels(), int(self.success))],
+        )
+        metric(
+            "suso_letters_submitted",
+            "gauge",
+            "Letters submitted to Click2Mail in the last run",
+            [(labels(), self.letters_submitted)],
+        )
+        metric(
+            "suso_letter_errors",
+            "gauge",
+            "Letters which failed to submit in the last run",
+            [(labels(), self.letter_errors)],
+        )
+        metric(
+            "suso_letters_deferred",
+            "gauge",
+            "Letters left for the next run because the last run ran out of time",
+            [(labels(), self.letters_deferred)],
+        )
+        metric(
+            "suso_render_failures",
+            "gauge",
+            "Letters which failed to render in the last run",
+            [(labels(), self.render_failures)],
+        )
+
+        if profiler is not None:
+            metric(
+                "suso_stage_duration_seconds",
+                "gauge",
+                "Wall clock time of each stage of the last run",
+                [
+                    (labels(stage=stage.name), f"{stage.wall_seconds or 0:.3f}")
+                    for stage in profiler.stages
+                ],
+            )
+            metric(
+                "suso_stage_failed",
+                "gauge",
+                "Whether each stage of the last run raised an error",
+                [
+                    (labels(stage=stage.name), int(stage.error is not None))
+                    for stage in profiler.stages
+                ],
+            )
+
+        with self.http._lock:
+            requests = sorted(self.http.requests.items())
+            latencies = sorted(
+                (key, (count, total, list(buckets)))
+                for key, (count, total, buckets) in self.http.latencies.items()
+            )
+        metric(
+            "suso_http_requests",
+            "gauge",
+            "HTTP requests made in the last run by vendor, endpoint, method and status",
+            [
+                (
+                    labels(vendor=vendor, endpoint=endpoint, method=method, code=code),
+                    count,
+                )
+                for (vendor, endpoint, method, code), count in requests
+            ],
+        )
+        samples = []
+        for (vendor, endpoint), (count, total, buckets) in latencies:
+            for bound, bucket_count in zip(HTTP_BUCKETS, buckets):
+                samples.append(
+                    (
+                        "_bucket"
+                        + labels(vendor=vendor, endpoint=endpoint, le=str(bound)),
+                        bucket_count,
+                    )
+                )
+            samples.append(
+                (
+                    "_bucket" + labels(vendor=vendor, endpoint=endpoint, le="+Inf"),
+                    count,
+                )
+            )
+            samples.append(
+                ("_sum" + labels(vendor=vendor, endpoint=endpoint), f"{total:.3f}")
+            )
+            samples.append(("_count" + labels(vendor=vendor, endpoint=endpoint), count))
+        metric(
+            "suso_http_request_duration_seconds",
+            "histogram",
+            "Latency of HTTP requests in the last run by vendor and endpoint",
+            samples,
+        )
+
+        if query_metrics is not None:
+            totals = query_metrics.to_dict()
+            stats = totals["statements"]
+            metric(
+                "suso_db_statements",
+                "gauge",
+                "SQL statements executed in the last run",
+                [(labels(), totals["executions"])],
+            )
+            metric(
+                "suso_db_seconds",
+                "gauge",
+                "Time spent in SQL in the last run",
+                [(labels(), f"{totals['seconds']:.3f}")],
+            )
+            metric(
+                "suso_db_rows_fetched",
+                "gauge",
+                "Rows read from the database in the last run",
+                [(labels(), sum(stat["rows_fetched"] for stat in stats))],
+            )
+            metric(
+                "suso_db_rows_affected",
+                "gauge",
+                "Rows written to the database in the last run",
+                [(labels(), sum(stat["rows_affected"] for stat in stats))],
+            )
+
+        if self.table_rows:
+            metric(
+                "suso_db_table_rows",
+                "gauge",
+                "Rows in each table at the end of the last run",
+                [
+                    (labels(table=table), count)
+                    for table, count in sorted(self.table_rows.items())
+                ],
+            )
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, profiler=None, query_metrics=None):
+        """
+        Write the metrics to `path`. The file is replaced atomically so that the
+        collector never reads half of it.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            f.write(self.to_text(profiler, query_metrics))
+        os.replace(path + ".tmp", path)
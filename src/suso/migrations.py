@@ -0,0 +1,260 @@
+"""
+Versioned changes to the schema of the SUSO tables. `susocli create` sets up the
+tables themselves; everything after that (indexes, constraints, new tables) goes
+here as a numbered `Migration`. Which migrations have been applied is recorded in
+MIGRATIONS_TABLE, so `susocli migrate` only ever applies each one once.
+
+To add a migration, append it to MIGRATIONS with the next version number. Never
+edit or reorder a migration that has already been applied somewhere.
+
+This module also knows which queries are hot and which indexes they ought to
+use, so that `susocli plans` can check the query plans.
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+from collections import namedtuple
+
+from suso import backends
+from suso import database as db
+
+MIGRATIONS_TABLE = "schema_migrations"
+
+# Each of `statements` is either SQL or a function which takes a cursor
+Migration = namedtuple("Migration", ("version", "description", "statements"))
+
+
+def _cover_good_records(curs):
+    """
+    Replace the index of good records with one which also carries the columns
+    the balance query reads, so that it never touches the table
+    """
+    backend = backends.backend_for(curs)
+    curs.execute(
+        backend.create_covering_index(
+            "ix_students_new_good_records_covering",
+            db.STUDENTS_TABLE,
+            ("id",),
+            # SQLite only counts the index as covering if it has the filtered column
+            ("cbo", "school", "enrolled_date", "is_good_record"),
+            where="is_good_record = 1",
+        )
+    )
+    curs.execute(backend.drop_index("ix_students_new_good_records", db.STUDENTS_TABLE))
+
+
+MIGRATIONS = (
+    Migration(
+        version=1,
+        description="Index the columns the run and stats queries filter and join on",
+        statements=(
+            f"""CREATE INDEX ix_students_new_enrolled_date
+                ON {db.STUDENTS_TABLE} (enrolled_date)""",
+            f"""CREATE INDEX ix_students_new_good_records
+                ON {db.STUDENTS_TABLE} (id) WHERE is_good_record = 1""",
+            f"""CREATE INDEX ix_randomizer_new_is_treatment
+                ON {db.RANDOMIZER_TABLE} (is_treatment, student_id)""",
+            f"""CREATE INDEX ix_status_new_status_student
+                ON {db.STATUS_TABLE} (status, student_id)""",
+            f"""CREATE INDEX ix_jobs_new_student_id
+                ON {db.JOBS_TABLE} (student_id)""",
+            f"""CREATE INDEX ix_mailings_new_job_status
+                ON {db.MAILINGS_TABLE} (job_id, status)""",
+        ),
+    ),
+    Migration(
+        version=2,
+        description="Materialize the counts of students by enrollment month and day",
+        statements=(
+            f"""CREATE TABLE {db.ENROLLMENT_BY_MONTH_TABLE} (
+                  the_year INTEGER NOT NULL,
+                  the_month INTEGER NOT NULL,
+                  num_students INTEGER NOT NULL,
+                  PRIMARY KEY (the_year, the_month)
+                )""",
+            f"""CREATE TABLE {db.ENROLLMENT_BY_DAY_TABLE} (
+                  enrolled_date NVARCHAR(32) NOT NULL PRIMARY KEY,
+                  num_students INTEGER NOT NULL
+                )""",
+            db.rebuild_enrollment_stats,
+        ),
+    ),
+    Migration(
+        version=3,
+        description="Add views of the latest job per student and mailing per job",
+        statements=(
+            f"""CREATE INDEX ix_mailings_new_job_datetime
+                ON {db.MAILINGS_TABLE} (job_id, status_datetime, id)""",
+            f"""CREATE VIEW {db.LATEST_JOBS_VIEW} AS
+                SELECT id, student_id, created_at
+                  FROM (
+                    SELECT id, student_id, created_at,
+                           ROW_NUMBER() OVER (
+                             PARTITION BY student_id
+                             ORDER BY created_at DESC, id DESC
+                           ) AS row_num
+                      FROM {db.JOBS_TABLE}
+                  ) ranked
+                 WHERE row_num = 1""",
+            f"""CREATE VIEW {db.LATEST_MAILINGS_VIEW} AS
+                SELECT job_id, status, status_datetime
+                  FROM (
+                    SELECT job_id, status, status_datetime,
+                           ROW_NUMBER() OVER (
+                             PARTITION BY job_id
+                             ORDER BY status_datetime DESC, id DESC
+                           ) AS row_num
+                      FROM {db.MAILINGS_TABLE}
+                  ) ranked
+                 WHERE row_num = 1""",
+        ),
+    ),
+    Migration(
+        version=4,
+        description="Cover the columns the balance query reads from good records",
+        statements=(_cover_good_records,),
+    ),
+)
+
+QueryCheck = namedtuple("QueryCheck", ("name", "sql", "params", "expected_indexes"))
+
+HOT_QUERIES = (
+    QueryCheck(
+        "latest enrollment",
+        db.LATEST_ENROLLMENT_QUERY,
+        (),
+        {"ix_students_new_enrolled_date"},
+    ),
+    QueryCheck(
+        "unrandomized students",
+        db.UNRANDOMIZED_STUDENTS_QUERY,
+        (),
+        {"ix_students_new_good_records_covering"},
+    ),
+    QueryCheck(
+        "randomized students",
+        db.RANDOMIZED_STUDENTS_QUERY,
+        (),
+        {"ix_students_new_good_records_covering"},
+    ),
+    QueryCheck(
+        "unsent treatment students",
+        db.UNSENT_TREATMENT_STUDENTS_QUERY,
+        (),
+        {"ix_status_new_status_student", "ix_randomizer_new_is_treatment"},
+    ),
+)
+
+
+def _create_migrations_table(curs):
+    db._create_table_if_not_exists(
+        curs,
+        MIGRATIONS_TABLE,
+        "version INTEGER PRIMARY KEY",
+        "description NVARCHAR(1024)",
+        f"applied_at DATETIME NOT NULL DEFAULT {backends.backend_for(curs).now}",
+    )
+
+
+def applied_versions(curs):
+    """
+    Return the versions of the migrations which have already been applied.
+
+    Args:
+      curs: A cursor into the SUSO database
+
+    Returns:
+      set[int]: The applied versions
+    """
+    _create_migrations_table(curs)
+    curs.execute(f"""SELECT version FROM {MIGRATIONS_TABLE}""")
+    return {row[0] for row in curs.fetchall()}
+
+
+def pending_migrations(curs, migrations=MIGRATIONS):
+    """Return the migrations that have not yet been applied, in order"""
+    applied = applied_versions(curs)
+    return [
+        migration
+        for migration in sorted(migrations, key=lambda m: m.version)
+        if migration.version not in applied
+    ]
+
+
+def migrate(conn, migrations=MIGRATIONS, target=None):
+    """
+    Apply every pending migration (up to and including `target`, if passed). Each
+    migration is applied and recorded in its own transaction, so a failure leaves
+    the database at the last migration which succeeded.
+
+    Args:
+      conn: A connection to the SUSO database
+      migrations (iterable[Migration]): The migrations to consider
+      target (int|None): The last version to apply
+
+    Returns:
+      list[Migration]: The migrations that were applied
+    """
+    curs = conn.cursor()
+    backend = backends.backend_for(curs)
+    pending = pending_migrations(curs, migrations)
+    conn.commit()
+
+    applied = []
+    for migration in pending:
+        if target is not None and migration.version > target:
+            break
+        try:
+            backend.begin(curs)
+            for statement in migration.statements:
+                if callable(statement):
+                    statement(curs)
+                else:
+                    curs.execute(statement)
+            curs.execute(
+                f"""
+        INSERT INTO {MIGRATIONS_TABLE}
+            (version, description)
+        VALUES
+            (?, ?)
+      """,
+                (migration.version, migration.description),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            curs.close()
+            raise
+        applied.append(migration)
+
+    curs.close()
+    return applied
+
+
+def indexes_used(curs, sql, params=()):
+    """
+    Ask the database for the plan it would use for `sql` (without running it) and
+    return the names of the indexes the plan touches.
+
+    Args:
+      curs: A cursor into the SUSO database
+      sql (str): The query
+      params (tuple): Parameters for the query
+
+    Returns:
+      set[str]: The names of the indexes in the plan
+    """
+    return backends.backend_for(curs).indexes_used(curs, sql, params)
+
+
+def check_query_plans(curs, queries=HOT_QUERIES):
+    """
+    For each of the hot queries, find which indexes its plan uses.
+
+    Args:
+      curs: A cursor into the SUSO database
+      queries (iterable[QueryCheck]): The queries to check
+
+    Returns:
+      list[tuple[QueryCheck, set[str]]]: Each query with the indexes its plan uses
+    """
+    return [(query, indexes_used(curs, query.sql, query.params)) for query in queries]
@@ -0,0 +1,128 @@
+"""
+Turn the participants we pull from ETO into the rows we store, and the students
+we store into the data for their letters. Everything here works on whole columns
+at a time, since a busy night can bring in tens of thousands of participants.
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import pandas as pd
+
+from suso import database as db
+from suso import render
+from suso.letters import LetterRecord
+
+# The columns which must all be present for a participant's record to be good
+REQUIRED_COLUMNS = (
+    "guardian_firstname",
+    "guardian_lastname",
+    "FName",
+    "LName",
+    "address",
+    "zipcode",
+)
+
+# ETO's names for the columns of STUDENTS_TABLE
+ETO_TO_STUDENT_COLUMNS = {
+    "CLID": "id",
+    "FName": "firstname",
+    "LName": "lastname",
+    "address": "address",
+    "zipcode": "zipcode",
+    "guardian_firstname": "guardian_firstname",
+    "guardian_lastname": "guardian_lastname",
+    "site_name": "cbo",
+    "school_name": "school",
+    "referral_date": "enrolled_date",
+}
+
+
+def latest_referrals(participants):
+    """
+    Keep just the latest referral of each participant.
+
+    Args:
+      participants (pd.DataFrame): Participants as returned by
+        `eto.ApiHandler.get_all_participants` with a `referral_date` column
+
+    Returns:
+      pd.DataFrame: One row per CLID
+    """
+    return participants.sort_values(
+        by="referral_date", ascending=False
+    ).drop_duplicates("CLID")
+
+
+def student_rows(participants):
+    """
+    Convert participants from ETO into rows for STUDENTS_TABLE. Participants who
+    are missing any of REQUIRED_COLUMNS are kept but marked as bad records.
+
+    Args:
+      participants (pd.DataFrame): Participants with a `referral_date` column,
+        one row per CLID
+
+    Returns:
+      pd.DataFrame: The rows, with the columns in STUDENT_COLUMNS
+    """
+    students = participants[list(ETO_TO_STUDENT_COLUMNS)].rename(
+        columns=ETO_TO_STUDENT_COLUMNS
+    )
+
+    has_caseworker = (
+        participants.staff_first_name.notnull() & participants.staff_last_name.notnull()
+    )
+    students["caseworker"] = (
+        participants.staff_first_name + " " + participants.staff_last_name
+    ).where(has_caseworker, None)
+
+    is_good_record = participants[list(REQUIRED_COLUMNS)].notnull().all(axis=1)
+    students["is_good_record"] = is_good_record.astype(int)
+
+    return students[list(db.STUDENT_COLUMNS)]
+
+
+def fix_caseworkers(df):
+    """
+    Fix the known problems with caseworker names: placeholder "User" accounts at
+    Far Southeast are replaced with its default contact, and digits are stripped.
+
+    Args:
+      df (pd.DataFrame): Students with `caseworker` and `cbo` columns
+
+    Returns:
+      pd.Series: The fixed caseworker names
+    """
+    caseworker = df.caseworker
+    far_southeast = render.CBOs.get("Far Southeast")
+    if far_southeast is not None:
+        is_placeholder = caseworker.str.startswith(
+            "User", na=False
+        ) & df.cbo.str.startswith("Far South", na=False)
+        caseworker = caseworker.mask(is_placeholder, far_southeast.default_contact)
+    return caseworker.str.replace(r"\d", "", regex=True)
+
+
+def letter_records(df):
+    """
+    Build the letters to the treated students in `df`.
+
+    Args:
+      df (pd.DataFrame): Students with the columns in LETTER_COLUMNS
+
+    Returns:
+      list[LetterRecord]: A letter for each treated student
+    """
+    treated = df[df.is_treatment > 0]
+    guardians = treated.guardian_firstname + " " + treated.guardian_lastname
+    return [
+        LetterRecord(*fields)
+        for fields in zip(
+            treated.id.tolist(),
+            treated.cbo.tolist(),
+            treated.school.tolist(),
+            guardians.tolist(),
+            treated.caseworker.tolist(),
+            treated.address.tolist(),
+            treated.zipcode.tolist(),
+        )
+    ]
@@ -0,0 +1,188 @@
+"""
+Time the stages of a run. Wrap each stage in `profiler.stage(name)` and the
+profiler records its wall clock time, CPU time (our own and that of any
+subprocesses, e.g., pdflatex), the peak RSS of the process when it finished, and
+whatever counts the stage reports. Optionally each stage is also run under
+cProfile.
+
+  profiler = Profiler()
+  with profiler.stage("render") as stage:
+      render_templates(data)
+      stage.count("letters", len(data))
+  profiler.write("profile.json")
+
+A disabled Profiler still times its stages. It just doesn't write anything or
+run cProfile.
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+
+def _cpu_seconds():
+    """Return (our CPU seconds, our subprocesses' CPU seconds)"""
+    if resource is None:
+        return time.process_time(), 0.0
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        own.ru_utime + own.ru_stime,
+        children.ru_utime + children.ru_stime,
+    )
+
+
+def peak_rss_mb():
+    """The peak resident set size of this process so far, in MB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+class Stage:
+    """
+    The measurements of one stage of a run.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = {}
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.child_cpu_seconds = None
+        self.peak_rss_mb = None
+        self.error = None
+        self.top_functions = None
+
+    def count(self, name, value):
+        """Record a count (e.g., the number of letters rendered) for the stage"""
+        self.counts[name] = value
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "child_cpu_seconds": self.child_cpu_seconds,
+            "peak_rss_mb": self.peak_rss_mb,
+            "counts": self.counts,
+            "error": self.error,
+            "top_functions": self.top_functions,
+        }
+
+
+class Profiler:
+    """
+    Collect the measurements of each stage of a run.
+    """
+
+    def __init__(self, enabled=True, cprofile=False, cprofile_directory=None):
+        """
+        Args:
+          enabled (bool): Whether `write` should actually write the report
+          cprofile (bool): Whether to run each stage under cProfile
+          cprofile_directory (str|None): If passed (and `cprofile` is set), dump
+            each stage's raw cProfile stats to `<name>.prof` here, for use with,
+            e.g., snakeviz
+        """
+        self.enabled = enabled
+        self.cprofile = enabled and cprofile
+        self.cprofile_directory = cprofile_directory
+        self.stages = []
+        self.started_at = datetime.now()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        A context manager measuring the stage `name`. Yields the `Stage`, on which
+        counts may be recorded. If the stage raises, the error is recorded and
+        re-raised.
+        """
+        stage = Stage(name)
+        self.stages.append(stage)
+
+        profile = cProfile.Profile() if self.cprofile else None
+        cpu_start, child_cpu_start = _cpu_seconds()
+        wall_start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield stage
+        except BaseException as e:
+            stage.error = repr(e)
+            raise
+        finally:
+            if profile is not None:
+                profile.disable()
+            stage.wall_seconds = time.perf_counter() - wall_start
+            cpu_end, child_cpu_end = _cpu_seconds()
+            stage.cpu_seconds = cpu_end - cpu_start
+            stage.child_cpu_seconds = child_cpu_end - child_cpu_start
+            stage.peak_rss_mb = peak_rss_mb()
+            if profile is not None:
+                self._save_profile(stage, profile)
+
+    def _save_profile(self, stage, profile):
+        output = io.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats("cumulative").print_stats(20)
+        stage.top_functions = output.getvalue()
+        if self.cprofile_directory:
+            os.makedirs(self.cprofile_directory, exist_ok=True)
+            stats.dump_stats(
+                os.path.join(self.cprofile_directory, f"{stage.name}.prof")
+            )
+
+    def to_dict(self):
+        return {
+            "started_at": self.started_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "wall_seconds": sum(stage.wall_seconds or 0 for stage in self.stages),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": [stage.to_dict() for stage in self.stages],
+        }
+
+    def summary(self):
+        """A plain text table of the stages"""
+        lines = [
+            "{:<12} {:>9} {:>9} {:>9} {:>9}  {}".format(
+                "stage", "wall (s)", "cpu (s)", "child (s)", "rss (MB)", "counts"
+            )
+        ]
+        for stage in self.stages:
+            lines.append(
+                "{:<12} {:>9.2f} {:>9.2f} {:>9.2f} {:>9}  {}".format(
+                    stage.name,
+                    stage.wall_seconds or 0,
+                    stage.cpu_seconds or 0,
+                    stage.child_cpu_seconds or 0,
+                    "-" if stage.peak_rss_mb is None else f"{stage.peak_rss_mb:.0f}",
+                    ", ".join(f"{key}={value}" for key, value in stage.counts.items()),
+                )
+            )
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Write the report to `path` as JSON, if the profiler is enabled"""
+        if not self.enabled:
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
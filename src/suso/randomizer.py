@@ -0,0 +1,193 @@
+"""
+Assign students to treatment or control.
+
+An assignment is a pure function of the student's id and a secret key, so it
+needs no global state: any number of runs or ingestion workers can randomize at
+the same time and will always agree, and re-randomizing a student always gives
+the same answer. Two methods are available:
+
+  * HASHED: each student is treated if a keyed hash of their id is odd. Simple,
+    but the arms drift apart like coin flips (by about sqrt(n)).
+  * BLOCKED (the default): the id space is cut into consecutive blocks of
+    `block_size` ids, and within each block exactly half of the ids, chosen by
+    the keyed hash, are treated. The arms only come out exactly balanced among
+    students whose ids fill whole blocks; students who enroll are a sparse
+    subset of the ids, so among them the arms can still drift apart.
+
+The key must be set in the `randomizer` section of the config and never changed
+once the study has started::
+
+  randomizer:
+    key: some long random string
+    method: blocked
+    block_size: 16
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import hashlib
+import hmac
+import math
+from collections import namedtuple
+
+HASHED = "hashed"
+BLOCKED = "blocked"
+METHODS = (HASHED, BLOCKED)
+
+DEFAULT_BLOCK_SIZE = 16
+
+
+class Randomizer:
+    """
+    Deterministically assign students to treatment or control.
+    """
+
+    def __init__(self, key, method=BLOCKED, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Args:
+          key (str): The secret key for the hash
+          method (str): One of METHODS
+          block_size (int): For BLOCKED, the number of consecutive ids in a block.
+            Must be even.
+        """
+        if method not in METHODS:
+            raise ValueError(
+                "Unknown randomization method {}; expected one of {}".format(
+                    method, ", ".join(METHODS)
+                )
+            )
+        if method == BLOCKED and (block_size < 2 or block_size % 2):
+            raise ValueError("block_size must be a positive even number")
+
+        self.key = key.encode("utf8")
+        self.method = method
+        self.block_size = block_size
+        self._treated_by_block = {}
+
+    def _hash(self, student_id):
+        digest = hmac.new(
+            self.key, str(int(student_id)).encode("utf8"), hashlib.sha256
+        ).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def _treated_in_block(self, block):
+        treated = self._treated_by_block.get(block)
+        if treated is None:
+            ids = range(block * self.block_size, (block + 1) * self.block_size)
+            ranked = sorted(
+                ids, key=lambda student_id: (self._hash(student_id), student_id)
+            )
+            treated = self._treated_by_block[block] = frozenset(
+                ranked[: self.block_size // 2]
+            )
+        return treated
+
+    def is_treatment(self, student_id):
+        """Is the student with id `student_id` in the treatment group?"""
+        student_id = int(student_id)
+        if self.method == HASHED:
+            return bool(self._hash(student_id) & 1)
+        return student_id in self._treated_in_block(student_id // self.block_size)
+
+    def assign(self, student_ids):
+        """
+        Assign each of `student_ids`.
+
+        Returns:
+          list[bool]: Whether each student is in the treatment group
+        """
+        return [self.is_treatment(student_id) for student_id in student_ids]
+
+
+def from_config(config):
+    """
+    Build the Randomizer described by the `randomizer` section of the config.
+
+    Args:
+      config (dict): The full config
+
+    Returns:
+      Randomizer: The randomizer
+
+    Raises:
+      ValueError: If the section doesn't set a `key`. Anyone who knew a default
+        key could tell which students are treated.
+    """
+    section = config.get("randomizer") or {}
+    if not section.get("key"):
+        raise ValueError("Set a secret key in the randomizer section of the config")
+    return Randomizer(
+        key=section["key"],
+        method=section.get("method", BLOCKED),
+        block_size=section.get("block_size", DEFAULT_BLOCK_SIZE),
+    )
+
+
+ArmBalance = namedtuple(
+    "ArmBalance", ("stratum", "num_treatment", "num_control", "z", "p_value")
+)
+
+
+def _arm_balance(stratum, num_treatment, num_control):
+    """
+    Compare the arm sizes to what a fair 50/50 assignment would give, using the
+    normal approximation to the binomial.
+    """
+    n = num_treatment + num_control
+    if n == 0:
+        return ArmBalance(stratum, 0, 0, 0.0, 1.0)
+    z = (num_treatment - n / 2) / math.sqrt(n / 4)
+    return ArmBalance(
+        stratum, num_treatment, num_control, z, math.erfc(abs(z) / math.sqrt(2))
+    )
+
+
+def balance(assignments, strata=None):
+    """
+    Check how balanced the arms are, overall and within each stratum.
+
+    Args:
+      assignments (iterable[bool]): Whether each student is treated
+      strata (iterable|None): The stratum (e.g., CBO or enrollment month) of each
+        student, in the same order
+
+    Returns:
+      list[ArmBalance]: The overall balance (with stratum None) followed by the
+        balance in each stratum, sorted by stratum
+    """
+    assignments = [bool(is_treatment) for is_treatment in assignments]
+    num_treatment = sum(assignments)
+    results = [_arm_balance(None, num_treatment, len(assignments) - num_treatment)]
+
+    if strata is not None:
+        counts = {}
+        for stratum, is_treatment in zip(strata, assignments):
+            treated_and_control = counts.setdefault(stratum, [0, 0])
+            treated_and_control[0 if is_treatment else 1] += 1
+        for stratum in sorted(counts, key=str):
+            results.append(_arm_balance(stratum, *counts[stratum]))
+
+    return results
+
+
+def balance_report(results, alpha=0.05):
+    """
+    Render the output of `balance` as a plain text table, marking any stratum
+    whose imbalance is significant at level `alpha`.
+    """
+    lines = [
+        "{:<30} {:>9} {:>9} {:>7} {:>7}".format(
+            "stratum", "treatment", "control", "z", "p"
+        )
+    ]
+    for result in results:
+        lines.append(
+            "{:<30} {:>9} {:>9} {:>7.2f} {:>7.3f}{}".format(
+                "(all)" if result.stratum is None else str(result.stratum)[:30],
+                result.num_treatment,
+                result.num_control,
+                result.z,
+                result.p_value,
+                " *" if result.p_value < alpha else "",
+            )
+        )
+    return "\n".join(lines)
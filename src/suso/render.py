@@ -4,10 +4,13 @@ import re
 import shutil
 import subprocess
 from collections import namedtuple
+from datetime import date, datetime
 from pathlib import Path
 
 import jinja2
 
+from suso.deadline import DeadlineExceeded
+
 TEMPLATE_DIR = Path(__file__).parent.absolute() / "templates"
 IMAGE_DIR = TEMPLATE_DIR / "images"
 
@@ -127,30 +130,37 @@ def get_latex_env(template_dir=TEMPLATE_DIR):
 
 
 def render_templates(
-    data,
+    letters,
     output_directory,
     template_name="template.tex.j2",
     pdf_output_directory=None,
     cleanup=True,
+    skip_failures=False,
+    deadline=None,
 ):
     """
     Render a single template (named `template_name`), which is in `template_dir`
-    multiple times according to the dictionary `data`. The output will be stored in
-    `output_directory` by the name {key}.tex where the keys iterate over the keys of
-    data.
+    once for each of `letters`. The output will be stored in `output_directory` by
+    the name {student_id}.tex.
 
     Finally, this will also run pdflatex on the output tex files and leave pdfs in the
-    output directory as well.
+    output directory as well. How each letter went is recorded on it: `pdf_path`
+    once its pdf is made, `render_error` if it couldn't be rendered, and `deferred`
+    if `deadline` passed before its turn.
 
     Args:
       template_dir (str): The template directory
-      data (dict[str, dict[str, str]]): The dictionary from filename to the keys to
-        fill in in the template
+      letters (iterable[letters.LetterRecord]): The letters to render
       output_directory (str): Where to store the rendered templates and pdfs
       template_name (str): The name of the template to render
       pdf_output_directory (str|None): If passed, will move rendered pdfs
         to this directory
       cleanup (bool): If True, will remove tex cruft from rendering
+      skip_failures (bool): If True, a letter pdflatex fails on is given a
+        `render_error` and skipped rather than stopping the whole batch
+      deadline (deadline.Deadline|None): If passed, each pdflatex call is killed
+        once it takes longer than the deadline allows, and the letters not
+        reached before it passes are marked `deferred`
 
     Side effects:
       Creates many files on the hard drive in `output_directory`
@@ -166,17 +176,17 @@ def render_templates(
 
     # Write all the templates
     templates_rendered = []
-    for key, datum in data.items():
+    for letter in letters:
 
         # If there is no CBO, just ignore it
-        if not datum["cbo_name"]:
+        if not letter.cbo_name:
+            letter.render_error = f"No CBO for {letter.student_id}"
             continue
-        templates_rendered.append(key)
+        templates_rendered.append(letter)
 
         # Render the template in memory
-        cbo_name = datum["cbo_name"]
-        # from IPython.core.debugger import Tracer; Tracer()()
-        school_name = get_official_school_name(datum.get("school"))
+        cbo_name = letter.cbo_name
+        school_name = get_official_school_name(letter.school)
         rendered = template.render(
             school_image=get_image_from_school_name(school_name),
             cbo_image=get_image_from_cbo_name(cbo_name),
@@ -184,36 +194,69 @@ def render_templates(
             cbo_zipcode=get_zipcode_from_cbo_name(cbo_name),
             contact_number=get_phone_from_cbo_name(cbo_name),
             cbo_name=get_fullname_from_cbo_name(cbo_name),
-            caseworker_name=datum["caseworker_name"]
+            caseworker_name=letter.caseworker_name
             or get_default_contact_from_cbo_name(cbo_name),
-            guardian=datum["guardian"],
+            guardian=letter.guardian,
             school=school_name,
         )
 
         # Write the template out to disk
         with open(
-            os.path.join(output_directory, "{key}.tex".format(key=key)), "w"
+            os.path.join(output_directory, "{}.tex".format(letter.student_id)), "w"
         ) as f:
             f.write(rendered)
 
+    # Pin the timestamps pdflatex embeds in the pdf to the start of today so that
+    # re-rendering a letter on the same day produces an identical file (which
+    # Click2MailClient can then avoid uploading twice). The letter's own date
+    # still comes from the clock.
+    today = datetime.combine(date.today(), datetime.min.time())
+    pdflatex_env = dict(os.environ, SOURCE_DATE_EPOCH=str(int(today.timestamp())))
+
     # Render all the pdfs
-    for key in data:
+    for i, letter in enumerate(templates_rendered):
+        try:
+            timeout = deadline and deadline.timeout()
+        except DeadlineExceeded:
+            for later in templates_rendered[i:]:
+                later.deferred = True
+            break
+
+        key = letter.student_id
+        # In its default mode, pdflatex stops and waits for input on an error
         p = subprocess.Popen(
-            ["pdflatex", "{key}".format(key=key)], cwd=output_directory
+            ["pdflatex", "-interaction=nonstopmode", "{key}".format(key=key)],
+            cwd=output_directory,
+            env=pdflatex_env,
+            stdin=subprocess.DEVNULL,
         )
-        p.wait()
+        try:
+            p.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            pass
+        finally:
+            # Never leave a pdflatex running behind us, however the wait ended
+            timed_out = p.returncode is None
+            if timed_out:
+                p.kill()
+                p.wait()
+        if timed_out and deadline.expired:
+            for later in templates_rendered[i:]:
+                later.deferred = True
+            break
         if p.returncode:
-            raise EnvironmentError(
-                "Something went wrong rendering template {key}".format(key=key)
-            )
+            message = "Something went wrong rendering template {key}".format(key=key)
+            if not skip_failures:
+                raise EnvironmentError(message)
+            letter.render_error = message
+            continue
 
         # If passed, separate out the pdfs
+        pdf_name = "{}.pdf".format(key)
+        letter.pdf_path = os.path.join(output_directory, pdf_name)
         if pdf_output_directory:
-            pdf_name = "{}.pdf".format(key)
-            shutil.move(
-                os.path.join(output_directory, pdf_name),
-                os.path.join(pdf_output_directory, pdf_name),
-            )
+            letter.pdf_path = os.path.join(pdf_output_directory, pdf_name)
+            shutil.move(os.path.join(output_directory, pdf_name), letter.pdf_path)
 
         # If asked, clean up the tex output
         if cleanup:
@@ -0,0 +1,221 @@
+"""
+Run a job on a cron-style schedule from inside one long-lived process, which is
+what `susocli serve` does with `susocli run`. Keeping the process alive between
+runs means imports, HTTP sessions, caches and database connections stay warm.
+
+Schedules use the usual five cron fields (minute, hour, day of month, month, day
+of week, with Sunday as 0 or 7) and support `*`, lists, ranges and steps, e.g.,
+`0 19-23 * * 1-5`. As in cron, if both the day of month and the day of week are
+restricted, a day matching either will do.
+
+Runs never overlap: the job runs in the scheduler's own thread, and ticks that
+come due while it is running are skipped rather than queued. On SIGTERM or
+SIGINT, the scheduler lets the current run finish and then returns.
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import signal
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+# (name, smallest value, largest value) of each field
+_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day of month", 1, 31),
+    ("month", 1, 12),
+    ("day of week", 0, 7),
+)
+
+# How far ahead to look for a matching minute before deciding there is none,
+# e.g., for `0 0 31 2 *`
+_MAX_LOOKAHEAD = timedelta(days=366 * 5)
+
+
+def _parse_field(text, name, low, high):
+    values = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError(f"Bad step in the {name} field: {text}")
+
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start_text, end_text = part.split("-", 1)
+            start, end = int(start_text), int(end_text)
+        else:
+            start = end = int(part)
+            if step != 1:
+                end = high
+
+        if start < low or end > high or start > end:
+            raise ValueError(f"Out of range value in the {name} field: {text}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronSchedule:
+    """
+    A parsed cron expression.
+    """
+
+    def __init__(self, expression):
+        """
+        Args:
+          expression (str): Five whitespace separated cron fields
+        """
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Expected 5 fields in the cron expression {expression!r}")
+
+        self.expression = expression
+        (
+            self.minutes,
+            self.hours,
+            self.days_of_month,
+            self.months,
+            days_of_week,
+        ) = (_parse_field(text, *field) for text, field in zip(fields, _FIELDS))
+        # Both 0 and 7 are Sunday
+        self.days_of_week = frozenset(day % 7 for day in days_of_week)
+        self._any_day_of_month = fields[2] == "*"
+        self._any_day_of_week = fields[4] == "*"
+
+    def __repr__(self):
+        return f"CronSchedule({self.expression!r})"
+
+    def _matches_day(self, when):
+        # Python's Monday is 0; cron's Sunday is 0
+        day_of_week = (when.weekday() + 1) % 7
+        day_of_month_ok = when.day in self.days_of_month
+        day_of_week_ok = day_of_week in self.days_of_week
+        if self._any_day_of_month or self._any_day_of_week:
+            return day_of_month_ok and day_of_week_ok
+        return day_of_month_ok or day_of_week_ok
+
+    def matches(self, when):
+        """Does the minute containing `when` match the schedule?"""
+        return (
+            when.minute in self.minutes
+            and when.hour in self.hours
+            and when.month in self.months
+            and self._matches_day(when)
+        )
+
+    def next_after(self, when):
+        """
+        Return the first minute strictly after `when` that matches the schedule.
+
+        Args:
+          when (datetime): The time to start looking from
+
+        Returns:
+          datetime: The next matching minute
+        """
+        candidate = when.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate + _MAX_LOOKAHEAD
+        while candidate < limit:
+            if candidate.month not in self.months or not self._matches_day(candidate):
+                candidate = (candidate + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if candidate.hour not in self.hours:
+                candidate = (candidate + timedelta(hours=1)).replace(minute=0)
+                continue
+            if candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+                continue
+            return candidate
+        raise ValueError(f"The schedule {self.expression!r} never fires")
+
+
+class Scheduler:
+    """
+    Call `job` at every time any of `schedules` fires, until stopped.
+    """
+
+    def __init__(self, schedules, job, now=datetime.now, sleep=None, log=print):
+        """
+        Args:
+          schedules (iterable[CronSchedule|str]): When to run the job
+          job (callable): Called with no arguments at each tick. Exceptions are
+            logged and do not stop the scheduler.
+          now (callable): Returns the current time. Here for testing.
+          sleep (callable|None): Called with the number of seconds to wait before
+            checking the time again. Defaults to waiting on the stop event, so
+            that `stop` wakes the scheduler. Here for testing.
+          log (callable): Called with each message the scheduler logs
+        """
+        self.schedules = [
+            schedule if isinstance(schedule, CronSchedule) else CronSchedule(schedule)
+            for schedule in schedules
+        ]
+        if not self.schedules:
+            raise ValueError("At least one schedule is required")
+        self.job = job
+        self.now = now
+        self.log = log
+        self._stop = threading.Event()
+        self.sleep = sleep or self._stop.wait
+
+    def next_run(self, after=None):
+        """The next time any of the schedules fires after `after` (default now)"""
+        after = after or self.now()
+        return min(schedule.next_after(after) for schedule in self.schedules)
+
+    def stop(self, *args):
+        """Ask the scheduler to stop once any run in progress has finished"""
+        if not self._stop.is_set():
+            self.log("Stopping after the current run (if any)")
+        self._stop.set()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def install_signal_handlers(self):
+        """Stop gracefully on SIGTERM and SIGINT"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def run_once(self):
+        """Run the job now, logging rather than raising any exception"""
+        self.log(f"Starting run at {self.now():%Y-%m-%d %H:%M:%S}")
+        try:
+            self.job()
+        except Exception:
+            self.log("Run failed:\n" + traceback.format_exc())
+        self.log(f"Finished run at {self.now():%Y-%m-%d %H:%M:%S}")
+
+    def run_forever(self, max_runs=None):
+        """
+        Wait for each tick and run the job, until `stop` is called (or `max_runs`
+        runs have happened).
+
+        Returns:
+          int: The number of runs
+        """
+        num_runs = 0
+        while not self._stop.is_set():
+            next_run = self.next_run()
+            self.log(f"Next run at {next_run:%Y-%m-%d %H:%M}")
+
+            # Wake up now and then in case the clock jumps
+            while not self._stop.is_set():
+                remaining = (next_run - self.now()).total_seconds()
+                if remaining <= 0:
+                    break
+                self.sleep(min(remaining, 60))
+            if self._stop.is_set():
+                break
+
+            self.run_once()
+            num_runs += 1
+
+            if max_runs is not None and num_runs >= max_runs:
+                break
+        return num_runs
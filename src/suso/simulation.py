@@ -0,0 +1,226 @@
+"""
+Rehearse a run without mailing anything. `susocli run --simulate N` makes up N
+participants and drives the whole pipeline against local fakes: ETO
+(`suso.fakes.eto`), a fresh SQLite database, Click2Mail
+(`suso.fakes.click2mail`) and MailChimp (`suso.fakes.mailchimp`). At the end it
+reports the throughput of the run and which stages it spent its time in.
+
+How slow each fake is comes from the `simulate` section of the config, e.g.::
+
+  simulate:
+    eto_latency: 0.1            # seconds per ETO request
+    click2mail_latency: 0.05    # seconds per Click2Mail request
+    click2mail_jitter: 0.05     # up to this much extra per request
+    click2mail_error_rate: 0.01 # fraction of requests answered with a 429/5xx
+    click2mail_pool_size: 10    # connections to keep open to Click2Mail
+    address_list_delay: 2       # seconds for Click2Mail to process an address list
+    mailchimp_latency: 0.2      # seconds per MailChimp request
+    render_latency: 0.5         # seconds per letter; leave out to run pdflatex
+    seed: 0
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+from suso import click2mail
+from suso.fakes.click2mail import FakeClick2MailServer
+from suso.fakes.eto import FakeApiHandler
+from suso.fakes.mailchimp import FakeMailChimp
+from suso.fakes.render import FakeRenderer
+
+SimulationSettings = namedtuple(
+    "SimulationSettings",
+    (
+        "eto_latency",
+        "click2mail_latency",
+        "click2mail_jitter",
+        "click2mail_error_rate",
+        "click2mail_pool_size",
+        "address_list_delay",
+        "mailchimp_latency",
+        "render_latency",
+        "seed",
+    ),
+)
+
+DEFAULT_SETTINGS = SimulationSettings(
+    eto_latency=0.0,
+    click2mail_latency=0.0,
+    click2mail_jitter=0.0,
+    click2mail_error_rate=0.0,
+    click2mail_pool_size=click2mail.DEFAULT_POOL_SIZE,
+    address_list_delay=0.0,
+    mailchimp_latency=0.0,
+    render_latency=None,
+    seed=0,
+)
+
+
+def settings_from_config(config):
+    """
+    Read the SimulationSettings from the `simulate` section of the config.
+    Anything left out takes its value from DEFAULT_SETTINGS.
+    """
+    section = config.get("simulate") or {}
+    unknown = set(section) - set(SimulationSettings._fields)
+    if unknown:
+        raise ValueError(
+            "Unknown settings in the simulate section: {}".format(
+                ", ".join(sorted(unknown))
+            )
+        )
+    return DEFAULT_SETTINGS._replace(**section)
+
+
+class Simulation:
+    """
+    The fakes, database and directories for one simulated run. Use it as a
+    context manager, which starts the fake Click2Mail server and cleans up after.
+    """
+
+    def __init__(self, config, num_participants, settings=None, directory=None):
+        """
+        Args:
+          config (dict): The real config. Only its `randomizer` and `simulate`
+            sections are used.
+          num_participants (int): The number of participants to make up
+          settings (SimulationSettings|None): How the fakes behave. Defaults to
+            the `simulate` section of the config.
+          directory (str|None): Where to keep the database, tex and pdf files. By
+            default, a temporary directory which is removed afterward.
+        """
+        from suso import render
+
+        self.num_participants = num_participants
+        self.settings = settings or settings_from_config(config)
+        self._owns_directory = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix="suso-simulate-")
+        self.tex = os.path.join(self.directory, "tex")
+        self.pdf = os.path.join(self.directory, "pdf")
+
+        credentials = {"username": "simulated", "password": "simulated"}
+        self.config = {
+            "db": {
+                "backend": "sqlite",
+                "database": os.path.join(self.directory, "suso.sqlite3"),
+            },
+            "eto": credentials,
+            "click2mail": credentials,
+            "mailchimp": {"username": "simulated", "key": "simulated"},
+            "randomizer": config.get("randomizer") or {"key": "simulated"},
+        }
+
+        self.eto = FakeApiHandler(
+            num_participants,
+            sites=list(render.CBOs),
+            latency=self.settings.eto_latency,
+            seed=self.settings.seed,
+        )
+        self.click2mail_server = FakeClick2MailServer(
+            latency=self.settings.click2mail_latency,
+            jitter=self.settings.click2mail_jitter,
+            error_rate=self.settings.click2mail_error_rate,
+            address_list_delay=self.settings.address_list_delay,
+            seed=self.settings.seed,
+        )
+        self.click2mail = click2mail.Click2MailClient(
+            base_url=self.click2mail_server.base_url,
+            document_index=click2mail.DocumentIndex(
+                os.path.join(self.pdf, "documents.json")
+            ),
+            pool_size=self.settings.click2mail_pool_size,
+        )
+        self.mailchimp = FakeMailChimp(latency=self.settings.mailchimp_latency)
+        self.renderer = (
+            None
+            if self.settings.render_latency is None
+            else FakeRenderer(latency=self.settings.render_latency)
+        )
+
+    def __enter__(self):
+        self.click2mail_server.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.click2mail.close()
+        self.click2mail_server.stop()
+        if self._owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def report(self, profiler, query_metrics=None):
+        """
+        Summarize the throughput of the simulated run and where its time went.
+
+        Args:
+          profiler (profiling.Profiler): The profiler the run recorded its stages in
+          query_metrics (database.QueryMetrics|None): The run's SQL timings
+
+        Returns:
+          str: The report
+        """
+        stages = [stage for stage in profiler.stages if stage.wall_seconds]
+        total = sum(stage.wall_seconds for stage in stages)
+        counts = {}
+        for stage in profiler.stages:
+            counts.update(
+                {(stage.name, key): value for key, value in stage.counts.items()}
+            )
+        num_letters = counts.get(("submit", "submitted"), 0)
+
+        lines = [
+            "Simulated {} participants: {} letters submitted in {:.1f}s "
+            "({:.2f} letters/s, {:.1f} participants/s)".format(
+                self.num_participants,
+                num_letters,
+                total,
+                num_letters / total if total else 0.0,
+                self.num_participants / total if total else 0.0,
+            ),
+            "",
+            "{:<12} {:>9} {:>6}".format("stage", "wall (s)", "share"),
+        ]
+        for stage in sorted(stages, key=lambda stage: -stage.wall_seconds):
+            lines.append(
+                "{:<12} {:>9.2f} {:>5.0f}%".format(
+                    stage.name, stage.wall_seconds, 100 * stage.wall_seconds / total
+                )
+            )
+        if stages:
+            bottleneck = max(stages, key=lambda stage: stage.wall_seconds)
+            lines.append(
+                "\nBottleneck: {} ({:.0f}% of the run)".format(
+                    bottleneck.name, 100 * bottleneck.wall_seconds / total
+                )
+            )
+
+        lines.append(
+            "\nETO: {} requests, {:.1f}s waiting".format(
+                sum(self.eto.requests.values()), self.eto.request_seconds
+            )
+        )
+        lines.append(
+            "Click2Mail: {} requests ({})".format(
+                sum(self.click2mail_server.requests.values()),
+                ", ".join(
+                    f"{endpoint} {code}: {n}"
+                    for (endpoint, code), n in sorted(
+                        self.click2mail_server.requests.items(), key=str
+                    )
+                ),
+            )
+        )
+        lines.append(
+            "MailChimp: {} requests, {} emails".format(
+                sum(self.mailchimp.requests.values()), len(self.mailchimp.sent)
+            )
+        )
+        if query_metrics is not None:
+            lines.append(
+                "Database: {:.2f}s in SQL\n\n{}".format(
+                    query_metrics.total_seconds, query_metrics.summary(limit=5)
+                )
+            )
+        return "\n".join(lines)
@@ -0,0 +1,123 @@
+"""
+A run is split into named stages, each of which saves its output when it
+finishes::
+
+  ingest     pull new participants from ETO and store them
+  randomize  assign the new students to treatment or control
+  render     render the letters for unsent treatment students
+  submit     upload and submit the letters to Click2Mail
+  notify     send the summary email
+
+Everything a stage needs from the ones before it is either in the database or in
+their saved outputs, so a run that failed partway through can be picked up from
+the stage that failed (`susocli run --from render`) without redoing the rest.
+
+Outputs are small JSON files, one per stage, kept in a directory (by default
+`stages` in the pdf directory)::
+
+  {"stage": "render", "finished_at": "2021-06-04 19:00:03", "output": {...}}
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import json
+import os
+from datetime import datetime
+
+INGEST = "ingest"
+RANDOMIZE = "randomize"
+RENDER = "render"
+SUBMIT = "submit"
+NOTIFY = "notify"
+
+STAGES = (INGEST, RANDOMIZE, RENDER, SUBMIT, NOTIFY)
+
+
+class MissingStageOutput(Exception):
+    """Raised when a stage needs the output of an earlier stage that hasn't run"""
+
+
+def stages_between(start=None, end=None):
+    """
+    The stages from `start` through `end`, inclusive.
+
+    Args:
+      start (str|None): The first stage to run. Defaults to the first stage.
+      end (str|None): The last stage to run. Defaults to the last stage.
+
+    Returns:
+      tuple[str]: The stages, in order
+    """
+    for stage in (start, end):
+        if stage is not None and stage not in STAGES:
+            raise ValueError(
+                "Unknown stage {}; expected one of {}".format(stage, ", ".join(STAGES))
+            )
+    first = STAGES.index(start) if start else 0
+    last = STAGES.index(end) if end else len(STAGES) - 1
+    if first > last:
+        raise ValueError(f"The stage {start} comes after {end}")
+    return STAGES[first : last + 1]
+
+
+class StageOutputs:
+    """
+    The saved outputs of the stages of a run.
+    """
+
+    def __init__(self, directory):
+        """
+        Args:
+          directory (str): Where to keep the outputs
+        """
+        self.directory = directory
+
+    def path(self, stage):
+        return os.path.join(self.directory, f"{stage}.json")
+
+    def save(self, stage, output):
+        """
+        Save the output of `stage`. The file is replaced atomically, so a crash
+        never leaves a half written output behind.
+
+        Args:
+          stage (str): One of STAGES
+          output (dict): Anything JSON serializable
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(stage)
+        with open(path + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "stage": stage,
+                    "finished_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "output": output,
+                },
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def load(self, stage):
+        """
+        Load the output of `stage`.
+
+        Raises:
+          MissingStageOutput: If `stage` hasn't finished since it was last cleared
+        """
+        try:
+            with open(self.path(stage)) as f:
+                return json.load(f)["output"]
+        except FileNotFoundError:
+            raise MissingStageOutput(
+                f"The {stage} stage has no saved output. "
+                f"Run it first, e.g., with --from {stage}"
+            )
+
+    def clear(self, stages):
+        """Forget the outputs of `stages`, e.g., because they are about to rerun"""
+        for stage in stages:
+            try:
+                os.remove(self.path(stage))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,148 @@
+"""
+Run several programs ("tenants"), each with its own config, at once. Each tenant
+runs in a fresh worker process of its own, so nothing (credentials, connections,
+module state) is shared between them, and everything it prints, including the
+output of subprocesses like pdflatex, goes to its own log file.
+
+  tenants = find_tenants(["configs/"])
+  results = run_in_processes(
+      [(name, {"config_path": path}) for name, path in tenants.items()],
+      target=some_module.run_one,
+      log_directory="logs",
+  )
+
+@author Kevin H. Wilson <kevin.wilson@dc.gov>
+"""
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from collections import namedtuple
+from datetime import datetime
+from multiprocessing.connection import wait
+
+CONFIG_EXTENSIONS = (".yml", ".yaml")
+
+TenantResult = namedtuple("TenantResult", ("name", "exit_code", "seconds", "log_path"))
+
+
+def tenant_name(config_path):
+    """A tenant's name: its config's file name without the extension"""
+    return os.path.splitext(os.path.basename(config_path))[0]
+
+
+def find_tenants(paths):
+    """
+    Expand `paths` into the config files to run. Directories stand for the YAML
+    files directly inside them.
+
+    Args:
+      paths (iterable[str]): Config files and directories of them
+
+    Returns:
+      dict[str, str]: A map from each tenant's name (its config's file name
+        without the extension) to its config file, in the order given
+    """
+    tenants = {}
+    for path in paths:
+        if os.path.isdir(path):
+            config_paths = sorted(
+                os.path.join(path, filename)
+                for filename in os.listdir(path)
+                if filename.endswith(CONFIG_EXTENSIONS)
+            )
+        else:
+            config_paths = [path]
+
+        for config_path in config_paths:
+            name = tenant_name(config_path)
+            if name in tenants:
+                raise ValueError(
+                    f"Two configs are named {name}: {tenants[name]} and {config_path}"
+                )
+            tenants[name] = config_path
+    return tenants
+
+
+def _run_tenant(name, target, kwargs, log_path):
+    """
+    The body of a worker process: point stdout and stderr at the tenant's log and
+    call `target(**kwargs)`. Exits non-zero if it raises.
+    """
+    os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+    log = open(log_path, "a")
+    # Redirect the file descriptors, not just sys.stdout, so that subprocesses'
+    # output lands in the log too
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+
+    print(f"=== {name} started at {datetime.now():%Y-%m-%d %H:%M:%S}", flush=True)
+    exit_code = 0
+    try:
+        target(**kwargs)
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    print(
+        f"=== {name} finished at {datetime.now():%Y-%m-%d %H:%M:%S} "
+        f"with exit code {exit_code}",
+        flush=True,
+    )
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sys.exit(exit_code)
+
+
+def run_in_processes(jobs, target, log_directory, workers=None, log=print):
+    """
+    Call `target` once per job, each in a new process, at most `workers` at a time.
+
+    Args:
+      jobs (iterable[tuple[str, dict]]): The name of each job and the keyword
+        arguments to call `target` with
+      target (callable): A module level function (so that it can be found in a
+        fresh interpreter)
+      log_directory (str): Each job's output goes to `<name>.log` here
+      workers (int|None): The most jobs to run at once. Defaults to all of them.
+      log (callable): Called with a message as each job starts and finishes
+
+    Returns:
+      list[TenantResult]: The result of each job, in the order they finished
+    """
+    pending = list(jobs)
+    workers = workers or len(pending) or 1
+    context = multiprocessing.get_context("spawn")
+
+    running = {}
+    results = []
+    while pending or running:
+        while pending and len(running) < workers:
+            name, kwargs = pending.pop(0)
+            log_path = os.path.join(log_directory, f"{name}.log")
+            process = context.Process(
+                target=_run_tenant,
+                args=(name, target, kwargs, log_path),
+                name=f"suso-{name}",
+            )
+            process.start()
+            running[process.sentinel] = (name, process, time.monotonic(), log_path)
+            log(f"Started {name} (pid {process.pid}), logging to {log_path}")
+
+        for sentinel in wait(list(running)):
+            name, process, started, log_path = running.pop(sentinel)
+            process.join()
+            result = TenantResult(
+                name, process.exitcode, time.monotonic() - started, log_path
+            )
+            results.append(result)
+            log(
+                "Finished {} in {:.1f}s with exit code {}".format(
+                    name, result.seconds, result.exit_code
+                )
+            )
+    return results
@@ -1,8 +1,15 @@
+import datetime
+import os
+import tempfile
 import textwrap
+from concurrent.futures import ThreadPoolExecutor
 
+import pytest
 from bs4 import BeautifulSoup
 
 from suso import click2mail
+from suso.deadline import Deadline
+from suso.fakes.click2mail import FakeClick2MailServer
 
 JOHN_DOE = {
     "firstname": "John",
@@ -62,8 +69,9 @@ def test__recipient_row_to_xml():
 
 
 class MockResponse:
-    def __init__(self, content):
+    def __init__(self, content, ok=True):
         self.content = content
+        self.ok = ok
 
 
 def test__get_return_status():
@@ -102,3 +110,192 @@ def test__recipient_list_to_xml():
     for address in addresses:
         to_compare = JOHN_DOE if address.find("First_name").text == "John" else JANE_ROE
         _check_dict(address, to_compare)
+
+
+def test_document_index_lookup():
+    index = click2mail.DocumentIndex()
+    index.add("abc", 10, 1234)
+    assert index.lookup("abc", 10) == 1234
+    assert index.lookup("abc", 11) is None
+    assert index.lookup("def", 10) is None
+
+    index.max_age = datetime.timedelta(0)
+    assert index.lookup("abc", 10) is None
+
+
+class UploadCountingClient(click2mail.Click2MailClient):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.uploads = 0
+
+    def _post(self, *args, **kwargs):
+        self.uploads += 1
+        return MockResponse(
+            "<document><id>{}</id><status>0</status>"
+            "<description>Success</description></document>".format(self.uploads)
+        )
+
+    def document_exists(self, document_id):
+        return True
+
+
+def test_post_document_reuses_uploaded_documents():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        first = os.path.join(tmp_dir, "first.pdf")
+        second = os.path.join(tmp_dir, "second.pdf")
+        for filename, content in [(first, b"same"), (second, b"same"), (second, b"")]:
+            with open(filename, "ab") as f:
+                f.write(content)
+
+        index_path = os.path.join(tmp_dir, "documents.json")
+        client = UploadCountingClient(
+            document_index=click2mail.DocumentIndex(index_path)
+        )
+        assert client.post_document(first) == 1
+        assert client.post_document(first) == 1
+        assert client.uploads == 1
+
+        # The index survives a restart
+        client = UploadCountingClient(
+            document_index=click2mail.DocumentIndex(index_path)
+        )
+        assert client.post_document(second) == 1
+        assert client.uploads == 0
+
+
+def _fake_client(server):
+    client = click2mail.Click2MailClient(base_url=server.base_url)
+    client.login("username", "secret")
+    return client
+
+
+def test_submission_against_fake_server():
+    with FakeClick2MailServer() as server, tempfile.TemporaryDirectory() as tmp_dir:
+        client = _fake_client(server)
+
+        filename = os.path.join(tmp_dir, "kevin.pdf")
+        with open(filename, "wb") as f:
+            f.write(b"%PDF-1.1")
+
+        document_id = client.post_document(filename)
+        address_list_id = client.post_recipients([JOHN_DOE], "aList")
+        job_id = client.create_job(document_id, address_list_id)
+        assert client.get_tracking_data(job_id) == (None, None)
+
+        client.submit_job(job_id)
+        status, status_time = client.get_tracking_data(job_id)
+        assert status == "Arrived at Recipient PO"
+        assert status_time.endswith(".0")
+
+        # Submitting twice is an error
+        with pytest.raises(ValueError):
+            client.submit_job(job_id)
+
+
+def test_fake_server_address_list_delay():
+    with FakeClick2MailServer(address_list_delay=60) as server:
+        client = _fake_client(server)
+        with open(__file__, "rb") as f:
+            response = client._post("documents", files={"file": f})
+        document_id = click2mail._get_id_from_response(response)
+
+        address_list_id = client.post_recipients([JOHN_DOE, JANE_ROE], "aList")
+        with pytest.raises(ValueError):
+            client.create_job(document_id, address_list_id)
+
+
+def test_fake_server_injects_failures():
+    with FakeClick2MailServer(error_rate=1.0, error_statuses=(429,)) as server:
+        client = _fake_client(server)
+        response = client._post("account", "authorize", retry_statuses=())
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "1"
+        assert server.requests[("authorize", 429)] == 1
+
+        # The client retries as long as the run's deadline allows
+        client.deadline = Deadline(0.5)
+        assert client._post("account", "authorize").status_code == 429
+        assert server.requests[("authorize", 429)] == 2
+
+
+def test_connections_are_pooled_across_threads():
+    with FakeClick2MailServer() as server:
+        client = click2mail.Click2MailClient(base_url=server.base_url, pool_size=4)
+        client.login("username", "secret")
+
+        def authorize(_):
+            return client._post("account", "authorize").status_code
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            assert set(executor.map(authorize, range(40))) == {200}
+
+        stats = client.pool_stats()
+        assert stats["requests"] == 40
+        assert stats["connections_opened"] <= 4
+        assert stats["connections_reused"] >= 36
+        client.close()
+
+
+def test_wait_for_address_lists():
+    with FakeClick2MailServer(address_list_delay=0.3) as server:
+        client = _fake_client(server)
+        address_list_ids = [
+            client.post_recipients([JOHN_DOE], f"aList{i}") for i in range(5)
+        ]
+
+        statuses = client.wait_for_address_lists(
+            address_list_ids, initial_interval=0.05, max_interval=0.1
+        )
+        assert statuses == {
+            address_list_id: (0, "Success") for address_list_id in address_list_ids
+        }
+        assert all(server.address_list_ready(i) for i in address_list_ids)
+
+        # A list Click2Mail doesn't know doesn't stop the wait on the others
+        statuses = client.wait_for_address_lists(
+            [address_list_ids[0], 999999], return_exceptions=True
+        )
+        assert statuses[address_list_ids[0]] == (0, "Success")
+        assert statuses[999999][0] is None
+        assert isinstance(statuses[999999][1], ValueError)
+
+
+def test_timed_out_submission_is_not_repeated(tmp_path):
+    import requests
+
+    from suso import cli, journal, letters
+
+    with FakeClick2MailServer() as server:
+        client = _fake_client(server)
+        document_id = client.post_document(__file__)
+        address_list_id = client.post_recipients([JOHN_DOE], "aList")
+        job_id = client.create_job(document_id, address_list_id)
+        assert client.job_submitted(job_id) is False
+
+        # The submission goes through but the response never arrives
+        submit_job = client.submit_job
+
+        def submit_then_time_out(job_id):
+            submit_job(job_id)
+            raise requests.Timeout()
+
+        client.submit_job = submit_then_time_out
+
+        # ...after the run is already out of time
+        client.deadline = Deadline(0)
+        letter = letters.LetterRecord(1234)
+        letter.job_id = job_id
+        submitter = cli.Submitter(
+            client,
+            [letter],
+            pdf_directory=str(tmp_path),
+            submission_journal=journal.SubmissionJournal(
+                str(tmp_path / "submissions.journal")
+            ),
+            deadline=Deadline(60),
+        )
+        submitter.submit()
+        assert letter.submitted
+        assert client.job_submitted(job_id) is True
+        assert server.requests[("submit_job", 200)] == 1
+        submitter.journal.close()
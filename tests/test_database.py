@@ -0,0 +1,410 @@
+import pytest
+
+from suso import backends
+from suso import database as db
+from suso import export, migrations
+
+
+@pytest.fixture
+def conn():
+    conn = db.get_connection({"backend": "sqlite", "database": ":memory:"})
+    curs = conn.cursor()
+    db.create_tables(curs)
+    curs.close()
+    conn.commit()
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def _student(id, enrolled_date="2018-01-08", is_good_record=1):
+    return (
+        id,
+        "First",
+        "Last",
+        "Address",
+        "20001",
+        "GFirst",
+        "GLast",
+        "Fake CBO",
+        "Fake Caseworker",
+        "Fake School",
+        enrolled_date,
+        is_good_record,
+    )
+
+
+def test_get_backend():
+    assert backends.get_backend({}).name == "mssql"
+    assert backends.get_backend({"backend": "sqlite"}).name == "sqlite"
+    with pytest.raises(ValueError):
+        backends.get_backend({"backend": "oracle"})
+
+
+def test_insert_new_students_skips_existing(conn):
+    curs = conn.cursor()
+    assert backends.backend_for(curs).name == "sqlite"
+
+    assert db.insert_new_students(curs, [_student(1), _student(2)]) == 2
+    assert db.insert_new_students(curs, [_student(2), _student(3)]) == 1
+    conn.commit()
+
+    curs.execute(f"SELECT id FROM {db.STUDENTS_TABLE} ORDER BY id")
+    assert [row[0] for row in curs.fetchall()] == [1, 2, 3]
+
+    # The staging table is gone, so we can stage again
+    assert db.insert_new_students(curs, [_student(3)]) == 0
+
+    # Only the students actually inserted are counted
+    curs.execute(f"SELECT num_students FROM {db.ENROLLMENT_BY_DAY_TABLE}")
+    assert curs.fetchall() == [(3,)]
+    curs.close()
+
+
+class BatchRecordingCursor:
+    """A sqlite cursor which, like pyodbc's, has a `fast_executemany` switch"""
+
+    backend = backends.BACKENDS["sqlite"]
+
+    def __init__(self, curs):
+        self._curs = curs
+        self.fast_executemany = False
+        self.batches = []
+
+    def executemany(self, sql, rows):
+        self.batches.append(len(rows))
+        return self._curs.executemany(sql, rows)
+
+    def __getattr__(self, name):
+        return getattr(self._curs, name)
+
+
+def test_bulk_inserts_are_batched(conn):
+    pd = pytest.importorskip("pandas")
+
+    curs = BatchRecordingCursor(conn.cursor())
+    students = pd.DataFrame(
+        [_student(i) for i in range(1, 6)],
+        columns=db.STUDENT_COLUMNS,
+    )
+    students.loc[2, "caseworker"] = float("nan")
+    assert db.insert_students(curs, students, batch_size=2) == 5
+    assert curs.fast_executemany
+    assert curs.batches == [2, 2, 1]
+
+    # numpy scalars are bound as plain values
+    randomizers = pd.DataFrame({"student_id": [1, 2], "is_treatment": [1, 0]})
+    assert db.insert_randomizers(curs, randomizers) == 2
+    assert db.insert_randomizers(curs, []) == 0
+    conn.commit()
+
+    curs.execute(f"SELECT id, caseworker FROM {db.STUDENTS_TABLE} WHERE id = 3")
+    assert curs.fetchall() == [(3, None)]
+    curs.execute(f"SELECT student_id, is_treatment FROM {db.RANDOMIZER_TABLE}")
+    assert sorted(curs.fetchall()) == [(1, 1), (2, 0)]
+    curs.execute(f"SELECT num_students FROM {db.ENROLLMENT_BY_DAY_TABLE}")
+    assert curs.fetchall() == [(5,)]
+    curs.close()
+
+
+def test_insert_new_students_stages_in_batches(conn):
+    import sqlite3
+
+    curs = BatchRecordingCursor(conn.cursor())
+    db.insert_students(curs, [_student(2), _student(4)])
+
+    new = [_student(i, "2018-02-01") for i in range(1, 6)]
+    del curs.batches[:]
+    assert db.insert_new_students(curs, new, batch_size=2) == 3
+    assert curs.batches == [2, 2, 1]
+    curs.execute(f"SELECT id FROM {db.STUDENTS_TABLE} ORDER BY id")
+    assert [row[0] for row in curs.fetchall()] == [1, 2, 3, 4, 5]
+
+    # A failed load still drops the staging table and inserts nothing
+    with pytest.raises(sqlite3.IntegrityError):
+        db.insert_new_students(curs, [_student(6), _student(6)])
+    curs.execute("SELECT name FROM sqlite_temp_master WHERE type = 'table'")
+    assert curs.fetchall() == []
+    curs.execute(f"SELECT COUNT(*) FROM {db.STUDENTS_TABLE}")
+    assert curs.fetchall() == [(5,)]
+    curs.close()
+
+
+def test_unsent_treatment_students_and_counts(conn):
+    curs = conn.cursor()
+    db.insert_students(
+        curs,
+        [
+            _student(1, "2018-01-08"),
+            _student(2, "2018-02-01"),
+            _student(3, "2018-02-02"),
+        ],
+    )
+    db.insert_randomizers(curs, [(1, 1), (2, 1), (3, 0)])
+    db.insert_status(curs, 1, "Success")
+    conn.commit()
+
+    curs.execute(db.UNSENT_TREATMENT_STUDENTS_QUERY)
+    assert [row[0] for row in curs.fetchall()] == [2]
+
+    db.insert_new_students(curs, [_student(3, "2018-02-02"), _student(4, "2018-02-02")])
+
+    def stats():
+        curs.execute(db.MONTH_STATS_QUERY, (2018, 2018, 1))
+        by_month = curs.fetchall()
+        curs.execute(db.DAY_STATS_QUERY, ("2018-02-01",))
+        return by_month, curs.fetchall()
+
+    expected = (
+        [(2018, 1, 1), (2018, 2, 3)],
+        [("2018-02-01", 1), ("2018-02-02", 2)],
+    )
+    assert stats() == expected
+
+    curs.execute(f"DELETE FROM {db.ENROLLMENT_BY_DAY_TABLE}")
+    db.rebuild_enrollment_stats(curs)
+    assert stats() == expected
+    curs.close()
+
+
+def test_migrations_and_plans(conn):
+    assert migrations.migrate(conn) == []
+
+    curs = conn.cursor()
+    assert migrations.applied_versions(curs) == {
+        migration.version for migration in migrations.MIGRATIONS
+    }
+    results = dict(
+        (query.name, indexes) for query, indexes in migrations.check_query_plans(curs)
+    )
+    assert "ix_students_new_enrolled_date" in results["latest enrollment"]
+    assert "ix_students_new_good_records_covering" in results["randomized students"]
+
+    curs.execute("EXPLAIN QUERY PLAN " + db.RANDOMIZED_STUDENTS_QUERY)
+    assert "COVERING INDEX" in curs.fetchall()[0][-1]
+    curs.close()
+
+
+def test_migrate_applies_each_migration_once():
+    import sqlite3
+
+    conn = db.get_connection({"backend": "sqlite", "database": ":memory:"})
+    curs = conn.cursor()
+    db.create_tables(curs)
+    conn.commit()
+
+    def indexes():
+        curs.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        return {row[0] for row in curs.fetchall() if row[0].startswith("ix_")}
+
+    applied = migrations.migrate(conn, target=1)
+    assert [migration.version for migration in applied] == [1]
+    assert "ix_students_new_good_records" in indexes()
+    assert [m.version for m in migrations.pending_migrations(curs)] == [
+        migration.version for migration in migrations.MIGRATIONS[1:]
+    ]
+
+    # A failing migration is rolled back without undoing the ones before it
+    broken = migrations.Migration(
+        version=99,
+        description="Broken",
+        statements=(f"CREATE INDEX ix_broken ON {db.STUDENTS_TABLE} (id)", "NOT SQL"),
+    )
+    with pytest.raises(sqlite3.OperationalError):
+        migrations.migrate(conn, migrations.MIGRATIONS + (broken,))
+    assert "ix_broken" not in indexes()
+    assert migrations.pending_migrations(curs, migrations.MIGRATIONS + (broken,)) == [
+        broken
+    ]
+
+    assert migrations.migrate(conn) == []
+    assert "ix_students_new_good_records" not in indexes()
+    assert "ix_students_new_good_records_covering" in indexes()
+    curs.close()
+    conn.close()
+
+
+def test_export_is_incremental(conn, tmp_path):
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+
+    curs = conn.cursor()
+    db.insert_students(curs, [_student(1), _student(2)])
+    curs.execute(
+        f"""UPDATE {db.STUDENTS_TABLE} SET created_at = '2000-01-01 00:00:00'"""
+    )
+    conn.commit()
+
+    written = export.export_tables(curs, str(tmp_path), chunk_size=1)
+    assert written[db.STUDENTS_TABLE] == 2
+
+    db.insert_students(curs, [_student(3)])
+    conn.commit()
+
+    written = export.export_tables(curs, str(tmp_path))
+    assert written[db.STUDENTS_TABLE] == 1
+    assert written[db.RANDOMIZER_TABLE] == 0
+
+    # A row stamped with the watermark's time but committed after the export
+    db.insert_students(curs, [_student(4)])
+    curs.execute(
+        f"""UPDATE {db.STUDENTS_TABLE}
+            SET created_at = (SELECT created_at FROM {db.STUDENTS_TABLE} WHERE id = 3)
+            WHERE id = 4"""
+    )
+    conn.commit()
+    written = export.export_tables(curs, str(tmp_path))
+    assert written[db.STUDENTS_TABLE] == 1
+    assert export.export_tables(curs, str(tmp_path))[db.STUDENTS_TABLE] == 0
+    curs.close()
+
+    df = pd.read_parquet(str(tmp_path / db.STUDENTS_TABLE))
+    assert sorted(df.id) == [1, 2, 3, 4]
+    assert df.is_good_record.dtype == bool
+
+
+def test_latest_views(conn):
+    curs = conn.cursor()
+    db.insert_students(curs, [_student(1), _student(2)])
+    db.insert_jobs(curs, [(10, 1), (11, 1), (20, 2)])
+    db.insert_mailings(
+        curs,
+        [
+            (11, "In Transit", "2018-01-10 10:00:00"),
+            (11, "USPS Indicated Delivered", "2018-01-12 10:00:00"),
+            (20, "In Transit", "2018-01-10 10:00:00"),
+        ],
+    )
+    conn.commit()
+
+    assert sorted(row[:2] for row in db.latest_jobs(curs)) == [(11, 1), (20, 2)]
+    assert sorted(row[:2] for row in db.latest_mailings(curs)) == [
+        (11, "USPS Indicated Delivered"),
+        (20, "In Transit"),
+    ]
+    assert db.undelivered_jobs(curs) == [(20, 2)]
+    curs.close()
+
+
+def test_pool_sessions_and_durability(tmp_path):
+    config = {"backend": "sqlite", "database": str(tmp_path / "suso.sqlite3")}
+
+    with db.ConnectionPool(config, size=1) as pool:
+        with pool.session() as session:
+            with session.transaction() as curs:
+                db.create_tables(curs)
+            migrations.migrate(session.conn)
+
+            # A failed transaction leaves nothing behind
+            with pytest.raises(ZeroDivisionError):
+                with session.transaction() as curs:
+                    db.insert_student(curs, *_student(1))
+                    1 / 0
+            assert session.query(f"SELECT COUNT(*) FROM {db.STUDENTS_TABLE}") == [(0,)]
+            first_conn = session.conn
+
+        # The connection is reused, and in letter mode each checkpoint commits
+        with pool.session(db.DURABILITY_LETTER) as session:
+            assert session.conn is first_conn
+            curs = session.cursor()
+            db.insert_student(curs, *_student(1))
+            session.checkpoint()
+            db.insert_student(curs, *_student(2))
+            curs.close()
+
+        # Releasing the connection rolled back the uncommitted student
+        with pool.session() as session:
+            assert session.query(f"SELECT id FROM {db.STUDENTS_TABLE}") == [(1,)]
+
+    with pytest.raises(ValueError):
+        db.Session(None, "sometimes")
+
+
+def test_statements_get_their_full_timeout_after_the_deadline(conn, monkeypatch):
+    from suso.deadline import Deadline
+
+    timeouts = []
+    monkeypatch.setattr(
+        backends.SqliteBackend,
+        "set_statement_timeout",
+        lambda self, conn, seconds: timeouts.append(seconds),
+    )
+    now = [0.0]
+    session = db.Session(conn)
+    session.deadline = Deadline(100, timeout=30, clock=lambda: now[0])
+
+    now[0] = 99.0
+    session.checkpoint()
+    now[0] = 100.0
+    session.checkpoint()
+    assert timeouts == [1.0, 30]
+
+
+def test_pool_wakes_waiters_when_a_connection_is_discarded():
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    with db.ConnectionPool({"backend": "sqlite"}, size=1) as pool:
+        conn = pool.acquire()
+        with pytest.raises(TimeoutError):
+            pool.acquire(timeout=0.05)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            waiting = executor.submit(pool.acquire, 5)
+            time.sleep(0.05)
+            # A connection which can't be rolled back is discarded on release
+            conn.close()
+            pool.release(conn)
+            new_conn = waiting.result(timeout=1)
+        assert new_conn is not conn
+        pool.release(new_conn)
+
+
+def test_instrumented_cursor_records_statements(conn):
+    metrics = db.QueryMetrics()
+    session = db.Session(conn, metrics=metrics)
+    with session.transaction() as curs:
+        db.insert_students(curs, [_student(1), _student(2)])
+        db.insert_new_students(curs, [_student(2), _student(3)])
+        assert backends.backend_for(curs).name == "sqlite"
+    for student_id in (1, 2):
+        session.query(f"SELECT * FROM {db.STUDENTS_TABLE} WHERE id = {student_id}")
+
+    statements = {
+        entry["statement"]: entry for entry in metrics.to_dict()["statements"]
+    }
+    lookup = statements[f"SELECT * FROM {db.STUDENTS_TABLE} WHERE id = ?"]
+    assert lookup["executions"] == 2
+    assert lookup["rows_fetched"] == 2
+
+    insert = db.fingerprint(db._insert_sql(db.STUDENTS_TABLE, db.STUDENT_COLUMNS))
+    assert statements[insert]["rows_affected"] == 2
+    assert "statements in" in metrics.summary()
+
+
+def test_insert_new_randomizers_is_idempotent(conn):
+    curs = conn.cursor()
+    db.insert_students(curs, [_student(1), _student(2)])
+    db.insert_new_randomizers(curs, [(1, 1)])
+    db.insert_new_randomizers(curs, [(1, 1), (2, 0)])
+    conn.commit()
+
+    curs.execute(f"SELECT student_id, is_treatment FROM {db.RANDOMIZER_TABLE}")
+    assert sorted(curs.fetchall()) == [(1, 1), (2, 0)]
+    curs.close()
+
+
+def test_run_refuses_an_unmigrated_database(tmp_path):
+    import click
+
+    from suso import cli
+
+    conn = db.get_connection({"backend": "sqlite", "database": ":memory:"})
+    curs = conn.cursor()
+    db.create_tables(curs)
+    curs.close()
+    conn.commit()
+
+    with pytest.raises(click.ClickException, match="susocli migrate"):
+        cli.run({}, db.Session(conn), str(tmp_path), str(tmp_path), None)
+    conn.close()
@@ -0,0 +1,44 @@
+import pytest
+import yaml
+from click.testing import CliRunner
+
+from suso import cli
+from suso.deadline import Deadline, DeadlineExceeded, deadline_from_config
+
+
+def test_deadline():
+    now = [0.0]
+    deadline = Deadline(100, timeout=30, clock=lambda: now[0])
+    assert deadline.timeout() == 30
+    assert deadline.timeout(300) == 100
+
+    now[0] = 90.0
+    assert deadline.timeout() == 10
+    assert not deadline.expired
+
+    now[0] = 100.0
+    assert deadline.expired
+    with pytest.raises(DeadlineExceeded):
+        deadline.timeout()
+
+    assert Deadline(timeout=30).timeout() == 30
+    assert deadline_from_config({"deadline": {"minutes": 2}}).seconds == 120
+    with pytest.raises(ValueError, match="seconds"):
+        deadline_from_config({"deadline": {"seconds": 2}})
+
+
+def test_run_out_of_time_defers_letters(tmp_path):
+    config = tmp_path / "config.yml"
+    config.write_text(
+        yaml.safe_dump(
+            {
+                "simulate": {"render_latency": 0.2, "seed": 1},
+                "deadline": {"minutes": 0.02},
+            }
+        )
+    )
+
+    result = CliRunner().invoke(cli.cli, ["run", str(config), "--simulate", "60"])
+    assert result.exit_code == 0, result.output
+    assert "Out of time; leaving" in result.output
+    assert "0 letters submitted" in result.output
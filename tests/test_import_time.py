@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import suso
+
+# The most that importing suso.cli may take, in milliseconds. Before the heavy
+# imports were made lazy it took about 900ms; now it takes well under 100ms.
+# Override with SUSO_IMPORT_BUDGET_MS on slow machines.
+IMPORT_BUDGET_MS = float(os.environ.get("SUSO_IMPORT_BUDGET_MS", 300))
+
+# Modules that only the commands which need them should import
+HEAVY_MODULES = ("pandas", "numpy", "requests", "bs4", "mailchimp3", "jinja2", "yaml")
+
+
+def _import_times(module):
+    """Import `module` in a fresh interpreter and parse `-X importtime`"""
+    env = dict(os.environ)
+    src = os.path.dirname(os.path.dirname(os.path.abspath(suso.__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def test_cli_import_is_fast():
+    # Take the best of a few tries to smooth out a noisy machine
+    best = min(_import_times("suso.cli")["suso.cli"] for _ in range(3))
+    assert best < IMPORT_BUDGET_MS, (
+        f"Importing suso.cli took {best:.0f}ms, over the budget of "
+        f"{IMPORT_BUDGET_MS:.0f}ms. Import heavy modules inside the commands "
+        "that use them."
+    )
+
+
+def test_cli_import_skips_heavy_modules():
+    imported = _import_times("suso.cli")
+    assert not [module for module in HEAVY_MODULES if module in imported]
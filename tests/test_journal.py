@@ -0,0 +1,79 @@
+import os
+import tempfile
+
+from suso import journal
+
+
+def test_journal_replays_after_restart():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "submissions.journal")
+
+        the_journal = journal.SubmissionJournal(path)
+        the_journal.record(1234, journal.DOCUMENT_UPLOADED, 11)
+        the_journal.record(1234, journal.ADDRESS_LIST_CREATED, 22)
+        the_journal.close()
+
+        # Simulate dying in the middle of a write
+        with open(path, "a") as f:
+            f.write('{"key": "1234", "stage": "job_cr')
+
+        the_journal = journal.SubmissionJournal(path)
+        assert the_journal.get(1234, journal.DOCUMENT_UPLOADED) == 11
+        assert the_journal.get("1234", journal.ADDRESS_LIST_CREATED) == 22
+        assert not the_journal.has(1234, journal.JOB_CREATED)
+        assert the_journal.last_stage(1234) == journal.ADDRESS_LIST_CREATED
+        assert the_journal.last_stage(5678) is None
+        the_journal.close()
+
+
+def test_journal_records_after_a_torn_line():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "submissions.journal")
+
+        the_journal = journal.SubmissionJournal(path)
+        the_journal.record(1234, journal.DOCUMENT_UPLOADED, 11)
+        the_journal.close()
+
+        # Die in the middle of a write, then carry on from where we left off
+        with open(path, "a") as f:
+            f.write('{"key": "1234", "stage": "job_cr')
+        the_journal = journal.SubmissionJournal(path)
+        the_journal.record(1234, journal.ADDRESS_LIST_CREATED, 22)
+        the_journal.close()
+
+        the_journal = journal.SubmissionJournal(path)
+        assert the_journal.get(1234, journal.DOCUMENT_UPLOADED) == 11
+        assert the_journal.get(1234, journal.ADDRESS_LIST_CREATED) == 22
+        the_journal.close()
+
+
+def test_journal_compact_drops_submitted_letters():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "submissions.journal")
+
+        the_journal = journal.SubmissionJournal(path)
+        for stage in journal.STAGES:
+            the_journal.record(1, stage, 100)
+        the_journal.record(2, journal.DOCUMENT_UPLOADED, 200)
+        the_journal.compact()
+        the_journal.close()
+
+        the_journal = journal.SubmissionJournal(path)
+        assert 1 not in the_journal
+        assert the_journal.get(2, journal.DOCUMENT_UPLOADED) == 200
+        assert len(the_journal) == 1
+        the_journal.close()
+
+
+def test_journal_reset_survives_restart():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "submissions.journal")
+
+        the_journal = journal.SubmissionJournal(path)
+        the_journal.record(1, journal.DOCUMENT_UPLOADED, 100)
+        the_journal.reset(1)
+        the_journal.close()
+
+        the_journal = journal.SubmissionJournal(path)
+        assert 1 not in the_journal
+        the_journal.close()
@@ -0,0 +1,19 @@
+import json
+
+from suso import letters
+from suso.letters import LetterRecord
+
+
+def test_table_round_trip():
+    letter = LetterRecord(
+        1, cbo_name="Example CBO", guardian="Pat Smith", zipcode="20001"
+    )
+    letter.pdf_path = "pdf/1.pdf"
+    letter.job_id = 245985
+    deferred = LetterRecord(2, cbo_name="Example CBO")
+    deferred.deferred = True
+
+    table = json.loads(json.dumps(letters.to_table([letter, deferred])))
+    assert letters.from_table(table) == [letter, deferred]
+    assert letters.from_table(table)[0].rendered
+    assert letter.recipient()["firstname"] == "Pat Smith"
@@ -0,0 +1,56 @@
+import yaml
+from click.testing import CliRunner
+
+from suso import cli, metrics
+
+
+def test_endpoint_label():
+    assert metrics.endpoint_label("jobs", "12345/submit") == "jobs/{id}/submit"
+    assert (
+        metrics.endpoint_label("Security.svc", "SSOAuthenticate/")
+        == "Security.svc/SSOAuthenticate"
+    )
+
+
+def test_run_metrics_text():
+    run_metrics = metrics.RunMetrics()
+    run_metrics.success = True
+    run_metrics.letters_submitted = 3
+    run_metrics.http.record("click2mail", "post", "jobs/{id}/submit", 200, 0.2)
+    run_metrics.http.record("click2mail", "post", "jobs/{id}/submit", 500, 3.0)
+
+    text = run_metrics.to_text()
+    assert "suso_run_success 1\n" in text
+    assert "suso_letters_submitted 3\n" in text
+    assert (
+        'suso_http_requests{vendor="click2mail",endpoint="jobs/{id}/submit",'
+        'method="POST",code="500"} 1\n'
+    ) in text
+    assert (
+        'suso_http_request_duration_seconds_bucket{vendor="click2mail",'
+        'endpoint="jobs/{id}/submit",le="0.25"} 1\n'
+    ) in text
+    assert (
+        'suso_http_request_duration_seconds_count{vendor="click2mail",'
+        'endpoint="jobs/{id}/submit"} 2\n'
+    ) in text
+
+
+def test_simulated_run_writes_metrics(tmp_path):
+    config = tmp_path / "config.yml"
+    config.write_text(yaml.safe_dump({"simulate": {"render_latency": 0, "seed": 1}}))
+    path = tmp_path / "metrics.prom"
+
+    result = CliRunner().invoke(
+        cli.cli, ["run", str(config), "--simulate", "20", "--metrics", str(path)]
+    )
+    assert result.exit_code == 0, result.output
+
+    # Every sample is labelled with the tenant, named after the config
+    text = path.read_text()
+    assert 'suso_run_success{tenant="config"} 1\n' in text
+    assert 'suso_stage_duration_seconds{tenant="config",stage="render"}' in text
+    assert (
+        'suso_http_requests{tenant="config",vendor="eto",endpoint="participant"'
+    ) in text
+    assert 'suso_db_table_rows{tenant="config",table="students_new"}' in text
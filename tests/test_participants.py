@@ -0,0 +1,71 @@
+import pandas as pd
+
+from suso import database as db
+from suso import participants
+from suso.letters import LetterRecord
+
+
+def test_student_rows_and_letters():
+    raw = pd.DataFrame(
+        {
+            "CLID": [1, 1, 2],
+            "FName": ["Ann", "Ann", None],
+            "LName": ["Smith", "Smith", "Jones"],
+            "address": ["1 Main St", "1 Main St", "2 Main St"],
+            "zipcode": ["20001", "20001", "20002"],
+            "guardian_firstname": ["Pat", "Pat", "Sam"],
+            "guardian_lastname": ["Smith", "Smith", "Jones"],
+            "site_name": ["Example CBO"] * 3,
+            "staff_first_name": ["User12", "User12", None],
+            "staff_last_name": ["Worker", "Worker", "Worker"],
+            "school_name": ["Example School"] * 3,
+            "referral_date": ["2018-01-01", "2018-02-01", "2018-01-15"],
+        }
+    )
+
+    students = participants.student_rows(participants.latest_referrals(raw))
+    assert list(students.columns) == list(db.STUDENT_COLUMNS)
+    assert db._to_rows(students.sort_values("id"), db.STUDENT_COLUMNS) == [
+        (
+            1,
+            "Ann",
+            "Smith",
+            "1 Main St",
+            "20001",
+            "Pat",
+            "Smith",
+            "Example CBO",
+            "User12 Worker",
+            "Example School",
+            "2018-02-01",
+            1,
+        ),
+        (
+            2,
+            None,
+            "Jones",
+            "2 Main St",
+            "20002",
+            "Sam",
+            "Jones",
+            "Example CBO",
+            None,
+            "Example School",
+            "2018-01-15",
+            0,
+        ),
+    ]
+
+    letters = students.assign(is_treatment=[1, 0])
+    letters["caseworker"] = participants.fix_caseworkers(letters)
+    assert participants.letter_records(letters) == [
+        LetterRecord(
+            1,
+            cbo_name="Example CBO",
+            school="Example School",
+            guardian="Pat Smith",
+            caseworker_name="User Worker",
+            address="1 Main St",
+            zipcode="20001",
+        )
+    ]
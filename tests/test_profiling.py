@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+from suso import profiling
+
+
+def test_profiler_records_stages(tmp_path):
+    profiler = profiling.Profiler(cprofile=True, cprofile_directory=str(tmp_path))
+    with profiler.stage("work") as stage:
+        sum(i * i for i in range(10000))
+        stage.count("items", 10000)
+    with pytest.raises(ValueError):
+        with profiler.stage("broken"):
+            raise ValueError("oops")
+
+    path = tmp_path / "profile.json"
+    profiler.write(str(path))
+    report = json.loads(path.read_text())
+
+    work, broken = report["stages"]
+    assert work["counts"] == {"items": 10000}
+    assert work["wall_seconds"] >= 0
+    assert "genexpr" in work["top_functions"]
+    assert broken["error"] == "ValueError('oops')"
+    assert (tmp_path / "work.prof").exists()
+    assert "work" in profiler.summary()
+
+
+def test_disabled_profiler_writes_nothing(tmp_path):
+    profiler = profiling.Profiler(enabled=False)
+    with profiler.stage("work"):
+        pass
+    profiler.write(str(tmp_path / "profile.json"))
+    assert not (tmp_path / "profile.json").exists()
+    assert profiler.stages[0].wall_seconds is not None
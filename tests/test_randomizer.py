@@ -0,0 +1,39 @@
+import pytest
+
+from suso import randomizer
+
+
+def test_assignments_are_deterministic():
+    first = randomizer.Randomizer(key="secret")
+    second = randomizer.Randomizer(key="secret")
+    other = randomizer.Randomizer(key="another secret")
+
+    ids = list(range(1000, 1200))
+    assert first.assign(ids) == second.assign(reversed(ids))[::-1]
+    assert first.assign(ids) != other.assign(ids)
+
+
+def test_blocked_assignment_is_balanced():
+    the_randomizer = randomizer.Randomizer(key="secret", block_size=8)
+
+    # Every full block is split exactly in half
+    assignments = the_randomizer.assign(range(800, 1600))
+    assert sum(assignments) == 400
+
+    # And a scattered subset stays close
+    results = randomizer.balance(
+        the_randomizer.assign(range(800, 1600, 3)),
+        strata=[student_id % 2 for student_id in range(800, 1600, 3)],
+    )
+    assert results[0].stratum is None
+    assert results[0].p_value > 0.05
+    assert [result.stratum for result in results[1:]] == [0, 1]
+    assert "(all)" in randomizer.balance_report(results)
+
+
+def test_from_config_requires_a_key():
+    with pytest.raises(ValueError, match="key"):
+        randomizer.from_config({"randomizer": {"method": "hashed"}})
+    assert randomizer.from_config({"randomizer": {"key": "secret"}}).assign(
+        range(10)
+    ) == randomizer.Randomizer("secret").assign(range(10))
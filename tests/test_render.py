@@ -3,25 +3,22 @@ import os
 import tempfile
 
 from suso import render
+from suso.letters import LetterRecord
 
 
 def test_render_templates():
-    the_vars = {
-        "guardian": "Kevin Wilson",
-        "caseworker_name": "Peter Casey",
-        "cbo_address": "1350 Pennsylvania Avenue",
-        "cbo_zip": "20004",
-        "cbo_name": "Boys Town",
-        "school": "Simple Elementary School",
-        "contact_number": "(202) 555-1234",
-    }
+    letter = LetterRecord(
+        "kevin",
+        guardian="Kevin Wilson",
+        caseworker_name="Peter Casey",
+        cbo_name="Boys Town",
+        school="Simple Elementary School",
+    )
 
     with tempfile.TemporaryDirectory() as tex_dir, tempfile.TemporaryDirectory() as pdf_dir:
 
         # Render the templates
-        render.render_templates(
-            {"kevin": the_vars}, tex_dir, pdf_output_directory=pdf_dir
-        )
+        render.render_templates([letter], tex_dir, pdf_output_directory=pdf_dir)
 
         # There should have been exactly one
         tex_files = glob.glob(os.path.join(tex_dir, "*.tex"))
@@ -32,3 +29,63 @@ def test_render_templates():
         # Named by the relevant key
         assert tex_files[0].endswith("kevin.tex")
         assert pdf_files[0].endswith("kevin.pdf")
+
+
+def test_render_templates_defers_letters_past_the_deadline(monkeypatch):
+    import subprocess
+
+    from suso.deadline import Deadline
+
+    now = [0.0]
+    durations = {"fast": 10, "slow": 100}
+    started, killed = [], []
+
+    class FakePdflatex:
+        def __init__(self, args, cwd, **kwargs):
+            self.key = args[-1]
+            self.cwd = cwd
+            self.returncode = None
+            started.append(self.key)
+
+        def wait(self, timeout=None):
+            if self.returncode is None:
+                duration = durations[self.key]
+                if timeout is not None and duration > timeout:
+                    now[0] += timeout
+                    raise subprocess.TimeoutExpired("pdflatex", timeout)
+                now[0] += duration
+                open(os.path.join(self.cwd, self.key + ".pdf"), "wb").close()
+                self.returncode = 0
+            return self.returncode
+
+        def kill(self):
+            killed.append(self.key)
+            self.returncode = -9
+
+    monkeypatch.setattr(render.subprocess, "Popen", FakePdflatex)
+
+    def render_with(seconds, keys):
+        now[0] = 0.0
+        letters = [LetterRecord(key, cbo_name="Example CBO") for key in keys]
+        with tempfile.TemporaryDirectory() as tex_dir:
+            render.render_templates(
+                letters,
+                tex_dir,
+                deadline=Deadline(seconds, timeout=45, clock=lambda: now[0]),
+            )
+        return letters
+
+    # A pdflatex still running when the run's time is up is killed
+    fast, slow, after = render_with(50, ["fast", "slow", "after"])
+    assert fast.pdf_path and not fast.deferred
+    assert slow.deferred and after.deferred
+    assert started == ["fast", "slow"]
+    assert killed == ["slow"]
+
+    # A pdflatex isn't started at all once the deadline has passed
+    del started[:], killed[:]
+    fast, after = render_with(10, ["fast", "after"])
+    assert fast.pdf_path and not fast.deferred
+    assert after.deferred
+    assert started == ["fast"]
+    assert killed == []
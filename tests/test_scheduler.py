@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from suso import scheduler
+
+
+def test_cron_schedule_next_after():
+    # 2021-06-04 was a Friday
+    friday_night = datetime(2021, 6, 4, 23, 30, 15)
+
+    weeknights = scheduler.CronSchedule("0 19-23 * * 1-5")
+    assert weeknights.next_after(datetime(2021, 6, 4, 18, 59)) == datetime(
+        2021, 6, 4, 19, 0
+    )
+    assert weeknights.next_after(friday_night) == datetime(2021, 6, 7, 19, 0)
+
+    every_ten = scheduler.CronSchedule("*/10 * * * *")
+    assert every_ten.next_after(friday_night) == datetime(2021, 6, 4, 23, 40)
+
+    # Restricting both day fields means either may match; 7 is Sunday
+    first_or_sunday = scheduler.CronSchedule("0 0 1 * 7")
+    assert first_or_sunday.next_after(friday_night) == datetime(2021, 6, 6, 0, 0)
+    assert first_or_sunday.next_after(datetime(2021, 6, 28)) == datetime(
+        2021, 7, 1, 0, 0
+    )
+
+    for expression in ("* * * *", "60 * * * *", "* * * * 1-8", "*/0 * * * *"):
+        with pytest.raises(ValueError):
+            scheduler.CronSchedule(expression)
+
+
+def test_scheduler_runs_without_overlap_and_survives_errors():
+    clock = [datetime(2021, 6, 4, 12, 0, 30)]
+    runs = []
+
+    def job():
+        runs.append(clock[0])
+        # A long run: ticks that came due meanwhile are skipped
+        clock[0] = clock[0].replace(minute=clock[0].minute + 3)
+        if len(runs) == 1:
+            raise RuntimeError("flaky")
+
+    def sleep(seconds):
+        clock[0] += timedelta(seconds=seconds)
+
+    server = scheduler.Scheduler(
+        ["* * * * *"], job, now=lambda: clock[0], sleep=sleep, log=lambda message: None
+    )
+    assert server.run_forever(max_runs=3) == 3
+    assert runs == [
+        datetime(2021, 6, 4, 12, 1),
+        datetime(2021, 6, 4, 12, 5),
+        datetime(2021, 6, 4, 12, 9),
+    ]
+
+    server.stop()
+    assert server.run_forever() == 0
+
+
+def test_serve_command_starts(tmp_path, monkeypatch):
+    import yaml
+    from click.testing import CliRunner
+
+    from suso import cli
+
+    config = tmp_path / "config.yml"
+    config.write_text(
+        yaml.safe_dump(
+            {
+                "db": {"backend": "sqlite", "database": str(tmp_path / "s.sqlite3")},
+                "serve": {"schedule": "0 19 * * 1-5"},
+            }
+        )
+    )
+    started = []
+    monkeypatch.setattr(
+        scheduler.Scheduler, "install_signal_handlers", lambda self: None
+    )
+    monkeypatch.setattr(
+        scheduler.Scheduler, "run_forever", lambda self: started.append(self.next_run())
+    )
+
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "serve",
+            str(config),
+            "--pdf",
+            str(tmp_path / "pdf"),
+            "--metrics",
+            str(tmp_path / "suso.prom"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert len(started) == 1
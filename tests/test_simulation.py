@@ -0,0 +1,46 @@
+import pytest
+import yaml
+from click.testing import CliRunner
+
+from suso import cli, simulation
+
+
+def test_simulated_run(tmp_path):
+    config = tmp_path / "config.yml"
+    config.write_text(yaml.safe_dump({"simulate": {"render_latency": 0, "seed": 1}}))
+
+    result = CliRunner().invoke(cli.cli, ["run", str(config), "--simulate", "40"])
+    assert result.exit_code == 0, result.output
+    assert "Simulated 40 participants" in result.output
+    assert "Bottleneck:" in result.output
+    assert "MailChimp: 3 requests, 1 emails" in result.output
+    assert "0 errors" in result.output
+
+
+def test_settings_from_config():
+    settings = simulation.settings_from_config({"simulate": {"eto_latency": 0.5}})
+    assert settings.eto_latency == 0.5
+    assert settings.render_latency is None
+
+    with pytest.raises(ValueError, match="eto_latency_ms"):
+        simulation.settings_from_config({"simulate": {"eto_latency_ms": 5}})
+
+
+def test_simulated_run_with_click2mail_errors(tmp_path):
+    config = tmp_path / "config.yml"
+    config.write_text(
+        yaml.safe_dump(
+            {
+                "simulate": {
+                    "render_latency": 0,
+                    "seed": 1,
+                    "click2mail_error_rate": 0.05,
+                }
+            }
+        )
+    )
+
+    # Injected failures are retried rather than stopping the rehearsal
+    result = CliRunner().invoke(cli.cli, ["run", str(config), "--simulate", "60"])
+    assert result.exit_code == 0, result.output
+    assert " 0 errors" in result.output
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from suso import cli
+from suso import database as db
+from suso import simulation, stages
+
+
+def test_stages_between():
+    assert stages.stages_between() == stages.STAGES
+    assert stages.stages_between("render") == ("render", "submit", "notify")
+    assert stages.stages_between("render", "render") == ("render",)
+    with pytest.raises(ValueError):
+        stages.stages_between("submit", "render")
+
+
+def test_rerun_from_failed_stage(tmp_path):
+    settings = simulation.DEFAULT_SETTINGS._replace(render_latency=0)
+    with simulation.Simulation({}, 30, settings, str(tmp_path)) as sim:
+        conn = db.get_connection(sim.config["db"])
+        cli.create_database(conn)
+        conn.close()
+
+        def broken_renderer(*args, **kwargs):
+            raise EnvironmentError("pdflatex died")
+
+        def run(**kwargs):
+            with db.ConnectionPool(sim.config["db"], size=1) as pool:
+                with pool.session() as session:
+                    cli.run(
+                        sim.config,
+                        session,
+                        sim.tex,
+                        sim.pdf,
+                        None,
+                        api=sim.eto,
+                        client=sim.click2mail,
+                        mailer=sim.mailchimp,
+                        **kwargs
+                    )
+
+        with pytest.raises(EnvironmentError):
+            run(renderer=broken_renderer)
+
+        outputs = stages.StageOutputs(os.path.join(sim.pdf, "stages"))
+        assert outputs.load(stages.INGEST)["new_students"] == 30
+        with pytest.raises(stages.MissingStageOutput):
+            outputs.load(stages.RENDER)
+        with pytest.raises(stages.MissingStageOutput):
+            run(renderer=sim.renderer, start=stages.SUBMIT)
+
+        # Picking up from the failed stage doesn't go back to ETO
+        eto_requests = sum(sim.eto.requests.values())
+        run(renderer=sim.renderer, start=stages.RENDER)
+        assert sum(sim.eto.requests.values()) == eto_requests
+
+        submitted = outputs.load(stages.SUBMIT)
+        assert submitted["submitted"] == submitted["letters"] > 0
+        assert len(sim.mailchimp.sent) == 1
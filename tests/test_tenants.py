@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from suso import tenants
+
+
+def test_find_tenants(tmp_path):
+    configs = tmp_path / "configs"
+    configs.mkdir()
+    for filename in ("b.yml", "a.yaml", "notes.txt"):
+        (configs / filename).write_text("")
+    (tmp_path / "c.yml").write_text("")
+
+    found = tenants.find_tenants([str(configs), str(tmp_path / "c.yml")])
+    assert list(found) == ["a", "b", "c"]
+    assert found["c"] == str(tmp_path / "c.yml")
+
+    with pytest.raises(ValueError, match="Two configs are named c"):
+        tenants.find_tenants([str(tmp_path / "c.yml"), str(tmp_path / "c.yml")])
+
+
+def test_run_in_processes(tmp_path):
+    # os.makedirs is a handy target: it fails if the directory already exists
+    existing = tmp_path / "existing"
+    existing.mkdir()
+    jobs = [
+        ("good", {"name": str(tmp_path / "new")}),
+        ("bad", {"name": str(existing)}),
+    ]
+    results = tenants.run_in_processes(
+        jobs, os.makedirs, str(tmp_path / "logs"), workers=1, log=lambda message: None
+    )
+
+    exit_codes = {result.name: result.exit_code for result in results}
+    assert exit_codes == {"good": 0, "bad": 1}
+    assert (tmp_path / "new").is_dir()
+    assert "FileExistsError" in (tmp_path / "logs" / "bad.log").read_text()
+    assert "exit code 0" in (tmp_path / "logs" / "good.log").read_text()
+
+
+def test_tenants_profile_apart():
+    from suso import cli
+
+    profile_paths = [
+        cli.tenant_arguments(
+            name, f"{name}.yml", "tex", "pdf", None, "/work/profile.json", None, None
+        )["profile_path"]
+        for name in ("a", "b")
+    ]
+    assert profile_paths == ["/work/profile-a.json", "/work/profile-b.json"]
+    assert [cli.cprofile_directory(path) for path in profile_paths] == [
+        "/work/profile-a-cprofile",
+        "/work/profile-b-cprofile",
+    ]